@@ -1,16 +1,29 @@
 import configparser
 import datetime
-import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from telnetlib import Telnet
 
 import requests
 from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import true, false
 
 import qrz
+from common.crawl_priority import crawl_score_clause
+from common.expect import expect
+from common.metrics import metrics, export
+from common.geocode_cache import GeocodeCache
+from common.rate_limit import RateLimiter
+from common.string_cleaner import non_word, get_callsign
+
+_geocode_cache = None
+_qrz_client = None
+_rate_limiters = {}
+
+
+class LookupNotFound(Exception):
+    pass
 
 
 def get_conf():
@@ -39,76 +52,382 @@ def get_conf():
     return config_options
 
 
-def get_info(callsign, method):
+def get_cache_conf():
+    """
+    Get geocode cache options. The [cache] section is optional, so this
+    doesn't require the rest of settings.cfg to be present.
+    :return: Dict of cache options
+    """
+
+    config = configparser.ConfigParser()
+    config.read("settings.cfg")
+
+    cache_options = {
+        'enabled': config.getboolean('cache', 'enabled', fallback=True),
+        'path': config.get('cache', 'path', fallback="geocode_cache.sqlite"),
+        'ttl_days': config.getfloat('cache', 'ttl_days', fallback=30),
+        'negative_ttl_hours': config.getfloat('cache', 'negative_ttl_hours',
+                                              fallback=24)
+    }
+
+    return cache_options
+
+
+def get_lookup_conf():
+    """
+    Get batch lookup options from the optional [lookup] section
+    :return: Dict of lookup options
+    """
+
+    config = configparser.ConfigParser()
+    config.read("settings.cfg")
+
+    lookup_options = {
+        'workers': config.getint('lookup', 'workers', fallback=4),
+        'hamdb_rate': config.getfloat('lookup', 'hamdb_rate', fallback=2),
+        'qrz_rate': config.getfloat('lookup', 'qrz_rate', fallback=2)
+    }
+
+    return lookup_options
+
+
+def get_daemon_conf():
+    """
+    Get crawl cadences from the optional [daemon] section. Intervals are in
+    seconds, and 0 disables a job.
+    :return: Dict of daemon options
+    """
+
+    config = configparser.ConfigParser()
+    config.read("settings.cfg")
+
+    daemon_options = {
+        'local_mh_interval': config.getint('daemon', 'local_mh_interval',
+                                           fallback=300),
+        'remote_mh_interval': config.getint('daemon', 'remote_mh_interval',
+                                            fallback=600),
+        'nodes_interval': config.getint('daemon', 'nodes_interval',
+                                        fallback=3600),
+        'geocode_interval': config.getint('daemon', 'geocode_interval',
+                                          fallback=120),
+        'parallel': config.getint('daemon', 'parallel', fallback=4),
+        'count': config.getint('daemon', 'count', fallback=8)
+    }
+
+    return daemon_options
+
+
+def get_metrics_conf():
+    """
+    Get run metrics options from the optional [metrics] section. Empty
+    paths turn that output off.
+    :return: Dict of metrics options
+    """
+
+    config = configparser.ConfigParser()
+    config.read("settings.cfg")
+
+    metrics_options = {
+        'json_file': config.get('metrics', 'json_file', fallback=""),
+        'prometheus_dir': config.get('metrics', 'prometheus_dir',
+                                     fallback=""),
+        'store': config.getboolean('metrics', 'store', fallback=False)
+    }
+
+    return metrics_options
+
+
+def save_metrics(run, session=None, RunMetric=None):
+    """
+    Write the run's metrics to the outputs set in [metrics]. Errors are
+    printed, so a bad metrics path can't fail a crawl.
+    :param run: Script name, ie mh_crawler
+    :param session: A session object, to store the metrics in the DB
+    :param RunMetric: a DB Object
+    :return: Metrics snapshot dict
+    """
+    metrics_conf = get_metrics_conf()
+    snapshot = metrics.snapshot(run)
+
+    try:
+        export(snapshot, metrics_conf['json_file'],
+               metrics_conf['prometheus_dir'])
+    except OSError as e:
+        print(f"Couldn't write metrics: {e}")
+
+    if metrics_conf['store'] and session is not None:
+        session.add(RunMetric(
+            run=run,
+            started=datetime.datetime.utcfromtimestamp(
+                int(snapshot['started'])),
+            seconds=snapshot['seconds'],
+            data=snapshot))
+        session.commit()
+
+    return snapshot
+
+
+def get_rate_limiter(provider):
+    """
+    Get the shared rate limiter for a lookup provider
+    :param provider: hamdb or qrz
+    :return: RateLimiter object
+    """
+
+    if provider not in _rate_limiters:
+        lookup_conf = get_lookup_conf()
+        _rate_limiters[provider] = RateLimiter(
+            lookup_conf[f'{provider}_rate'])
+
+    return _rate_limiters[provider]
+
+
+def get_geocode_cache():
+    """
+    Get the geocode cache, opening it on first use
+    :return: GeocodeCache object, or None if caching is disabled
+    """
+    global _geocode_cache
+
+    if _geocode_cache is None:
+        cache_conf = get_cache_conf()
+        if not cache_conf['enabled']:
+            return None
+        _geocode_cache = GeocodeCache(
+            cache_conf['path'],
+            ttl=cache_conf['ttl_days'] * 86400,
+            negative_ttl=cache_conf['negative_ttl_hours'] * 3600
+        )
+
+    return _geocode_cache
+
+
+def get_qrz_client():
+    """
+    Get the QRZ client for this process. The client keeps its HTTP
+    connections open and saves its session key to disk, so later runs can
+    skip the login until QRZ times the session out.
+    :return: qrz.QRZ object
+    """
+    global _qrz_client
+
+    if _qrz_client is None:
+        config = configparser.ConfigParser()
+        config.read("settings.cfg")
+        session_file = config.get('qrz', 'session_file',
+                                  fallback="qrz_session.key")
+        _qrz_client = qrz.QRZ(cfg="settings.cfg", session_file=session_file)
+
+    return _qrz_client
+
+
+def get_info(callsign, method, use_cache=True):
     """
-    Get info from hamdb
+    Get info from hamdb or QRZ, going through the geocode cache first
     :param callsign: Callsign string
+    :param method: hamdb or qrz
+    :param use_cache: Set to False to always query the provider
     :return: call & lat/long
     """
 
+    if callsign:
+        callsign = non_word.sub(' ', callsign)
+
+        if not get_callsign(callsign).valid:
+            return None
+    else:
+        return None
+
+    provider = "hamdb" if method == "hamdb" else "qrz"
+    cache = get_geocode_cache() if use_cache else None
+
+    metrics.count('lookups')
+    if cache:
+        hit, result = cache.get(callsign, provider)
+        if hit:
+            metrics.count('lookup_cache_hits')
+            return result
+
+    get_rate_limiter(provider).wait()
+
+    try:
+        with metrics.timer(f'lookup_{provider}'):
+            result = _lookup(callsign, method)
+    except (qrz.CallsignNotFound, LookupNotFound):
+        metrics.count('lookup_not_found')
+        result = None
+    else:
+        if result is None:
+            # Lookup failed, don't remember it as not found
+            metrics.count('lookup_failures')
+            return None
+
+    if cache:
+        cache.put(callsign, provider, result)
+
+    return result
+
+
+def get_info_many(callsigns, method, max_workers=None):
+    """
+    Look up many callsigns at once on a bounded thread pool. Requests to
+    each provider are rate limited, and cached calls don't wait at all.
+    :param callsigns: Iterable of callsign strings
+    :param method: hamdb or qrz
+    :param max_workers: Number of lookup threads. Defaults to [lookup]
+    workers.
+    :return: Dict of callsign: get_info result
+    """
+
+    callsigns = list({call for call in callsigns if call})
+    if not callsigns:
+        return {}
+
+    if max_workers is None:
+        max_workers = get_lookup_conf()['workers']
+
+    # Set up the shared cache, limiter and client before the threads start
+    get_geocode_cache()
+    if method == "hamdb":
+        get_rate_limiter("hamdb")
+    else:
+        get_rate_limiter("qrz")
+        get_qrz_client()
+
+    def lookup(call):
+        try:
+            return get_info(call, method)
+        except Exception as e:
+            print(f"Error {e} on {call}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(callsigns, executor.map(lookup, callsigns)))
+
+    return results
+
+
+def get_cached_info_many(callsigns, method):
+    """
+    Get the callsigns that are in the geocode cache, without querying the
+    provider
+    :param callsigns: Iterable of callsign strings
+    :param method: hamdb or qrz
+    :return: Dict of callsign: cached get_info result. Calls that aren't
+    cached are left out; calls cached as not found and calls get_info
+    wouldn't look up map to None.
+    """
+    cache = get_geocode_cache()
+    if cache is None:
+        return {}
+
+    provider = "hamdb" if method == "hamdb" else "qrz"
+    results = {}
+    hits = 0
+    for call in {call for call in callsigns if call}:
+        # get_info rejects these without caching them, so they'd never be
+        # cache hits
+        if not get_callsign(non_word.sub(' ', call)).valid:
+            results[call] = None
+            continue
+
+        hit, result = cache.get(non_word.sub(' ', call), provider)
+        if hit:
+            results[call] = result
+            hits += 1
+
+    metrics.count('lookup_cache_hits', hits)
+
+    return results
+
+
+def _lookup(callsign, method):
+    """
+    Query hamdb or QRZ for a callsign
+    :param callsign: Validated callsign string
+    :param method: hamdb or qrz
+    :return: (lat, lon, grid), or None if the lookup failed
+    :raises LookupNotFound, qrz.CallsignNotFound: Provider doesn't know the
+    call
+    """
+
     lat = None
     lon = None
     grid = None
     max_retries = 3
     retry_delay = 5
 
-    if callsign:
-        callsign = re.sub(r'[^\w]', ' ', callsign)
-        match = re.match(r'[A-Za-z0-9]*([a-zA-Z]+[0-9]+|[0-9]+[a-zA-Z]+)',
-                            callsign)
-
-        if match is None:
-            return None
-
-        if method == "hamdb":
-            req = f"http://api.hamdb.org/{callsign}/json/mh-stats"
-            http_results = None
-            for attempt in range(max_retries):
-                try:
-                    http_results = requests.get(req).json()
-                    break  # If the request is successful, exit the loop
-                except Exception as e:
-                    print(f"Attempt {attempt + 1} failed: {e}")
-                    if attempt < max_retries - 1:
-                        print(f"Retrying in {retry_delay} seconds...")
-                        sleep(retry_delay)
-                    else:
-                        return None
-
-            lat = http_results['hamdb']['callsign']['lat']
-            lon = http_results['hamdb']['callsign']['lon']
-            grid = http_results['hamdb']['callsign']['grid']
-
-            if lat == "NOT_FOUND" or lon == "NOT_FOUND" or grid == "NOT_FOUND":
-                return None
-        else:
+    if method == "hamdb":
+        req = f"http://api.hamdb.org/{callsign}/json/mh-stats"
+        http_results = None
+        for attempt in range(max_retries):
             try:
-                qrz_instance = qrz.QRZ(cfg="settings.cfg")
-                http_results = qrz_instance.callsign(callsign)
-                lat = http_results['lat']
-                lon = http_results['lon']
-                grid = http_results['grid']
-            except qrz.CallsignNotFound or qrz.QRZsessionNotFound:
-                return None
+                http_results = requests.get(req).json()
+                break  # If the request is successful, exit the loop
+            except Exception as e:
+                print(f"Attempt {attempt + 1} failed: {e}")
+                if attempt < max_retries - 1:
+                    print(f"Retrying in {retry_delay} seconds...")
+                    sleep(retry_delay)
+                else:
+                    return None
 
+        lat = http_results['hamdb']['callsign']['lat']
+        lon = http_results['hamdb']['callsign']['lon']
+        grid = http_results['hamdb']['callsign']['grid']
+
+        if lat == "NOT_FOUND" or lon == "NOT_FOUND" or grid == "NOT_FOUND":
+            raise LookupNotFound(callsign)
     else:
-        return None
+        try:
+            http_results = get_qrz_client().callsign(callsign)
+            lat = http_results['lat']
+            lon = http_results['lon']
+            grid = http_results['grid']
+        except qrz.QRZsessionNotFound:
+            return None
 
     return (lat, lon, grid)
 
 
+def get_last_seen(session, call_column, heard_column, check_column, calls):
+    """
+    Get the latest last heard & last check times for a batch of calls with
+    one grouped query
+    :param session: A session object
+    :param call_column: Callsign column of the table, ie Operator.call
+    :param heard_column: Last heard column of the table
+    :param check_column: Last check column of the table
+    :param calls: Iterable of callsigns in the current batch
+    :return: Dict of call: (last_heard, last_check). Calls that aren't in
+    the table are left out.
+    """
+
+    calls = set(calls)
+    if not calls:
+        return {}
+
+    results = session.query(call_column, func.max(heard_column),
+                            func.max(check_column)). \
+        filter(call_column.in_(calls)). \
+        group_by(call_column).all()
+
+    return {row[0]: (row[1], row[2]) for row in results}
+
+
 def telnet_connect():
     """
     Connect to telnet & return telnet object
     :return: Telnet object
     """
     conf = get_conf()
-    tn = Telnet(conf['telnet_ip'], conf['telnet_port'], timeout=5)
-    tn.read_until(b"user: ", timeout=2)
-    tn.write(conf['telnet_user'].encode('ascii') + b"\r")
-    tn.read_until(b"password:", timeout=2)
-    tn.write(conf['telnet_pw'].encode('ascii') + b"\r")
-    tn.read_until(b'Telnet Server\r\n', timeout=20)
+    with metrics.timer('gateway_login'):
+        tn = Telnet(conf['telnet_ip'], conf['telnet_port'], timeout=5)
+        tn.read_until(b"user: ", timeout=2)
+        tn.write(conf['telnet_user'].encode('ascii') + b"\r")
+        tn.read_until(b"password:", timeout=2)
+        tn.write(conf['telnet_pw'].encode('ascii') + b"\r")
+        tn.read_until(b'Telnet Server\r\n', timeout=20)
 
     return tn
 
@@ -126,61 +445,88 @@ def node_connect(node_name, tn):
 
     try:
         tn.write(b"\r\n" + connect_cmd + b"\r")
-        con_results = tn.read_until(b'Connected to', timeout=30)
+        # Stop at the first answer instead of waiting out the timeout when
+        # the connect fails
+        with metrics.timer('node_connect'):
+            index, con_results = expect(
+                tn, [b'Connected to', b'Downlink connect needs port number',
+                     b'Failure with', b'Busy from'], timeout=30)
     except ConnectionResetError:
         print("Connection reset")
         return None
 
     # Stuck on local node
-    if con_results == b'\r\n' or \
-            b"Downlink connect needs port number" in con_results:
+    if index != 0:
         print(f"Couldn't connect to {node_name}")
+        metrics.count('node_connect_failures')
         tn.write(b'b\r')
-        exit()
+        return None
     else:
         print(f"Connected to {node_name}")
-        #tn.write(b'\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n')
-        #tn.read_until(b"\n", timeout=20)
-        sleep(3)
+        # Let the connect text finish instead of sleeping a fixed time
+        expect(tn, [], timeout=5, idle=1)
         return tn
 
 
-def auto_node_selector(CrawledNode, session, refresh_days):
+def auto_node_selector(CrawledNode, session, refresh_days, limit=1):
     """
-    Automatically get a node to crawl
+    Automatically get nodes to crawl. Due ports are ranked by how many new
+    MH rows a crawl is expected to find for the time it takes.
     :param CrawledNode: a DB Object
     :param session: A session object
     :param refresh_days: Days ago to select from DB
-    :return: A dict containing (id, port, last_crawled, port_name)
+    :param limit: Most node ports to return. Only one port per node is
+    returned.
+    :return: A dict containing (id, port, last_crawled, port_name,
+    new_station_rate, crawl_seconds) for each node
     """
-    node_to_crawl_info = None
-    refresh_time = datetime.datetime.utcnow().replace(microsecond=0) - \
-                   datetime.timedelta(days=refresh_days)
-    # Get a node that hasn't been crawled in 2 weeks
+    node_to_crawl_info = {}
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    refresh_time = now - datetime.timedelta(days=refresh_days)
 
-    try:
-        # Get a node port that doesn't need check and is active
-        crawled_nodes = session.query(CrawledNode).filter(
-            CrawledNode.last_crawled < refresh_time). \
-            filter(CrawledNode.needs_check == false(),
-                   CrawledNode.active_port == true()). \
-            order_by(func.random()).limit(1).one_or_none()
-        if crawled_nodes:
-            node_to_crawl_info = {
-                crawled_nodes.node_id: (
-                    crawled_nodes.id,
-                    crawled_nodes.port,
-                    crawled_nodes.last_crawled,
-                    crawled_nodes.port_name
-                )
-            }
-
-    except NoResultFound:
-        print("Nothing to crawl")
-        exit()
+    # Get node ports that don't need check and are active. Extra ports are
+    # fetched, as only the best port of each node is used.
+    crawled_nodes = session.query(CrawledNode).filter(
+        CrawledNode.last_crawled < refresh_time). \
+        filter(CrawledNode.needs_check == false(),
+               CrawledNode.active_port == true()). \
+        order_by(crawl_score_clause(CrawledNode, now).desc()). \
+        limit(limit * 4).all()
+
+    for crawled_node in crawled_nodes:
+        if len(node_to_crawl_info) >= limit:
+            break
 
-    if node_to_crawl_info is None:
+        node_to_crawl_info.setdefault(crawled_node.node_id, (
+            crawled_node.id,
+            crawled_node.port,
+            crawled_node.last_crawled,
+            crawled_node.port_name,
+            crawled_node.new_station_rate,
+            crawled_node.crawl_seconds
+        ))
+
+    if not node_to_crawl_info:
         print("Nothing to crawl")
-        exit()
 
     return node_to_crawl_info
+
+
+def active_node_ports(CrawledNode, session, node_id):
+    """
+    Get every active port of a node that doesn't need a check
+    :param CrawledNode: a DB Object
+    :param session: A session object
+    :param node_id: Node name
+    :return: List of (id, port, last_crawled, port_name, new_station_rate,
+    crawl_seconds), like auto_node_selector, sorted by port
+    """
+    crawled_nodes = session.query(CrawledNode).filter(
+        CrawledNode.node_id == node_id,
+        CrawledNode.needs_check == false(),
+        CrawledNode.active_port == true()). \
+        order_by(CrawledNode.port).all()
+
+    return [(crawled_node.id, crawled_node.port, crawled_node.last_crawled,
+             crawled_node.port_name, crawled_node.new_station_rate,
+             crawled_node.crawl_seconds) for crawled_node in crawled_nodes]
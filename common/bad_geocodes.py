@@ -0,0 +1,109 @@
+class BadGeocodeIndex(object):
+    """
+    Bad geocode node names, indexed by their alias and callsign parts. A
+    name like 'LPBNOD:KD5LPB-7' can be found by 'LPBNOD', 'KD5LPB-7' or
+    'KD5LPB', so checking a node or operator is a dict lookup instead of a
+    scan of every bad geocode.
+    """
+
+    def __init__(self, rows=()):
+        """
+        :param rows: Iterable of (node_name, last_checked) tuples
+        """
+        # node name: last checked datetime
+        self._names = {}
+        # alias or callsign part: latest last checked datetime of the names
+        # it's in
+        self._tokens = {}
+
+        for node_name, last_checked in rows:
+            self.add(node_name, last_checked)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        """
+        :param name: Node name, alias or callsign
+        :return: True if it's a bad geocode name or part of one
+        """
+        if name is None:
+            return False
+
+        name = name.strip()
+
+        return name in self._names or name in self._tokens
+
+    def has_name(self, node_name):
+        """
+        Check for a bad geocode row with exactly this node name, without
+        matching its parts
+        :param node_name: Node name like 'LPBNOD:KD5LPB-7'
+        :return: True if there's a row with this name
+        """
+        if node_name is None:
+            return False
+
+        return node_name.strip() in self._names
+
+    def add(self, node_name, last_checked=None):
+        """
+        Add a bad geocode
+        :param node_name: Node name like 'LPBNOD:KD5LPB-7', or a callsign
+        :param last_checked: Datetime the name was last geocoded
+        """
+        node_name = node_name.strip()
+        self._names[node_name] = last_checked
+
+        for token in tokens(node_name):
+            checked = self._tokens.get(token)
+            if token not in self._tokens or \
+                    (last_checked is not None and
+                     (checked is None or last_checked > checked)):
+                self._tokens[token] = last_checked
+
+    def get(self, name):
+        """
+        Get the last checked time of a bad geocode
+        :param name: Node name, alias or callsign
+        :return: Datetime, or None if it isn't a bad geocode or was never
+        checked. A part shared by several names gets the latest time.
+        """
+        if name is None:
+            return None
+
+        name = name.strip()
+        if name in self._names:
+            return self._names[name]
+
+        return self._tokens.get(name)
+
+
+def tokens(node_name):
+    """
+    Split a node name into the parts it can be looked up by
+    :param node_name: Node name like 'LPBNOD:KD5LPB-7'
+    :return: Set of parts, ie {'LPBNOD', 'KD5LPB-7', 'KD5LPB'}
+    """
+    parts = set()
+    for part in node_name.split(':'):
+        part = part.strip()
+        if not part:
+            continue
+        parts.add(part)
+        base = part.split('-')[0]
+        if base:
+            parts.add(base)
+
+    return parts
+
+
+def load_bad_geocodes(session, BadGeocode):
+    """
+    Load every bad geocode into an index
+    :param session: A session object
+    :param BadGeocode: a DB Object
+    :return: BadGeocodeIndex
+    """
+    return BadGeocodeIndex(session.query(BadGeocode.node_name,
+                                         BadGeocode.last_checked).all())
@@ -0,0 +1,82 @@
+import re
+
+from sqlalchemy import func, text
+
+# (low MHz, high MHz, band). Ranges are wide enough to cover the port
+# names the old SQL CASE statement matched, ie 14x.xxx for 2M.
+BANDS = [
+    (3.0, 4.0, '80M'),
+    (7.0, 8.0, '40M'),
+    (14.0, 15.0, '20M'),
+    (140.0, 150.0, '2M'),
+    (219.0, 230.0, '1.25M'),
+    (400.0, 500.0, '70CM')
+]
+
+frequency_pattern = re.compile(r'(?<![\d.])(\d{1,3}\.\d+)')
+band_label_pattern = re.compile(r'(?<![\w.])(1\.25M|70CM|80M|40M|20M|2M)\b',
+                                re.IGNORECASE)
+
+
+def classify_band(port_name):
+    """
+    Get the band of a port from the frequency or band in its name
+    :param port_name: A port name like '2M 144.990 1200 Baud'
+    :return: Band string like '2M', or None if it can't be worked out
+    """
+    if not port_name:
+        return None
+
+    for frequency in frequency_pattern.findall(port_name):
+        frequency = float(frequency)
+        for low, high, band in BANDS:
+            if low <= frequency < high:
+                return band
+
+    label = band_label_pattern.search(port_name)
+    if label:
+        return label.group(1).upper()
+
+    return None
+
+
+def base_call_clause(call_column):
+    """
+    Get the base callsign of an MH row as a SQL expression, ie KD5LPB for
+    KD5LPB-7. remote_mh has an index on it, so an operator's MH rows can be
+    found without scanning the table.
+    :param call_column: Callsign column, ie RemotelyHeardStation.remote_call
+    :return: SQL expression
+    """
+    return func.regexp_replace(func.split_part(call_column, '-', 1),
+                               '[^A-Za-z0-9]+', '', 'g')
+
+
+def update_operator_bands(session, RemoteOperator, RemotelyHeardStation):
+    """
+    Fill in the bands column of remote operators that don't have one. Only
+    the MH rows of those operators are read, through the base call index.
+    :param session: A session object
+    :param RemoteOperator: a DB Object
+    :param RemotelyHeardStation: a DB Object
+    :return: Number of operators updated
+    """
+    operators = RemoteOperator.__tablename__
+    mh = RemotelyHeardStation.__tablename__
+
+    # Bands are stored like '2M,70CM,'. The join expression must match
+    # base_call_clause for the index to be used.
+    update_statement = text(
+        f"UPDATE {operators} SET bands = heard_bands.bands "
+        f"FROM (SELECT op.remote_call AS base_call, "
+        f"string_agg(DISTINCT mh.band, ',' ORDER BY mh.band) || ',' "
+        f"AS bands "
+        f"FROM {operators} AS op JOIN {mh} AS mh "
+        f"ON regexp_replace(split_part(mh.remote_call, '-', 1), "
+        f"'[^A-Za-z0-9]+', '', 'g') = op.remote_call "
+        f"WHERE op.bands IS NULL AND mh.band IS NOT NULL "
+        f"GROUP BY op.remote_call) AS heard_bands "
+        f"WHERE {operators}.remote_call = heard_bands.base_call "
+        f"AND {operators}.bands IS NULL")
+
+    return session.execute(update_statement).rowcount
@@ -0,0 +1,286 @@
+import datetime
+import re
+from collections import namedtuple
+
+from common.expect import PROMPT, DISCONNECTED
+
+# A port from the ports command, ie 1, '2M 145.050 1200'
+PortRecord = namedtuple('PortRecord', ['number', 'name'])
+
+# A heard station from the mh or mhu command. Digipeaters is a list of
+# digipeater calls, or None.
+MHRecord = namedtuple('MHRecord', ['call', 'heard_time', 'digipeaters'])
+
+# A node from the nodes command. Alias is None if the node has no alias.
+NodeRecord = namedtuple('NodeRecord', ['alias', 'call'])
+
+# A line that couldn't be parsed
+ParseError = namedtuple('ParseError', ['line', 'reason'])
+
+node_pattern = re.compile(r'(?:([^\s:]+):)?(\w+-\d+)')
+
+# mhu gives month abbreviations
+months = {month: number for number, month in
+          enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+                     'Sep', 'Oct', 'Nov', 'Dec'], start=1)}
+
+
+def parse_port_line(line):
+    """
+    Parse a line of ports output
+    :param line: Line string like '  1 2M 145.050 1200'
+    :return: PortRecord
+    """
+    match = re.match(r'\s*(\d+)\s*(.*)', line)
+    if not match:
+        raise ValueError("No port number")
+
+    return PortRecord(int(match.group(1)), match.group(2).strip())
+
+
+def parse_mh_line(line, now):
+    """
+    Parse a line of mh output. Times are given as time passed, ie
+    'KE0GB-7 00:01:02:03 via KD5LPB-7,N0CALL*' was heard 1 hour, 2 minutes
+    and 3 seconds ago.
+    :param line: Line string
+    :param now: Datetime the mh command was sent
+    :return: MHRecord
+    """
+    tokens = line.split()
+    if 'via' in tokens:
+        tokens.remove('via')
+
+    if len(tokens) < 2:
+        raise ValueError("No time heard")
+
+    try:
+        days, hours, minutes, seconds = (int(part) for part in
+                                         tokens[1].split(':'))
+    except ValueError:
+        raise ValueError(f"Bad time passed: {tokens[1]}")
+
+    heard_time = now - datetime.timedelta(days=days, hours=hours,
+                                          minutes=minutes, seconds=seconds)
+
+    return MHRecord(tokens[0].strip(), heard_time, _digipeaters(tokens, 2))
+
+
+def parse_mhu_line(line, now):
+    """
+    Parse a line of mhu output, ie 'KE0GB-7 Jan 30 12:00:00 via KD5LPB-7'.
+    The year isn't given, so times later than now are from last year.
+    :param line: Line string
+    :param now: Datetime the mhu command was sent
+    :return: MHRecord
+    """
+    tokens = line.split()
+    if 'via' in tokens:
+        tokens.remove('via')
+
+    if len(tokens) < 4:
+        raise ValueError("No time heard")
+
+    try:
+        month = months[tokens[1].title()]
+        hour, minute, second = (int(part) for part in tokens[3].split(':'))
+        heard_time = datetime.datetime(now.year, month, int(tokens[2]), hour,
+                                       minute, second)
+    except (KeyError, ValueError):
+        raise ValueError(f"Bad time heard: {' '.join(tokens[1:4])}")
+
+    if heard_time > now:
+        heard_time = heard_time.replace(year=now.year - 1)
+
+    return MHRecord(tokens[0], heard_time, _digipeaters(tokens, 4))
+
+
+def parse_nodes_line(line):
+    """
+    Parse a line of nodes output, ie 'LPBNOD:KD5LPB-7  COSCO:KE0GB-7'
+    :param line: Line string
+    :return: List of NodeRecords
+    """
+    records = [NodeRecord(alias or None, call) for alias, call in
+               node_pattern.findall(line)]
+    if not records:
+        raise ValueError("No nodes")
+
+    return records
+
+
+def port_header(port):
+    """
+    Get the header that starts the mh or mhu listing of a port
+    :param port: Port number
+    :return: Compiled regex
+    """
+    return re.compile(rb'Port %d\b' % port)
+
+
+def parse_listing(command, header, data, now=None):
+    """
+    Parse a whole transcript of a command's output
+    :param command: ports, mh, mhu or nodes
+    :param header: Bytes or compiled regex that starts the listing
+    :param data: Bytes read from telnet
+    :param now: Datetime the command was sent
+    :return: Tuple of (list of records, list of ParseErrors)
+    """
+    parser = BPQParser(command, header, now)
+    records = parser.feed(data) + parser.close()
+
+    return records, parser.errors
+
+
+def _digipeaters(tokens, index):
+    """
+    Get the digipeater list from a tokenized MH line
+    """
+    try:
+        return tokens[index].split(',')
+    except IndexError:
+        return None
+
+
+class BPQParser(object):
+    """
+    Parses BPQ command output as it's read. Feed it bytes as they arrive
+    and it returns records for each complete line. Only the last partial
+    line is kept between feeds. Lines that can't be parsed are added to
+    errors instead of stopping the parse.
+    """
+
+    def __init__(self, command, header, now=None, end=None):
+        """
+        :param command: ports, mh, mhu or nodes
+        :param header: Bytes or compiled regex that starts the listing, ie
+        b'Ports'. Anything before it is ignored.
+        :param now: Datetime the command was sent, for working out heard
+        times. Defaults to now.
+        :param end: Bytes or compiled regex that ends the listing, ie the
+        header of the next listing when several commands are sent at once.
+        The line it's on is left for the next parser. The listing always
+        ends at a disconnect message.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow().replace(microsecond=0)
+
+        self.command = command
+        self.now = now
+        self.started = False
+        self.done = False
+        self.errors = []
+        self.lines = 0
+        # Data read after the end of the listing
+        self.leftover = b''
+        self._buffer = bytearray()
+
+        if isinstance(header, bytes):
+            header = re.compile(re.escape(header))
+        self.header = header
+
+        if isinstance(end, bytes):
+            end = re.compile(re.escape(end))
+        self.end = end
+
+        parse_line = {
+            'ports': parse_port_line,
+            'mh': lambda line: parse_mh_line(line, now),
+            'mhu': lambda line: parse_mhu_line(line, now),
+            'nodes': parse_nodes_line
+        }
+        self._parse_line = parse_line[command]
+
+    def feed(self, data):
+        """
+        Parse newly read data
+        :param data: Bytes read from telnet
+        :return: List of records from the complete lines in the data
+        """
+        if self.done:
+            return []
+
+        self._buffer += data
+        end = max(self._buffer.rfind(b'\r'), self._buffer.rfind(b'\n'))
+        if end == -1:
+            return []
+
+        lines = self._buffer[:end].splitlines()
+        del self._buffer[:end + 1]
+
+        records = self._parse_lines(lines)
+        if self.done:
+            self.leftover += bytes(self._buffer)
+            self._buffer.clear()
+
+        return records
+
+    def close(self):
+        """
+        Parse whatever is left after the last line break
+        :return: List of records
+        """
+        lines = [bytes(self._buffer)]
+        self._buffer.clear()
+
+        if self.done:
+            return []
+
+        records = self._parse_lines(lines)
+        self.done = True
+
+        return records
+
+    def _parse_lines(self, lines):
+        records = []
+
+        for i, line in enumerate(lines):
+            if not self.started:
+                match = self.header.search(line)
+                if not match:
+                    continue
+                self.started = True
+                # Parse anything after the header on the same line
+                line = line[match.end():]
+
+            elif self.end and self.end.search(line):
+                self.done = True
+                self._keep_leftover(lines[i:])
+                break
+
+            # The listing ends at the disconnect message
+            end = line.find(DISCONNECTED)
+            if end != -1:
+                line = line[:end]
+                self.done = True
+
+            line = line.strip()
+            if not line or PROMPT.match(line):
+                if self.done:
+                    self._keep_leftover(lines[i + 1:])
+                    break
+                continue
+
+            self.lines += 1
+            line = line.decode('utf-8', errors='replace')
+            try:
+                record = self._parse_line(line)
+            except ValueError as e:
+                self.errors.append(ParseError(line, str(e)))
+                record = []
+
+            if isinstance(record, list):
+                records.extend(record)
+            else:
+                records.append(record)
+
+            if self.done:
+                self._keep_leftover(lines[i + 1:])
+                break
+
+        return records
+
+    def _keep_leftover(self, lines):
+        if lines:
+            self.leftover = b'\r'.join(lines) + b'\r'
@@ -0,0 +1,159 @@
+import csv
+import io
+
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Inserts that support ON CONFLICT, by dialect
+conflict_inserts = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert
+}
+
+
+class BulkWriter(object):
+    """
+    Collects new ORM objects and writes them in bulk instead of one INSERT
+    per object. Has the same add/flush interface as a session, so scripts
+    can use either one to write new rows.
+
+    With the copy method, rows are streamed to Postgres with COPY. Columns
+    that weren't set are left out so the DB fills them in, and geometry
+    columns are sent as EWKT ('SRID=4326;POINT(lon lat)') for PostGIS to
+    build the point. The insert method uses multi-row INSERT statements.
+
+    With ignore_conflicts, rows that would break a unique constraint are
+    skipped with ON CONFLICT DO NOTHING, so overlapping runs can write the
+    same rows. COPY can't skip rows, so copied rows go through a temporary
+    table first.
+    """
+
+    def __init__(self, session, method="copy", batch_size=1000,
+                 ignore_conflicts=False):
+        """
+        :param session: A session object. Rows are written in its
+        transaction.
+        :param method: copy or insert
+        :param batch_size: Rows per multi-row INSERT statement
+        :param ignore_conflicts: Skip rows that break a unique constraint
+        """
+        self.session = session
+        self.method = method
+        self.batch_size = batch_size
+        self.ignore_conflicts = ignore_conflicts
+        self._rows = {}
+        self.counts = {}
+
+    def add(self, instance):
+        """
+        Queue a new, unsaved ORM object to be written
+        :param instance: An ORM object, ie RemotelyHeardStation(...)
+        """
+        mapper = inspect(instance).mapper
+        values = {}
+
+        for attr in mapper.column_attrs:
+            column = attr.columns[0]
+            if attr.key in instance.__dict__:
+                values[column.name] = instance.__dict__[attr.key]
+            elif column.default is not None and column.default.is_scalar:
+                values[column.name] = column.default.arg
+
+        key = (mapper.local_table, tuple(values))
+        self._rows.setdefault(key, []).append(tuple(values.values()))
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    def clear(self):
+        """
+        Drop queued rows without writing them, ie after a rollback
+        """
+        self._rows = {}
+
+    def flush(self):
+        """
+        Write all queued rows
+        :return: Number of rows written, not counting skipped conflicts
+        """
+        # Pending ORM changes, like new crawled nodes, go first
+        self.session.flush()
+
+        written = 0
+        for (table, columns), rows in self._rows.items():
+            count = None
+            if self.method == "copy":
+                count = self._copy(table, columns, rows)
+            if count is None:
+                count = self._insert(table, columns, rows)
+
+            self.counts[table.name] = self.counts.get(table.name, 0) + count
+            written += count
+
+        self._rows = {}
+
+        return written
+
+    def _copy(self, table, columns, rows):
+        """
+        COPY rows into a table in CSV format
+        :return: Number of rows written, or None if the driver doesn't
+        support COPY
+        """
+        connection = self.session.connection()
+        cursor = connection.connection.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            return None
+
+        preparer = connection.dialect.identifier_preparer
+        column_names = ", ".join(preparer.quote(column) for column in columns)
+        target = preparer.format_table(table)
+        if self.ignore_conflicts:
+            # Copy into a scratch table with the same columns, then insert
+            # the rows that don't conflict
+            target = preparer.quote(f"bulk_{table.name}")
+            cursor.execute(f"DROP TABLE IF EXISTS {target}")
+            cursor.execute(f"CREATE TEMP TABLE {target} ON COMMIT DROP AS "
+                           f"SELECT {column_names} FROM "
+                           f"{preparer.format_table(table)} WITH NO DATA")
+
+        # None is sent as \N so empty strings stay empty strings
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow(['\\N' if value is None else value
+                             for value in row])
+        buf.seek(0)
+
+        cursor.copy_expert(f"COPY {target} "
+                           f"({column_names}) FROM STDIN "
+                           f"WITH (FORMAT csv, NULL '\\N')", buf)
+        count = len(rows)
+
+        if self.ignore_conflicts:
+            cursor.execute(f"INSERT INTO {preparer.format_table(table)} "
+                           f"({column_names}) SELECT {column_names} FROM "
+                           f"{target} ON CONFLICT DO NOTHING")
+            count = cursor.rowcount
+        cursor.close()
+
+        return count
+
+    def _insert(self, table, columns, rows):
+        """
+        Write rows with multi-row INSERT statements
+        :return: Number of rows written
+        """
+        count = 0
+        for i in range(0, len(rows), self.batch_size):
+            batch = [dict(zip(columns, row))
+                     for row in rows[i:i + self.batch_size]]
+            if self.ignore_conflicts:
+                dialect = self.session.connection().dialect.name
+                statement = conflict_inserts[dialect](table).values(batch). \
+                    on_conflict_do_nothing()
+            else:
+                statement = table.insert().values(batch)
+            count += self.session.execute(statement).rowcount
+
+        return count
@@ -0,0 +1,78 @@
+from sqlalchemy import func, literal
+from sqlalchemy.types import DateTime
+
+# Rate assumed for ports without crawl history, in new MH rows per day. It's
+# high so new ports get crawled soon and earn a real rate.
+PRIOR_RATE = 50.0
+# Added to every rate, so quiet ports are still crawled once they're stale
+# enough
+RATE_FLOOR = 1.0
+# Crawl time assumed for ports without crawl history
+DEFAULT_CRAWL_SECONDS = 30.0
+# Weight of the latest crawl in the rate and crawl time averages
+SMOOTHING = 0.3
+
+
+def crawl_score(last_crawled, new_station_rate, crawl_seconds, now):
+    """
+    Score a port by the new MH rows a crawl is expected to find per second
+    spent crawling. Higher is crawled first.
+    :param last_crawled: Datetime the port was last crawled
+    :param new_station_rate: New MH rows per day, or None
+    :param crawl_seconds: Seconds a crawl takes, or None
+    :param now: Current datetime
+    :return: Score float
+    """
+    if new_station_rate is None:
+        new_station_rate = PRIOR_RATE
+    if crawl_seconds is None:
+        crawl_seconds = DEFAULT_CRAWL_SECONDS
+
+    stale_days = (now - last_crawled).total_seconds() / 86400
+
+    return stale_days * (new_station_rate + RATE_FLOOR) / \
+        max(crawl_seconds, 1.0)
+
+
+def crawl_score_clause(CrawledNode, now):
+    """
+    Get crawl_score as a SQL expression, so ports can be ranked by the DB
+    :param CrawledNode: a DB Object
+    :param now: Current datetime
+    :return: SQL expression
+    """
+    stale_days = func.extract(
+        'epoch', literal(now, DateTime) - CrawledNode.last_crawled) / 86400
+
+    return stale_days * \
+        (func.coalesce(CrawledNode.new_station_rate, PRIOR_RATE) +
+         RATE_FLOOR) / \
+        func.greatest(func.coalesce(CrawledNode.crawl_seconds,
+                                    DEFAULT_CRAWL_SECONDS), 1.0)
+
+
+def update_crawl_stats(new_station_rate, crawl_seconds, new_rows, stale_days,
+                       seconds):
+    """
+    Fold a crawl into a port's averages
+    :param new_station_rate: Current new MH rows per day, or None
+    :param crawl_seconds: Current seconds per crawl, or None
+    :param new_rows: MH rows the crawl added
+    :param stale_days: Days since the port was last crawled
+    :param seconds: Seconds the crawl took
+    :return: Tuple of (new_station_rate, crawl_seconds)
+    """
+    # Don't let a quick recrawl turn a few rows into a huge rate
+    rate = new_rows / max(stale_days, 1 / 24)
+
+    if new_station_rate is None:
+        new_station_rate = rate
+    else:
+        new_station_rate += SMOOTHING * (rate - new_station_rate)
+
+    if crawl_seconds is None:
+        crawl_seconds = seconds
+    else:
+        crawl_seconds += SMOOTHING * (seconds - crawl_seconds)
+
+    return new_station_rate, crawl_seconds
@@ -0,0 +1,191 @@
+import calendar
+import datetime
+from bisect import bisect_left, insort
+
+from sqlalchemy import func, exists, select, delete, update, BigInteger
+
+# Width of the heard time buckets in the remote MH unique key. It's twice
+# the default window, so a crawl's few seconds of clock jitter rarely
+# splits one hearing across two buckets.
+HEARD_BUCKET_SECONDS = 10
+
+
+class HeardIndex(object):
+    """
+    Sorted heard times per callsign, for answering "was this call heard
+    within N seconds of this time" without scanning the whole MH history
+    """
+
+    def __init__(self, rows=(), window=5):
+        """
+        :param rows: Iterable of (call, heard_time) tuples
+        :param window: Default window in seconds either side of a time
+        """
+        self.window = datetime.timedelta(seconds=window)
+        self._times = {}
+
+        for call, heard_time in rows:
+            self._times.setdefault(call, []).append(heard_time)
+
+        for times in self._times.values():
+            times.sort()
+
+    def __len__(self):
+        return sum(len(times) for times in self._times.values())
+
+    def add(self, call, heard_time):
+        """
+        Add a heard time for a call
+        :param call: Callsign string
+        :param heard_time: Datetime the call was heard
+        """
+        insort(self._times.setdefault(call, []), heard_time)
+
+    def seen(self, call, heard_time, window=None):
+        """
+        Check if a call was heard within the window of a time
+        :param call: Callsign string
+        :param heard_time: Datetime to check
+        :param window: Seconds either side of heard_time. Defaults to the
+        index window.
+        :return: True if the call was heard in the window
+        """
+        times = self._times.get(call)
+        if not times:
+            return False
+
+        if window is None:
+            window = self.window
+        else:
+            window = datetime.timedelta(seconds=window)
+
+        i = bisect_left(times, heard_time - window)
+
+        return i < len(times) and times[i] <= heard_time + window
+
+
+def load_heard_index(session, call_column, time_column, heard_times,
+                     criteria=(), window=5):
+    """
+    Build a HeardIndex from only the rows that could collide with the
+    current MH output
+    :param session: A session object
+    :param call_column: Callsign column, ie RemotelyHeardStation.remote_call
+    :param time_column: Heard time column, ie RemotelyHeardStation.heard_time
+    :param heard_times: Heard times in the current MH output
+    :param criteria: Extra filters, like the node & port being crawled
+    :param window: Window in seconds either side of each heard time
+    :return: HeardIndex object
+    """
+    heard_times = list(heard_times)
+    if not heard_times:
+        return HeardIndex(window=window)
+
+    delta = datetime.timedelta(seconds=window)
+    rows = session.query(call_column, time_column). \
+        filter(time_column >= min(heard_times) - delta,
+               time_column <= max(heard_times) + delta,
+               *criteria).all()
+
+    return HeardIndex(rows, window=window)
+
+
+def heard_bucket(heard_time):
+    """
+    Get the heard time bucket of an MH row, for the unique key that stops
+    overlapping crawls writing the same row twice
+    :param heard_time: UTC datetime
+    :return: Bucket number
+    """
+    return calendar.timegm(heard_time.timetuple()) // HEARD_BUCKET_SECONDS
+
+
+def heard_bucket_clause(time_column):
+    """
+    Get heard_bucket as a SQL expression, for backfilling existing rows
+    :param time_column: Heard time column, ie RemotelyHeardStation.heard_time
+    :return: SQL expression
+    """
+    return func.floor(func.extract('epoch', time_column) /
+                      HEARD_BUCKET_SECONDS).cast(BigInteger)
+
+
+def natural_key(table, alias):
+    """
+    Get the columns of a table's unique key. The remote MH key is built
+    from heard_time, so rows without a heard_bucket yet are still matched.
+    :param table: Table object
+    :param alias: Alias of the table to take the columns from
+    :return: List of columns and SQL expressions
+    """
+    index = next(index for index in sorted(table.indexes,
+                                           key=lambda i: i.name)
+                 if index.unique)
+
+    return [heard_bucket_clause(alias.c.heard_time)
+            if column.name == 'heard_bucket' else alias.c[column.name]
+            for column in index.columns]
+
+
+def _duplicate_criteria(table, a, b):
+    """
+    Match rows of alias a that share a unique key with a row of alias b
+    with a lower id
+    """
+    return [a_column == b_column for a_column, b_column in
+            zip(natural_key(table, a), natural_key(table, b))] + \
+        [a.c.id > b.c.id]
+
+
+def duplicates_statement(table):
+    """
+    Build a query for a key shared by more than one row of a table. It's
+    one pass over the table instead of a self-join, and stops at the first
+    duplicate.
+    :param table: Table object
+    :return: Select statement returning a row if there are duplicates
+    """
+    key = natural_key(table, table)
+
+    return select(*key).group_by(*key).having(func.count() > 1).limit(1)
+
+
+def delete_duplicates_statement(table, start=None, end=None):
+    """
+    Build the delete of rows that share a unique key with a row of lower
+    id, so the unique index can be built
+    :param table: Table object
+    :param start: Lowest id to delete, or None
+    :param end: Id to delete up to, but not including, or None
+    :return: Delete statement
+    """
+    a = table.alias('a')
+    b = table.alias('b')
+    criteria = _duplicate_criteria(table, a, b)
+    if start is not None:
+        criteria.append(a.c.id >= start)
+    if end is not None:
+        criteria.append(a.c.id < end)
+
+    return delete(a).where(*criteria)
+
+
+def backfill_heard_bucket_statement(table, ids):
+    """
+    Build the update that sets the heard_bucket of remote MH rows. A row
+    whose key another row already has is left alone, so this can run after
+    the unique index exists.
+    :param table: Table object
+    :param ids: Row ids to update
+    :return: Update statement
+    """
+    other = table.alias('other')
+    bucket = heard_bucket_clause(table.c.heard_time)
+    taken = exists().where(other.c.parent_call == table.c.parent_call,
+                           other.c.port == table.c.port,
+                           other.c.remote_call == table.c.remote_call,
+                           other.c.heard_bucket == bucket)
+
+    return update(table). \
+        where(table.c.id.in_(ids), table.c.heard_bucket.is_(None), ~taken). \
+        values(heard_bucket=bucket)
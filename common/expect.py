@@ -0,0 +1,147 @@
+import itertools
+import re
+import select
+import time
+
+from common.metrics import metrics
+
+# Response header BPQ puts before command output, ie "GMNOD:KD5LPB-7} "
+PROMPT = re.compile(rb'[\w-]+:[\w-]+\} ')
+
+# Sent when the circuit is closed, ie after "bye"
+DISCONNECTED = b'***'
+
+# Seconds without new data before a listing is treated as complete
+IDLE_TIMEOUT = 2
+
+# Bytes of earlier data a regex pattern is matched against with each read
+REGEX_TAIL = 256
+
+
+def read_chunks(tn, timeout=20, idle=None):
+    """
+    Yield data from a telnet connection as it arrives, until the connection
+    closes or a deadline passes
+    :param tn: A Telnet connection object
+    :param timeout: Seconds to wait in total
+    :param idle: Stop after this many seconds without new data
+    :return: Generator of byte strings
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    last_data = start
+
+    while True:
+        now = time.monotonic()
+        wait = deadline - now
+        if idle is not None:
+            wait = min(wait, last_data + idle - now)
+        if wait <= 0:
+            return
+
+        # Telnet may have data buffered already that select can't see
+        if not (tn.sock_avail() or tn.rawq or tn.cookedq):
+            select.select([tn], [], [], wait)
+
+        try:
+            chunk = tn.read_very_eager()
+        except EOFError:
+            return
+
+        if chunk:
+            last_data = time.monotonic()
+            yield chunk
+
+
+def expect(tn, patterns, timeout=20, idle=None, data=b''):
+    """
+    Read from a telnet connection until one of the patterns is seen, the
+    connection closes, or a deadline passes
+    :param tn: A Telnet connection object
+    :param patterns: List of byte strings or compiled byte regexes. An empty
+    list reads until the connection closes, the deadline or the idle timeout.
+    Regexes are only matched against the new data and the last REGEX_TAIL
+    bytes before it, so they shouldn't match longer than that.
+    :param timeout: Seconds to wait in total
+    :param idle: Stop after this many seconds without new data
+    :param data: Bytes already read, ie the leftover of a parser. They're
+    searched before reading more.
+    :return: Tuple of (index of the pattern seen or -1, data read)
+    """
+    # Only the new data and enough of the old data for a match split
+    # across reads is searched, so a long read isn't searched again and
+    # again
+    tail = max([len(pattern) - 1 if isinstance(pattern, bytes)
+                else REGEX_TAIL for pattern in patterns], default=0)
+    buffer = bytearray()
+
+    chunks = read_chunks(tn, timeout, idle)
+    if data:
+        chunks = itertools.chain([data], chunks)
+    for chunk in chunks:
+        start = max(len(buffer) - tail, 0)
+        buffer += chunk
+        window = buffer[start:]
+
+        for index, pattern in enumerate(patterns):
+            if isinstance(pattern, bytes):
+                if pattern in window:
+                    return index, bytes(buffer)
+            elif pattern.search(window):
+                return index, bytes(buffer)
+
+    return -1, bytes(buffer)
+
+
+def read_records(tn, parser, timeout=30, idle=None, data=b''):
+    """
+    Parse a listing as it's read. Waits up to the timeout for the parser's
+    header, then reads until the listing ends, the connection closes, or
+    the link goes quiet. Anything read after the end of the listing, like
+    the next command's answer, is left in parser.leftover for the next
+    read.
+    :param tn: A Telnet connection object
+    :param parser: A BPQParser object
+    :param timeout: Seconds to wait for the whole listing
+    :param idle: Seconds without new data that end the listing, once the
+    header has been read
+    :param data: Bytes already read, ie the leftover of the previous
+    listing. They're parsed before reading more.
+    :return: Generator of records
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    parse_seconds = 0
+
+    reads = read_chunks(tn, timeout)
+    chunks = reads
+    if data:
+        chunks = itertools.chain([data], reads)
+    for chunk in chunks:
+        parse_start = time.perf_counter()
+        records = parser.feed(chunk)
+        parse_seconds += time.perf_counter() - parse_start
+        for record in records:
+            yield record
+        if parser.started or parser.done:
+            break
+    reads.close()
+
+    if parser.started and not parser.done:
+        remaining = max(deadline - time.monotonic(), 0)
+        for chunk in read_chunks(tn, remaining, idle):
+            parse_start = time.perf_counter()
+            records = parser.feed(chunk)
+            parse_seconds += time.perf_counter() - parse_start
+            for record in records:
+                yield record
+            if parser.done:
+                break
+
+    for record in parser.close():
+        yield record
+
+    # Round trip from the command to the end of its listing
+    metrics.add_time(f'command_{parser.command}', time.monotonic() - start)
+    metrics.add_time(f'parse_{parser.command}', parse_seconds)
+    metrics.count(f'{parser.command}_lines', parser.lines)
@@ -0,0 +1,118 @@
+from common import telnet_connect, node_connect
+from common.expect import IDLE_TIMEOUT, expect, read_records
+
+# Sent by the local node when a remote node disconnects us
+RETURNED = b'Returned to Node'
+
+
+class GatewaySession(object):
+    """
+    Stays logged in to the local BPQ telnet server and connects to remote
+    nodes one after another, so each crawl doesn't pay for the TCP setup
+    and user/password handshake. If the local node drops the session, the
+    next connect logs in again.
+    """
+
+    def __init__(self):
+        self.tn = None
+        self.logins = 0
+
+    def connect(self, node_name):
+        """
+        Connect to a remote node through the local node
+        :param node_name: Name of node to connect to
+        :return: Telnet object, or None if the node couldn't be reached
+        """
+        # An idle session may have been dropped by the local node, so try
+        # again once with a new login
+        for attempt in range(2):
+            logged_in = self.tn is not None
+            if not logged_in:
+                self.tn = telnet_connect()
+                self.logins += 1
+
+            try:
+                tn = node_connect(node_name, self.tn)
+            except (OSError, EOFError):
+                self.close()
+                if logged_in:
+                    continue
+                return None
+
+            if tn is None:
+                # node_connect logs out of the local node when it's stuck.
+                # A session the local node dropped quietly while idle
+                # looks the same, so try again with a new login.
+                self.close()
+                if logged_in:
+                    continue
+
+            return tn
+
+    def local_command(self, command, new_parser, timeout=30):
+        """
+        Send a command to the local node and parse its listing, until the
+        link goes quiet
+        :param command: Command bytes, ie b"mhu 1"
+        :param new_parser: Function returning a new BPQParser for the listing
+        :param timeout: Seconds to wait for the whole listing
+        :return: Tuple of (parser, list of records)
+        """
+        # An idle session may have been dropped by the local node, so try
+        # again once with a new login
+        for attempt in range(2):
+            logged_in = self.tn is not None
+            if not logged_in:
+                self.tn = telnet_connect()
+                self.logins += 1
+
+            parser = new_parser()
+            try:
+                self.tn.write(command + b"\r")
+                records = list(read_records(self.tn, parser, timeout,
+                                            idle=IDLE_TIMEOUT))
+            except (OSError, EOFError):
+                parser.started = False
+                records = []
+
+            if parser.started:
+                break
+            self.close()
+            if not logged_in:
+                break
+
+        return parser, records
+
+    def release(self, timeout=10, data=b''):
+        """
+        Wait to be returned to the local node after sending bye to a remote
+        node. If that doesn't happen, the session is dropped so the next
+        connect doesn't go out through the remote node.
+        :param timeout: Seconds to wait
+        :param data: Bytes already read after the last listing
+        :return: True if the session can be reused
+        """
+        if self.tn is None:
+            return False
+
+        index, data = expect(self.tn, [RETURNED], timeout=timeout,
+                             data=data)
+        if index == -1:
+            self.close()
+            return False
+
+        return True
+
+    def close(self):
+        """
+        Log out of the local node
+        """
+        if self.tn is None:
+            return
+
+        try:
+            self.tn.write(b"bye\r")
+        except OSError:
+            pass
+        self.tn.close()
+        self.tn = None
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import time
+
+
+class GeocodeCache(object):
+    """
+    On-disk cache of callsign lookups, shared by every script on the host.
+    Rows are keyed by (provider, callsign) and hold the (lat, lon, grid)
+    returned by get_info. Lookups that came back "not found" are stored with
+    NULL coordinates and expire after negative_ttl instead of ttl.
+    """
+
+    def __init__(self, path, ttl, negative_ttl, evict_interval=3600):
+        """
+        :param path: Path to the sqlite file
+        :param ttl: Seconds to keep a found result
+        :param negative_ttl: Seconds to keep a not found result
+        :param evict_interval: Seconds between expired row sweeps
+        """
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.evict_interval = evict_interval
+        self._lock = threading.Lock()
+        self._last_evict = 0
+
+        self._con = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("CREATE TABLE IF NOT EXISTS geocodes ("
+                          "provider TEXT NOT NULL, "
+                          "callsign TEXT NOT NULL, "
+                          "lat TEXT, "
+                          "lon TEXT, "
+                          "grid TEXT, "
+                          "found INTEGER NOT NULL, "
+                          "expires REAL NOT NULL, "
+                          "PRIMARY KEY (provider, callsign))")
+        self._con.commit()
+        self.evict()
+
+    @staticmethod
+    def normalize(callsign):
+        """
+        Normalize a callsign for use as a cache key
+        :param callsign: Callsign string
+        :return: Upper-case callsign without surrounding whitespace
+        """
+        return callsign.strip().upper()
+
+    def get(self, callsign, provider):
+        """
+        Get a cached lookup
+        :param callsign: Callsign string
+        :param provider: hamdb or qrz
+        :return: Tuple of (hit, result). Result is (lat, lon, grid) or None
+        for a cached not found.
+        """
+        key = self.normalize(callsign)
+        with self._lock:
+            row = self._con.execute(
+                "SELECT lat, lon, grid, found FROM geocodes "
+                "WHERE provider = ? AND callsign = ? AND expires > ?",
+                (provider.lower(), key, time.time())).fetchone()
+
+        if row is None:
+            return False, None
+        if not row[3]:
+            return True, None
+
+        return True, (row[0], row[1], row[2])
+
+    def put(self, callsign, provider, result):
+        """
+        Store a lookup result
+        :param callsign: Callsign string
+        :param provider: hamdb or qrz
+        :param result: (lat, lon, grid), or None if the call wasn't found
+        """
+        now = time.time()
+        key = self.normalize(callsign)
+
+        if result:
+            lat, lon, grid = result
+            found = 1
+            expires = now + self.ttl
+        else:
+            lat = lon = grid = None
+            found = 0
+            expires = now + self.negative_ttl
+
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO geocodes "
+                "(provider, callsign, lat, lon, grid, found, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (provider.lower(), key, lat, lon, grid, found, expires))
+            self._con.commit()
+
+        if now - self._last_evict > self.evict_interval:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete expired entries
+        :return: Number of rows deleted
+        """
+        now = time.time()
+        with self._lock:
+            deleted = self._con.execute(
+                "DELETE FROM geocodes WHERE expires <= ?", (now,)).rowcount
+            self._con.commit()
+            self._last_evict = now
+
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._con.close()
@@ -0,0 +1,167 @@
+import datetime
+
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+
+# Seconds a worker has to finish a claimed batch before another worker
+# can claim it
+LEASE_SECONDS = 600
+# Seconds before retrying a failed lookup, doubled on each attempt
+RETRY_SECONDS = 300
+# Lookups tried before a callsign is given up on
+MAX_ATTEMPTS = 3
+
+
+def queue_payload(**values):
+    """
+    Build the payload of a queued callsign. Datetimes are stored as ISO
+    strings so the payload can be saved as JSON.
+    :param values: Column values for the row the worker adds once the
+    callsign is geocoded
+    :return: Dict
+    """
+    return {key: value.isoformat() if isinstance(value, datetime.datetime)
+            else value for key, value in values.items()}
+
+
+def read_payload(payload):
+    """
+    Turn a stored payload back into column values
+    :param payload: Dict from queue_payload
+    :return: Dict with the ISO strings of datetime fields parsed
+    """
+    values = {}
+    for key, value in payload.items():
+        if isinstance(value, str) and key in ('lastheard', 'lastcheck'):
+            value = datetime.datetime.fromisoformat(value)
+        values[key] = value
+
+    return values
+
+
+def enqueue_statement(GeocodeQueue, queued, now):
+    """
+    Build the insert for queued callsigns. Callsigns already on the queue
+    are left alone, so a crawl never waits on a worker's claim.
+    :param GeocodeQueue: a DB Object
+    :param queued: Dict of (kind, call): payload
+    :param now: Current datetime
+    :return: Insert statement
+    """
+    rows = [{'kind': kind, 'call': call, 'payload': payload,
+             'enqueued': now, 'next_attempt': now, 'attempts': 0}
+            for (kind, call), payload in sorted(queued.items())]
+
+    return insert(GeocodeQueue).values(rows).on_conflict_do_nothing(
+        index_elements=['kind', 'call'])
+
+
+def enqueue_geocodes(session, GeocodeQueue, queued, now):
+    """
+    Add callsigns to the geocode queue in the session's transaction
+    :param session: A session object
+    :param GeocodeQueue: a DB Object
+    :param queued: Dict of (kind, call): payload
+    :param now: Current datetime
+    :return: Number of callsigns queued
+    """
+    if not queued:
+        return 0
+
+    session.execute(enqueue_statement(GeocodeQueue, queued, now))
+
+    return len(queued)
+
+
+def claim_statement(GeocodeQueue, batch_size, now):
+    """
+    Build the update that claims due callsigns. Rows locked by another
+    worker are skipped instead of waited on.
+    :param GeocodeQueue: a DB Object
+    :param batch_size: Most callsigns to claim
+    :param now: Current datetime
+    :return: Update statement returning the claimed rows
+    """
+    due = select(GeocodeQueue.id). \
+        where(GeocodeQueue.next_attempt <= now). \
+        order_by(GeocodeQueue.next_attempt). \
+        limit(batch_size). \
+        with_for_update(skip_locked=True)
+
+    return update(GeocodeQueue). \
+        where(GeocodeQueue.id.in_(due.scalar_subquery())). \
+        values(next_attempt=now + datetime.timedelta(seconds=LEASE_SECONDS),
+               attempts=GeocodeQueue.attempts + 1). \
+        returning(GeocodeQueue.id, GeocodeQueue.kind, GeocodeQueue.call,
+                  GeocodeQueue.payload, GeocodeQueue.attempts). \
+        execution_options(synchronize_session=False)
+
+
+def claim_geocodes(session, GeocodeQueue, batch_size, now):
+    """
+    Claim a batch of due callsigns and commit, so no transaction is held
+    open while they're looked up
+    :param session: A session object
+    :param GeocodeQueue: a DB Object
+    :param batch_size: Most callsigns to claim
+    :param now: Current datetime
+    :return: List of rows with id, kind, call, payload & attempts
+    """
+    claimed = session.execute(
+        claim_statement(GeocodeQueue, batch_size, now)).all()
+    session.commit()
+
+    return claimed
+
+
+def retry_delay(attempts):
+    """
+    Get the wait before the next lookup of a callsign
+    :param attempts: Lookups tried so far
+    :return: Timedelta
+    """
+    return datetime.timedelta(seconds=RETRY_SECONDS * 2 ** (attempts - 1))
+
+
+def retry_geocode(session, GeocodeQueue, queue_id, attempts, now):
+    """
+    Put a claimed callsign back on the queue for a later attempt
+    :param session: A session object
+    :param GeocodeQueue: a DB Object
+    :param queue_id: Queue row id
+    :param attempts: Lookups tried so far
+    :param now: Current datetime
+    """
+    session.execute(update(GeocodeQueue).
+                    where(GeocodeQueue.id == queue_id).
+                    values(next_attempt=now + retry_delay(attempts)).
+                    execution_options(synchronize_session=False))
+
+
+def finish_geocode(session, GeocodeQueue, queue_id):
+    """
+    Remove a handled callsign from the queue
+    :param session: A session object
+    :param GeocodeQueue: a DB Object
+    :param queue_id: Queue row id
+    """
+    session.execute(delete(GeocodeQueue).
+                    where(GeocodeQueue.id == queue_id).
+                    execution_options(synchronize_session=False))
+
+
+def release_geocodes(session, GeocodeQueue, queue_ids, now):
+    """
+    Give back claimed callsigns whose results couldn't be written. They're
+    due again after RETRY_SECONDS, and the failed claim doesn't count as an
+    attempt.
+    :param session: A session object
+    :param GeocodeQueue: a DB Object
+    :param queue_ids: Queue row ids
+    :param now: Current datetime
+    """
+    session.execute(update(GeocodeQueue).
+                    where(GeocodeQueue.id.in_(queue_ids)).
+                    values(next_attempt=now + retry_delay(1),
+                           attempts=GeocodeQueue.attempts - 1).
+                    execution_options(synchronize_session=False))
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Counters and phase timings for a run. Crawl workers and lookup threads
+    record into the same object, so updates are locked.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        :param clock: Function returning a time in seconds, for the timers
+        """
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Start a new run
+        """
+        with self._lock:
+            self.started = time.time()
+            self._start = self.clock()
+            self.counters = Counter()
+            # name: [count, total seconds, max seconds]
+            self.timings = {}
+
+    def count(self, name, value=1):
+        """
+        Add to a counter
+        :param name: Counter name
+        :param value: Amount to add
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        """
+        Record one timing of a phase
+        :param name: Phase name
+        :param seconds: Seconds the phase took
+        """
+        with self._lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time the body of a with block as a phase, even if it raises
+        :param name: Phase name
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, self.clock() - start)
+
+    def snapshot(self, run):
+        """
+        Get the run's metrics
+        :param run: Script name, ie mh_crawler
+        :return: Dict that can be dumped to JSON
+        """
+        with self._lock:
+            return {
+                'run': run,
+                'started': self.started,
+                'seconds': round(self.clock() - self._start, 6),
+                'counters': dict(self.counters),
+                'timings': {name: {'count': count,
+                                   'total': round(total, 6),
+                                   'max': round(longest, 6)}
+                            for name, (count, total, longest) in
+                            sorted(self.timings.items())}
+            }
+
+
+def prometheus_text(snapshot):
+    """
+    Format a snapshot for the node_exporter textfile collector
+    :param snapshot: Dict from Metrics.snapshot
+    :return: Text in the Prometheus exposition format
+    """
+    run = snapshot['run']
+    lines = [
+        "# HELP mh_stats_run_seconds Duration of the last run",
+        "# TYPE mh_stats_run_seconds gauge",
+        f'mh_stats_run_seconds{{run="{run}"}} {snapshot["seconds"]}',
+        "# HELP mh_stats_run_timestamp_seconds Start time of the last run",
+        "# TYPE mh_stats_run_timestamp_seconds gauge",
+        f'mh_stats_run_timestamp_seconds{{run="{run}"}} '
+        f'{snapshot["started"]:.3f}',
+        "# HELP mh_stats_run_count Counters from the last run",
+        "# TYPE mh_stats_run_count gauge"
+    ]
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f'mh_stats_run_count{{run="{run}",name="{name}"}} '
+                     f'{value}')
+
+    for metric, key, help_text in [
+            ('mh_stats_phase_seconds', 'total', "Time spent in each phase"),
+            ('mh_stats_phase_count', 'count', "Times each phase ran"),
+            ('mh_stats_phase_max_seconds', 'max', "Longest run of each phase")]:
+        lines.append(f"# HELP {metric} {help_text} in the last run")
+        lines.append(f"# TYPE {metric} gauge")
+        for phase, timing in snapshot['timings'].items():
+            lines.append(f'{metric}{{run="{run}",phase="{phase}"}} '
+                         f'{timing[key]}')
+
+    return "\n".join(lines) + "\n"
+
+
+def export(snapshot, json_file=None, prometheus_dir=None):
+    """
+    Write a snapshot as a JSON line and/or a Prometheus textfile
+    :param snapshot: Dict from Metrics.snapshot
+    :param json_file: File to append a JSON line to, or None
+    :param prometheus_dir: Textfile collector directory, or None. The file
+    is named after the run and replaced atomically, so the collector never
+    reads half a file.
+    """
+    if json_file:
+        with open(json_file, 'a') as f:
+            f.write(json.dumps(snapshot, sort_keys=True) + "\n")
+
+    if prometheus_dir:
+        path = os.path.join(prometheus_dir, f"mh_stats_{snapshot['run']}.prom")
+        with open(path + ".tmp", 'w') as f:
+            f.write(prometheus_text(snapshot))
+        os.replace(path + ".tmp", path)
+
+
+# Shared by every module in the process
+metrics = Metrics()
@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so no more than `rate` happen per second, across all
+    threads sharing the limiter
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Calls per second. 0 or less disables the limit.
+        """
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the caller may make its request
+        :return: Seconds spent waiting
+        """
+        if not self.interval:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
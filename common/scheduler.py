@@ -0,0 +1,87 @@
+import time
+import traceback
+
+
+class Job(object):
+    """
+    A function run every interval seconds
+    """
+
+    def __init__(self, name, interval, func, next_run):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = next_run
+        self.runs = 0
+        self.failures = 0
+
+
+class Scheduler(object):
+    """
+    Runs jobs one at a time, each on its own cadence. A job that fails is
+    logged and run again at its next slot. Slow jobs push back the jobs
+    behind them instead of running twice to catch up.
+    """
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param clock: Function returning the current time in seconds
+        :param sleep: Function to sleep for some seconds
+        """
+        self.clock = clock
+        self.sleep = sleep
+        self.jobs = []
+
+    def add(self, name, interval, func, delay=0):
+        """
+        Add a job
+        :param name: Name used in the log
+        :param interval: Seconds between runs. 0 or less doesn't add the job.
+        :param func: Function to run, with no arguments
+        :param delay: Seconds to wait before the first run
+        :return: Job object, or None if the job is disabled
+        """
+        if interval <= 0:
+            return None
+
+        job = Job(name, interval, func, self.clock() + delay)
+        self.jobs.append(job)
+
+        return job
+
+    def run_pending(self):
+        """
+        Run every job that is due
+        :return: Seconds until the next job is due
+        """
+        for job in sorted(self.jobs, key=lambda j: j.next_run):
+            if job.next_run > self.clock():
+                continue
+
+            self.run_job(job)
+            job.next_run = max(job.next_run + job.interval, self.clock())
+
+        return max(min(job.next_run for job in self.jobs) - self.clock(), 0)
+
+    def run_job(self, job):
+        """
+        Run a job, logging any error
+        :param job: Job object
+        """
+        job.runs += 1
+        try:
+            job.func()
+        except Exception as e:
+            job.failures += 1
+            print(f"Error running {job.name}: {e}")
+            traceback.print_exc()
+
+    def run_forever(self):
+        """
+        Run jobs until interrupted
+        """
+        if not self.jobs:
+            return
+
+        while True:
+            self.sleep(self.run_pending())
@@ -1,4 +1,69 @@
 import re
+from functools import lru_cache
+
+non_word = re.compile(r'[^\w]')
+# Base calls that get_info will look up, ie KD5LPB or 2E0ABC
+valid_call = re.compile(r'[A-Za-z0-9]*([a-zA-Z]+[0-9]+|[0-9]+[a-zA-Z]+)')
+
+# Most parsed callsigns kept by get_callsign
+CALLSIGN_CACHE_SIZE = 65536
+
+
+class Callsign(object):
+    """
+    A callsign parsed once, like 'kd5lpb-7' from an MH list or 'N0CALL-7*'
+    from a digipeater path. Use get_callsign to share parsed callsigns
+    instead of parsing the same text in every loop. Shared callsigns
+    mustn't be changed.
+    """
+    __slots__ = ('call', 'base', 'ssid', 'heard', 'valid')
+
+    def __init__(self, text):
+        """
+        :param text: Callsign string or bytes
+        """
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', errors='replace')
+
+        # Digipeaters that repeated the packet are marked with *
+        self.heard = '*' in text
+        # Call includes ssid, ie KD5LPB-7
+        self.call = text.replace('*', '').strip().upper()
+
+        base, dash, ssid = self.call.partition('-')
+        # Base is just the call, ie KD5LPB
+        self.base = non_word.sub(' ', base.strip()).strip()
+
+        self.ssid = None
+        if dash:
+            try:
+                self.ssid = int(non_word.sub(' ', ssid))
+            except ValueError:
+                pass
+
+        self.valid = valid_call.match(self.base) is not None
+
+    def __eq__(self, other):
+        return isinstance(other, Callsign) and self.call == other.call
+
+    def __hash__(self):
+        return hash(self.call)
+
+    def __str__(self):
+        return self.call
+
+    def __repr__(self):
+        return f"Callsign({self.call!r})"
+
+
+@lru_cache(maxsize=CALLSIGN_CACHE_SIZE)
+def get_callsign(text):
+    """
+    Get a parsed callsign, from the cache if the text was seen recently
+    :param text: Callsign string or bytes
+    :return: Callsign
+    """
+    return Callsign(text)
 
 
 def strip_call(node_call):
@@ -7,48 +72,37 @@ def strip_call(node_call):
     :param node_call: A node name string like kd5lpb-7
     :return: CALL-SSID, CALL, SSID
     """
+    callsign = get_callsign(node_call)
 
-    # Call includes ssid, ie KD5LPB-7
-    call = node_call.strip().upper()
-    # Op_call is just the call, ie KD5LPB
-    op_call = re.sub(r'[^\w]', ' ', call.split('-')[0].strip())
+    return callsign.call, callsign.base, callsign.ssid
 
-    # Get SSID of call if it exists
-    if '-' in call:
-        ssid = int(re.sub(r'[^\w]', ' ', call.split('-')[1]))
-    else:
-        ssid = None
 
-    return call, op_call, ssid
+def call_base(call):
+    """
+    Get the base of a node call for comparing calls
+    :param call: A call string or bytes like b'KD5LPB-7'
+    :return: Base string, ie KD5LPB
+    """
+    if isinstance(call, bytes):
+        call = call.decode('utf-8')
+
+    return non_word.sub(' ', call.split('-', 1)[0])
 
 
 def remove_dupes(call_list):
     "Returns list with one alias:call pair per node"
-    a_list = []
-    b_list = []
+    seen = set()
     res = []
 
     for element in call_list:
         if len(element) > 1:
-            a = element[0]
-            b = element[1]
-
-            if isinstance(a, bytes):
-                a_temp = a.decode('utf-8')
-                b_temp = b.decode('utf-8')
-            else:
-                a_temp = a
-                b_temp = b
-
-            # Get callsign base
-            a_base = re.sub(r'[^\w]', ' ', a_temp.split('-')[0])
-            b_base = re.sub(r'[^\w]', ' ', b_temp.split('-')[0])
-
-            if a_base not in a_list and a_base not in b_list and b_base \
-                    not in a_list and b_base not in b_list:
-                res.append([a, b])
-                a_list.append(a_base)
-                b_list.append(b_base)
+            a_base = call_base(element[0])
+            b_base = call_base(element[1])
+
+            if a_base not in seen and b_base not in seen:
+                res.append([element[0], element[1]])
+                seen.add(a_base)
+                seen.add(b_base)
         else:
             res.append(element)
 
@@ -66,18 +120,12 @@ def clean_calls(calls_to_clean):
 
     cleaned_calls = []
     for call in calls_to_clean:
-        if ':' in call:
-            call = call.split(':')
-            while (b'' in call):
-                call.remove(b'')
-            cleaned_calls.append(call)
-
-        else:
-            cleaned_calls.append([None, call])
+        if not call:
+            continue
 
-    cleaned_calls = [[string for string in sublist if string] for sublist in
-                     cleaned_calls]
-    cleaned_calls = [e for e in cleaned_calls if e != []]
-    cleaned_calls = remove_dupes(cleaned_calls)
+        separator = b':' if isinstance(call, bytes) else ':'
+        parts = [part for part in call.split(separator) if part]
+        if parts:
+            cleaned_calls.append(parts)
 
-    return cleaned_calls
+    return remove_dupes(cleaned_calls)
@@ -0,0 +1,203 @@
+#!/bin/python3
+# Look up the callsigns queued by mh_crawler.py & mh_to_pg.py with
+# --defer-geocode, and fill in their coordinates. Several workers can run at
+# once; each claims its own batch.
+
+import argparse
+import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+from common import get_conf, get_cached_info_many, get_info_many, \
+    save_metrics
+from common.geocode_queue import claim_geocodes, retry_geocode, \
+    finish_geocode, release_geocodes, read_payload, MAX_ATTEMPTS
+from common.metrics import metrics
+from models.db import get_engine, BadGeocode, Digipeater, GeocodeQueue, \
+    Operator, RemoteDigipeater, RemoteOperator, RunMetric
+
+Session = sessionmaker()
+
+# Queue kind: (table, callsign column)
+tables = {
+    'operator': (Operator, Operator.call),
+    'digipeater': (Digipeater, Digipeater.call),
+    'remote_operator': (RemoteOperator, RemoteOperator.remote_call),
+    'remote_digipeater': (RemoteDigipeater, RemoteDigipeater.call)
+}
+
+
+def apply_geocode(session, kind, call, values, info, now, verbose=False):
+    """
+    Write a lookup result. Existing rows get the new coordinates, and a row
+    is added from the queued values if there isn't one. A row a crawl adds
+    in the meantime is updated instead of breaking the unique key.
+    :param session: A session object
+    :param kind: Queue kind
+    :param call: Callsign
+    :param values: Column values from the queue payload
+    :param info: (lat, lon, grid), or None if the call couldn't be geocoded
+    :param now: Current datetime
+    :param verbose: Verbose log
+    :return: added, updated, or bad_geocode
+    """
+    table, call_column = tables[kind]
+
+    if info:
+        lat = float(info[0])
+        lon = float(info[1])
+        grid = info[2]
+        geom = f"SRID=4326;POINT({lon} {lat})"
+
+        def update_coordinates():
+            return session.query(table).filter(call_column == call).update(
+                {table.geom: geom, table.grid: grid, table.lastcheck: now},
+                synchronize_session=False)
+
+        if not update_coordinates():
+            added = session.execute(
+                insert(table).
+                values(**{call_column.key: call}, grid=grid, geom=geom,
+                       lastcheck=now, **values).
+                on_conflict_do_nothing()).rowcount
+            if added:
+                if verbose:
+                    print(f"Added {call} to {table.__tablename__}")
+                return 'added'
+            update_coordinates()
+
+        if verbose:
+            print(f"Updated coordinates for {call}")
+        return 'updated'
+
+    # Only new remote operators are tracked as bad geocodes, like the
+    # crawler does
+    if kind == 'remote_operator' and \
+            not session.query(RemoteOperator.id).filter(
+                RemoteOperator.remote_call == call).first() and \
+            not session.query(BadGeocode.id).filter(
+                BadGeocode.node_name == call).first():
+        if verbose:
+            print(f"{call} not geocoded. Adding to bad geocode table")
+        session.add(BadGeocode(last_checked=now,
+                               reason="Operator not geocoded",
+                               node_name=call,
+                               parent_node=values.get('parent_call')))
+
+    return 'bad_geocode'
+
+
+def process_batch(session, batch_size, info_method, verbose=False):
+    """
+    Claim a batch of queued callsigns, look them up and write the results.
+    Lookups that fail are retried later, up to MAX_ATTEMPTS times. Calls
+    the geocode cache already has as not found aren't looked up or retried.
+    :param session: A session object
+    :param batch_size: Most callsigns to claim
+    :param info_method: hamdb or qrz
+    :param verbose: Verbose log
+    :return: Number of callsigns claimed
+    """
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    with metrics.timer('db_claim'):
+        claimed = claim_geocodes(session, GeocodeQueue, batch_size, now)
+    if not claimed:
+        return 0
+
+    # No transaction is open while the providers are queried
+    calls = {row.call for row in claimed}
+    with metrics.timer('lookups'):
+        lookups = get_cached_info_many(calls, info_method)
+        not_found = {call for call, info in lookups.items() if info is None}
+        lookups.update(get_info_many(calls - set(lookups), info_method))
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    try:
+        write_results(session, claimed, lookups, now, verbose, not_found)
+    except SQLAlchemyError as e:
+        # Put the batch back on the queue without using up its attempts
+        print(f"Error writing geocodes: {e}")
+        session.rollback()
+        release_geocodes(session, GeocodeQueue,
+                         [row.id for row in claimed], now)
+        session.commit()
+        metrics.count('write_errors')
+
+    return len(claimed)
+
+
+def write_results(session, claimed, lookups, now, verbose=False,
+                  not_found=()):
+    """
+    Write the lookup results of a claimed batch and commit
+    :param session: A session object
+    :param claimed: Rows from claim_geocodes
+    :param lookups: Dict of call: get_info result
+    :param now: Current datetime
+    :param verbose: Verbose log
+    :param not_found: Calls known not to geocode, ie cached as not found.
+    They're finished instead of retried.
+    """
+    with metrics.timer('db_updates'):
+        for row in claimed:
+            info = lookups.get(row.call)
+            if info is None and row.call not in not_found and \
+                    row.attempts < MAX_ATTEMPTS:
+                retry_geocode(session, GeocodeQueue, row.id, row.attempts,
+                              now)
+                metrics.count('retried')
+                continue
+
+            try:
+                result = apply_geocode(session, row.kind, row.call,
+                                       read_payload(row.payload), info, now,
+                                       verbose)
+            except (TypeError, ValueError, IndexError):
+                print(f"Bad lookup result for {row.call}: {info}")
+                result = apply_geocode(session, row.kind, row.call,
+                                       read_payload(row.payload), None, now,
+                                       verbose)
+            metrics.count(result)
+            finish_geocode(session, GeocodeQueue, row.id)
+
+    with metrics.timer('db_commit'):
+        session.commit()
+
+
+def main(batch_size=50, verbose=False):
+    """
+    Work through the geocode queue until nothing is due
+    :param batch_size: Callsigns to claim at a time
+    :param verbose: Verbose log
+    """
+    metrics.clear()
+    info_method = get_conf()['info_method']
+    session = Session(bind=get_engine())
+
+    processed = 0
+    while True:
+        claimed = process_batch(session, batch_size, info_method, verbose)
+        if not claimed:
+            break
+        processed += claimed
+
+    counts = metrics.snapshot('geocode_worker')['counters']
+    print(f"{datetime.datetime.utcnow().replace(microsecond=0)} - Processed "
+          f"{processed} queued callsigns: {counts.get('added', 0)} added, "
+          f"{counts.get('updated', 0)} updated, "
+          f"{counts.get('bad_geocode', 0)} not geocoded and "
+          f"{counts.get('retried', 0)} to retry.")
+
+    save_metrics('geocode_worker', session, RunMetric)
+    session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Geocode queued callsigns")
+    parser.add_argument('-v', action='store_true', help="Verbose log")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="Callsigns to claim at a time")
+    args = parser.parse_args()
+    main(args.batch_size, args.v)
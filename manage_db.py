@@ -0,0 +1,210 @@
+#!/bin/python3
+# Database maintenance commands
+
+import argparse
+import re
+
+from sqlalchemy import func, inspect, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex
+
+from common.bands import classify_band
+from common.dedupe import duplicates_statement, \
+    delete_duplicates_statement, backfill_heard_bucket_statement
+from models.db import get_engine, init_db, Base, RemotelyHeardStation
+
+
+def upgrade(engine):
+    """
+    Create any columns and indexes declared on the models that are missing
+    from the database. New columns must be nullable without a default, so
+    adding them doesn't rewrite the table. Indexes are built with CREATE
+    INDEX CONCURRENTLY, so the tables stay writable while the crawlers run.
+    :param engine: An engine object
+    :return: Number of columns and indexes created
+    """
+    created = 0
+    inspector = inspect(engine)
+
+    # CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as con:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                print(f"Creating table {table.name}")
+                table.create(con)
+                created += len(table.indexes)
+                continue
+
+            existing_columns = {column['name'] for column in
+                                inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                print(f"Adding column {column.name} to {table.name}")
+                con.execute(f"ALTER TABLE {table.name} ADD COLUMN IF NOT "
+                            f"EXISTS {column.name} {column_type}")
+                created += 1
+
+            # The inspector leaves out expression indexes, so they'd be
+            # created again on every run
+            existing = {row[0] for row in con.execute(
+                text("SELECT indexname FROM pg_indexes "
+                     "WHERE schemaname = current_schema() "
+                     "AND tablename = :table"), {'table': table.name})}
+
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name in existing:
+                    continue
+
+                if index.unique and con.execute(
+                        duplicates_statement(table)).first() is not None:
+                    print(f"Not creating {index.name}: {table.name} has "
+                          f"duplicate rows. Run manage_db.py dedupe first.")
+                    continue
+
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                ddl = re.sub(r'^CREATE (UNIQUE )?INDEX',
+                             r'CREATE \1INDEX CONCURRENTLY IF NOT EXISTS', ddl)
+
+                print(f"Creating index {index.name} on {table.name}")
+                con.execute(ddl)
+                created += 1
+
+    return created
+
+
+def backfill_bands(engine, batch_size):
+    """
+    Set the band of remote MH rows that don't have one, from their port
+    name. Rows are updated and committed in batches to keep transactions
+    short.
+    :param engine: An engine object
+    :param batch_size: Rows to update per transaction
+    :return: Number of rows updated
+    """
+    session = sessionmaker(bind=engine)()
+    updated = 0
+
+    ports = session.query(RemotelyHeardStation.port).\
+        filter(RemotelyHeardStation.band.is_(None)).distinct().all()
+
+    for port in ports:
+        port = port[0]
+        band = classify_band(port)
+        if band is None:
+            print(f"Couldn't get band for port {port}")
+            continue
+
+        while True:
+            batch = session.query(RemotelyHeardStation.id).\
+                filter(RemotelyHeardStation.port == port,
+                       RemotelyHeardStation.band.is_(None)).\
+                limit(batch_size)
+
+            rows = session.query(RemotelyHeardStation).\
+                filter(RemotelyHeardStation.id.in_(batch)).\
+                update({RemotelyHeardStation.band: band},
+                       synchronize_session=False)
+            session.commit()
+            updated += rows
+
+            if rows < batch_size:
+                break
+
+        print(f"Set band {band} for port {port}")
+
+    session.close()
+
+    return updated
+
+
+def dedupe(engine, batch_size):
+    """
+    Delete rows that break the unique keys, keeping the first row written,
+    then set the heard_bucket of remote MH rows that don't have one.
+    Both are done in batches of ids to keep transactions short.
+    :param engine: An engine object
+    :param batch_size: Ids to delete from or rows to update per transaction
+    :return: Tuple of (rows deleted, rows updated)
+    """
+    session = sessionmaker(bind=engine)()
+    deleted = 0
+
+    for table in Base.metadata.sorted_tables:
+        if not any(index.unique for index in table.indexes):
+            continue
+
+        first_id, last_id = session.query(func.min(table.c.id),
+                                          func.max(table.c.id)).one()
+        if first_id is None:
+            continue
+
+        rows = 0
+        for start in range(first_id, last_id + 1, batch_size):
+            rows += session.execute(delete_duplicates_statement(
+                table, start, start + batch_size)).rowcount
+            session.commit()
+        if rows:
+            print(f"Deleted {rows} duplicate rows from {table.name}")
+        deleted += rows
+
+    table = RemotelyHeardStation.__table__
+    updated = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in session.query(RemotelyHeardStation.id).
+               filter(RemotelyHeardStation.id > last_id,
+                      RemotelyHeardStation.heard_bucket.is_(None)).
+               order_by(RemotelyHeardStation.id).
+               limit(batch_size)]
+        if not ids:
+            break
+
+        updated += session.execute(
+            backfill_heard_bucket_statement(table, ids)).rowcount
+        session.commit()
+        last_id = ids[-1]
+
+    session.close()
+
+    return deleted, updated
+
+
+parser = argparse.ArgumentParser(description="Manage the mh-stats database")
+subparsers = parser.add_subparsers(dest='command', required=True)
+subparsers.add_parser('init', help="Create any tables that don't exist")
+subparsers.add_parser('upgrade',
+                      help="Create missing tables, columns and indexes "
+                           "without locking existing tables")
+backfill_parser = subparsers.add_parser(
+    'backfill-bands', help="Set the band of remote MH rows that have none")
+backfill_parser.add_argument('--batch-size', type=int, default=5000,
+                             help="Rows to update per transaction")
+dedupe_parser = subparsers.add_parser(
+    'dedupe', help="Delete duplicate rows so the unique indexes can be "
+                   "built")
+dedupe_parser.add_argument('--batch-size', type=int, default=5000,
+                           help="Ids to delete from or rows to update per "
+                                "transaction")
+args = parser.parse_args()
+
+if args.command == 'init':
+    init_db()
+    print("Created missing tables")
+
+elif args.command == 'upgrade':
+    upgraded = upgrade(get_engine())
+    print(f"Created {upgraded} columns and indexes")
+
+elif args.command == 'backfill-bands':
+    backfilled = backfill_bands(get_engine(), args.batch_size)
+    print(f"Updated {backfilled} MH rows")
+
+elif args.command == 'dedupe':
+    removed, bucketed = dedupe(get_engine(), args.batch_size)
+    print(f"Deleted {removed} duplicate rows and set the heard bucket of "
+          f"{bucketed} MH rows")
@@ -2,191 +2,281 @@
 
 import argparse
 import datetime
-import re
-from string import digits
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from geoalchemy2.shape import to_shape
 from sqlalchemy import or_
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import true
 
-from common import get_info, get_conf, telnet_connect, node_connect, \
-    auto_node_selector
-from common.string_cleaner import strip_call
-from models.db import local_engine, CrawledNode, RemoteOperator, \
+from common import get_info_many, get_conf, get_last_seen, telnet_connect, \
+    node_connect, auto_node_selector, active_node_ports, save_metrics, \
+    get_cached_info_many
+from common.bad_geocodes import BadGeocodeIndex, load_bad_geocodes
+from common.bands import classify_band, update_operator_bands
+from common.bpq_parser import BPQParser, port_header
+from common.bulk import BulkWriter
+from common.crawl_priority import update_crawl_stats
+from common.dedupe import load_heard_index, heard_bucket
+from common.expect import read_records, IDLE_TIMEOUT, PROMPT
+from common.gateway import GatewaySession
+from common.geocode_queue import enqueue_geocodes, queue_payload
+from common.metrics import metrics
+from common.string_cleaner import strip_call, get_callsign
+from models.db import get_engine, CrawledNode, RemoteOperator, \
     RemoteDigipeater, \
-    RemotelyHeardStation, BadGeocode
+    RemotelyHeardStation, BadGeocode, RunMetric, GeocodeQueue
 
 refresh_days = 1
 debug = False
 
-print(f"\n==============================================\n"
-      f"Run at {datetime.datetime.utcnow().replace(microsecond=0)}")
-
-port_name = None
-
-parser = argparse.ArgumentParser(description="Crawl BPQ nodes")
-parser.add_argument('--node', metavar='N', type=str, help="Node name to crawl")
-parser.add_argument('-auto', action='store_true',
-                    help="Pick a node to crawl automatically")
-parser.add_argument('-v', action='store_true', help='Verbose log')
-args = parser.parse_args()
-node_to_crawl = args.node
-auto = args.auto
-verbose = args.v
-conf = get_conf()
-info_method = conf['info_method']
-
-if node_to_crawl:
-    node_to_crawl = node_to_crawl.strip().upper()
-
-year = datetime.date.today().year
-
-# Connect to PG
-Session = sessionmaker(bind=local_engine)
-
-last_crawled_port_name = None
-node_to_crawl_info = {}
-read_crawled_nodes = Session()
-session = Session()
-
-if auto and node_to_crawl:
-    print("You can't enter node to crawl & auto mode")
-    exit()
-
-elif auto and not debug:
-    node_to_crawl_info = auto_node_selector(CrawledNode, session, refresh_days)
-elif not node_to_crawl and not debug:
-    print("You must enter a node to crawl.")
-    exit()
-elif not node_to_crawl and not auto:
-    node_to_crawl = "KD5LPB"
-
-# Get bad geocode node names
-existing_bad_geocodes = session.query(BadGeocode.node_name).all()
-bad_geocodes = []
-for geocode in existing_bad_geocodes:
-    geocode = geocode[0]
-
-    """
-    Split node name into two parts and put into list. This is for checking if
-    a bad geocode has already been added to the bad geocode table later in the
-    script.
-    """
-    if ':' in geocode:
-        node_part_one = geocode.split(':')[0].split('-')[0]
-        node_part_two = geocode.split(':')[1].split('-')[0]
-        bad_geocodes.append(node_part_one)
-        bad_geocodes.append(node_part_two)
-    else:
-        bad_geocodes.append(geocode)
-
-# Get all remote operators
-existing_ops = session.query(RemoteOperator.remote_call,
-                             RemoteOperator.geom).all()
-
-existing_ops_data = {}
-for op in existing_ops:
-    remote_call = op[0]
-    point = to_shape(op[1])
-    lon = point.x
-    lat = point.y
-
-    existing_ops_data[remote_call] = (lat, lon)
-
-# Get all remote digipeaters
-existing_digipeaters = session.query(RemoteDigipeater.call,
-                                     RemoteDigipeater.geom,
-                                     RemoteDigipeater.heard,
-                                     RemoteDigipeater.ports).all()
-
-existing_digipeaters_data = {}
-for digipeater in existing_digipeaters:
-    digipeater_call = digipeater[0]
-    point = to_shape(digipeater[1])
-    lon = point.x
-    lat = point.y
-    heard = digipeater[2]
-    ports = digipeater[3]
-    existing_digipeaters_data[digipeater_call] = (lat, lon, heard, ports)
-
-# Get all remote MHeard list
-existing_remote_mh_results = session.query(RemotelyHeardStation.remote_call,
-                                           RemotelyHeardStation.heard_time).all()
-
-existing_mh_data = []
-for row in existing_remote_mh_results:
-    call = row[0]
-    timestamp = row[1]
-    hour_minute = timestamp.strftime("%H:%M:%S")
-    existing_mh_data.append(f"{call} {hour_minute}")
-
-# Connect to local telnet server
-tn = telnet_connect()
-
-if auto and not debug:
-    # Get node to crawl from dict
-    node_to_crawl = list(node_to_crawl_info.keys())[0]
-    print(f"Auto crawling node {node_to_crawl}")
-
-if not debug:  # Stay local if debugging
-    try:
-        tn = node_connect(node_to_crawl, tn)
-    except KeyboardInterrupt:
-        print("Closing connection")
-        tn.write(b'bye\r')
-        exit()
+Session = sessionmaker()
 
-# Get available ports
-available_ports = None
-tn.write("p".encode('ascii') + b'\r')  # Get available ports
-tn.write(b'\n\n\n')
-
-# Print available ports to screen
-available_ports_raw = tn.read_until(b'\n\n\n',
-                                    timeout=20)
-
-try:
-    available_ports_raw = available_ports_raw.split(b"Ports")[1].strip()
-    available_ports_raw = available_ports_raw.split(b'***')[0]
-    available_ports_raw = re.sub(b' +', b' ', available_ports_raw)
-    available_ports = available_ports_raw.split(b'\r\n')
-except IndexError:
-    # Corrupt data
-    print(f"Possible corrupt data received: {available_ports_raw}")
-    exit()
-
-
-node_name_map = {}
-for port in available_ports:
-    menu_item = int(re.search(r'\d+', port.decode('utf-8')).group())
-    port_name = port.decode('utf-8').strip().lstrip(digits).strip()
-    node_name_map[menu_item] = port_name
-
-if not auto:
-    # Give menu options on screen
-    selected_port = None
-    menu_item = 1
-    print("Select VHF/UHF port to scan MHeard on")
-    for menu_item, port_name in node_name_map.items():
-        print(f"{menu_item}: {port_name}")
+# Set by start_run
+session = None
+writer = None
+verbose = False
+bulk = False
+defer_geocode = False
+info_method = None
+
+# Bad geocodes already in the DB, kept up to date as rows are added during
+# a run. It's reloaded at the start of each run, since the other crawlers
+# add rows too. Operators & digipeaters are looked up per MH list instead.
+bad_geocodes = BadGeocodeIndex()
+
+counters = Counter()
+
+# Gateway sessions stay logged in to the local node between crawls
+gateway_lock = threading.Lock()
+gateway_sessions = []
+idle_gateways = []
+
+
+def start_run(verbose_log=False, bulk_load=False, defer=False):
+    """
+    Open a session for a crawl run, and load the bad geocode cache
+    :param verbose_log: Verbose log
+    :param bulk_load: Write new rows with COPY instead of one at a time
+    :param defer: Queue callsigns that aren't in the geocode cache for
+    geocode_worker.py instead of looking them up during the crawl
+    """
+    global session, writer, verbose, bulk, defer_geocode, info_method
+
+    verbose = verbose_log
+    bulk = bulk_load
+    defer_geocode = defer
+    info_method = get_conf()['info_method']
+    session = Session(bind=get_engine())
+
+    # New MH, operator, digipeater & bad geocode rows go through the writer.
+    # Rows another run already wrote are skipped by the unique keys.
+    writer = BulkWriter(session, method="copy" if bulk else "insert",
+                        ignore_conflicts=True)
+
+    counters.clear()
+    metrics.clear()
+    with metrics.timer('db_load_caches'):
+        load_caches()
+
+
+def load_caches():
+    """
+    Load bad geocodes from the DB
+    """
+    global bad_geocodes
+
+    bad_geocodes = load_bad_geocodes(session, BadGeocode)
+
+
+class CrawlError(Exception):
+    pass
+
+
+def get_ports(tn):
+    """
+    Get the ports of the connected node, for the port menu. The next
+    command depends on the answer, so nothing follows the listing and it
+    ends when the link goes quiet for a while. Crawls that know their
+    ports send the mh commands with the ports command instead; see
+    fetch_node.
+    :param tn: A Telnet connection object
+    :return: Dict of port number: port name
+    """
+    tn.write(b"p\r")  # Get available ports
+
+    # Wait well past a short pause on a slow link before deciding the
+    # listing is done
+    return read_ports(tn, idle=IDLE_TIMEOUT * 5)[0]
+
+
+def read_ports(tn, end=None, idle=None):
+    """
+    Read the listing of a ports command that's already been sent
+    :param tn: A Telnet connection object
+    :param end: Bytes or compiled regex that ends the listing, ie the
+    prompt of the next command's answer
+    :param idle: Seconds without new data that end the listing
+    :return: Tuple of (dict of port number: port name, bytes read after
+    the listing)
+    """
+    parser = BPQParser('ports', b"Ports", end=end)
+    ports = list(read_records(tn, parser, timeout=20, idle=idle))
+    if not parser.started:
+        raise CrawlError("No response to ports command")
+
+    for error in parser.errors:
+        print(f"Couldn't parse port {error.line}: {error.reason}")
+
+    return {port.number: port.name for port in ports}, parser.leftover
+
+
+def get_mh_list(tn, selected_port, now):
+    """
+    Get the MH list of a port, then disconnect
+    :param tn: A Telnet connection object
+    :param selected_port: Port number
+    :param now: Time the MH command was sent
+    :return: List of MHRecords sorted by heard time
+    """
+    return get_mh_lists(tn, [selected_port], now)[selected_port]
+
+
+def get_mh_lists(tn, selected_ports, now):
+    """
+    Get the MH lists of several ports, then disconnect. All the mh commands
+    are sent at once, so the node answers them back to back.
+    :param tn: A Telnet connection object
+    :param selected_ports: List of port numbers
+    :param now: Time the MH commands were sent
+    :return: Dict of port number: list of MHRecords sorted by heard time
+    """
+    send_mh_commands(tn, selected_ports)
+
+    return read_mh_lists(tn, selected_ports, now)[0]
+
+
+def send_mh_commands(tn, selected_ports):
+    """
+    Send the mh command of each port, then disconnect
+    :param tn: A Telnet connection object
+    :param selected_ports: List of port numbers
+    """
+    print(f"Getting MH list for port "
+          f"{', '.join(str(port) for port in selected_ports)}.")
+    for selected_port in selected_ports:
+        mh_command = f"mh {selected_port}".encode('ascii')
+        tn.write(mh_command + b"\r")
+    tn.write(b"\r")
+    tn.write(b"bye\r")
+
+
+def read_mh_lists(tn, selected_ports, now, data=b''):
+    """
+    Read the MH lists of ports whose mh commands have been sent. Answers to
+    commands for other ports are skipped.
+    :param tn: A Telnet connection object
+    :param selected_ports: Port numbers to read, in the order they were sent
+    :param now: Time the MH commands were sent
+    :param data: Bytes already read after the previous listing
+    :return: Tuple of (dict of port number: list of MHRecords sorted by
+    heard time, bytes read after the last list)
+    """
+    mh_lists = {}
+    for selected_port in selected_ports:
+        # Each list ends at the prompt of the next answer, or the last one
+        # at the disconnect. Records are parsed as the list is read.
+        parser = BPQParser('mh', port_header(selected_port), now, PROMPT)
+        mh_list = list(read_records(tn, parser, timeout=20, data=data))
+        data = parser.leftover
+        if not parser.started:
+            raise CrawlError(f"No MH list received for port {selected_port}")
+
+        for error in parser.errors:
+            print(f"Couldn't parse MH line {error.line}: {error.reason}")
+
+        mh_lists[selected_port] = sorted(mh_list, key=lambda x: x.heard_time)
+    print("Got MH list")
+
+    return mh_lists, data
+
+
+def fetch_node(node_to_crawl, selected_ports):
+    """
+    Connect to a node through an idle gateway session and get the MH lists
+    of some of its ports. Only talks to the network, so it can run in a
+    worker thread.
+    :param node_to_crawl: Node name
+    :param selected_ports: Dict of port number: port name from the crawled
+    nodes table. MH lists aren't fetched for ports whose name has changed.
+    :return: Tuple of (node_name_map, mh_lists, now, seconds). mh_lists is
+    a dict of port number: list of MHRecords, without the ports whose name
+    has changed. seconds is the time taken to connect and fetch the MH
+    lists.
+    """
+    start = time.monotonic()
+    with gateway_lock:
+        if idle_gateways:
+            gateway = idle_gateways.pop()
+        else:
+            gateway = GatewaySession()
+            gateway_sessions.append(gateway)
 
     try:
-        selected_port = int(input().strip())
-    except ValueError:
-        print("You didn't enter a valid selection. Closing")
-        tn.write(b'bye\r')
-        exit()
+        tn = gateway.connect(node_to_crawl)
+        if tn is None:
+            raise CrawlError(f"Couldn't connect to {node_to_crawl}")
+
+        mh_lists = {}
+        try:
+            # Send the mh commands with the ports command, so the ports
+            # listing ends at the prompt of the first MH list instead of
+            # after the link goes quiet
+            now = datetime.datetime.utcnow().replace(microsecond=0)
+            tn.write(b"p\r")
+            send_mh_commands(tn, list(selected_ports))
+            node_name_map, data = read_ports(tn, end=PROMPT)
+
+            # Lists of ports that are gone or whose name has changed are
+            # skipped
+            ports = []
+            for selected_port, expected_port_name in selected_ports.items():
+                port_name = node_name_map.get(selected_port)
+                if port_name is not None and (not expected_port_name or
+                                              port_name.strip() ==
+                                              expected_port_name.strip()):
+                    ports.append(selected_port)
+
+            if ports:
+                mh_lists, data = read_mh_lists(tn, ports, now, data)
+            else:
+                now = None
+            seconds = time.monotonic() - start
+        except Exception:
+            gateway.close()
+            raise
 
-else:
-    # crawled_node[1]: (crawled_node[0], crawled_node[2], crawled_node[3])
-    selected_port = node_to_crawl_info.get(node_to_crawl)[1]
+        # Back on the local node, ready for the next crawl
+        gateway.release(data=data)
+    finally:
+        with gateway_lock:
+            idle_gateways.append(gateway)
 
-if selected_port:
+    return node_name_map, mh_lists, now, seconds
 
-    port_name = node_name_map.get(selected_port).strip()
 
+def check_crawled_port(node_to_crawl, selected_port, port_name):
+    """
+    Add the UID of a crawled port if it doesn't exist, and flag the port
+    for checking if its name has changed since it was last crawled
+    :param node_to_crawl: Node name
+    :param selected_port: Port number
+    :param port_name: Current port name
+    :return: Tuple of (port_ok, last_crawled_port_name)
+    """
     try:
         last_crawled_port_name = session.query(CrawledNode.port_name).filter(
             CrawledNode.port == selected_port,
@@ -194,10 +284,10 @@ if selected_port:
             CrawledNode.active_port == true()
         ).one_or_none()
     except MultipleResultsFound:
-        print(f"Multiple results for node ID {node_to_crawl}, "
-              f"port: {selected_port} in crawled_nodes table. Check for dupes, "
-              f"and set one of them to inactive, if necessary.")
-        exit()
+        raise CrawlError(f"Multiple results for node ID {node_to_crawl}, "
+                         f"port: {selected_port} in crawled_nodes table. Check "
+                         f"for dupes, and set one of them to inactive, if "
+                         f"necessary.")
 
     if last_crawled_port_name:
         last_crawled_port_name = last_crawled_port_name[0]
@@ -212,7 +302,7 @@ if selected_port:
         update({CrawledNode.uid: crawled_node_uid},
                synchronize_session="fetch")
 
-    # Update needs_check flag and exit if port has changed
+    # Update needs_check flag if port has changed
     if last_crawled_port_name and port_name.strip() != last_crawled_port_name.strip():
         print(f"Port has changed for {node_to_crawl}. "
               f"Was {last_crawled_port_name}, is now {port_name}")
@@ -221,569 +311,796 @@ if selected_port:
                                           CrawledNode.port == selected_port). \
             update({CrawledNode.needs_check: True},
                    synchronize_session='fetch')
-        session.commit()
-        session.close()
-        tn.write(b"bye\r")
-        exit()
-
-    # Send the MH command
-    print(f"Getting MH list for port {selected_port}.")
-    mh_command = f"mh {selected_port}".encode('ascii')
-    now = datetime.datetime.utcnow().replace(microsecond=0)
-    tn.write(mh_command + b"\r")
-    tn.write(b"\r")
-    tn.write(b"bye\r")
-else:
-    print("No port selected")
-    exit()
-
-mh_output = None
-try:
-    # Read and parse output from telnet
-    mh_output = tn.read_until(b'***', timeout=20)
-    port_string = f"Port {selected_port}".encode('ascii')
-    mh_output = mh_output.split(port_string)[1].strip()
-    mh_output = mh_output.split(b'***')[0]
-    mh_output = re.sub(b' +', b' ', mh_output)
-    mh_output = mh_output.split(b'\r\n')
-    print("Got MH list")
-except IndexError:
-    print(f"Might have gotten bad results. The MH output was {mh_output}")
-    print("Try again")
-    exit()
-
-# Make list of lists for each entry
-index = 0
-for item in mh_output:
-    mh_output[index] = item.strip().split(b' ')
-    index += 1
-
-# Clean up list
-for index, item in enumerate(mh_output):
-    if b'via' in item:
-        item.remove(b'via')
-
-    if len(item) == 1:
-        del mh_output[index]
-
-# Convert time to datetime, and get digipeater list
-mh_list = []
-for item in mh_output:
-    if len(item) > 1:
-        res = []
-        call = item[0].decode('utf-8').strip()
-        res.append(call)
-        time_passed = item[1].decode('utf-8')
-
-        try:
-            days_passed = int(time_passed.split(':')[0])
-            hours_passed = int(time_passed.split(':')[1])
-            minutes_passed = int(time_passed.split(':')[2])
-            seconds_passed = int(time_passed.split(':')[3])
-        except ValueError or IndexError as v:
-            print(f"Error trying to parse time: {v}")
-            exit()
+        return False, last_crawled_port_name
 
-        try:
-            ymd = now - datetime.timedelta(days=days_passed,
-                                           hours=hours_passed,
-                                           minutes=minutes_passed,
-                                           seconds=seconds_passed)
-            res.append(ymd)
-        except Exception as e:
-            # Got bad time format
-            print(f"Error parsing time passed: {time_passed}. Error: {e}")
-            exit()
-        try:
-            digipeaters = item[2].decode('utf-8').split(',')
-            res.append(digipeaters)
-        except IndexError:
-            res.append(None)
+    return True, last_crawled_port_name
 
-        mh_list.append(res)
 
-mh_list = sorted(mh_list, key=lambda x: x[1], reverse=False)
-
-# Update the nodes crawled table
-node_info = node_to_crawl_info.get(node_to_crawl)
-
-if auto and not debug:
-    # Update timestamp of crawled node
-    # crawled_node[1]: (crawled_node[0], crawled_node[2], crawled_node[3])
-
-    if verbose:
-        print("Updating crawled node timestamp")
-    nodes_to_crawl_id = node_info[0]
-    port = node_info[1]
-    timestamp = node_info[2]
-
-    session.query(CrawledNode).filter(
-        CrawledNode.id == nodes_to_crawl_id).update(
-        {CrawledNode.last_crawled: now}, synchronize_session="fetch")
-
-    session.query(CrawledNode).filter(CrawledNode.id == nodes_to_crawl_id,
-                                      CrawledNode.needs_check.is_(None)). \
-        update({CrawledNode.needs_check: False}, synchronize_session="fetch")
-
-    if not last_crawled_port_name:  # Update port name if doesn't exist
-        session.query(CrawledNode).filter(
-            CrawledNode.id == nodes_to_crawl_id).update(
-            {CrawledNode.port_name: port_name}, synchronize_session="fetch")
-
-elif not auto:  # Write new node
-    # Get port crawled by node name, port number and port name
-    crawled_nodes = session.query(CrawledNode).filter(
-        CrawledNode.node_id == node_to_crawl,
-        CrawledNode.port == selected_port,
-        CrawledNode.port_name == port_name).one_or_none()
+def update_crawled_node(node_to_crawl, node_info, selected_port, port_name,
+                        last_crawled_port_name, now):
+    """
+    Update the nodes crawled table
+    :param node_to_crawl: Node name
+    :param node_info: (id, port, last_crawled, port_name) from
+    auto_node_selector, or None for a manual crawl
+    :param selected_port: Port number
+    :param port_name: Current port name
+    :param last_crawled_port_name: Port name in the crawled nodes table
+    :param now: Time of the crawl
+    """
+    if node_info and not debug:
+        # Update timestamp of crawled node
+        # crawled_node[1]: (crawled_node[0], crawled_node[2], crawled_node[3])
 
-    if crawled_nodes:
-        nodes_to_crawl_id = crawled_nodes.id
+        if verbose:
+            print("Updating crawled node timestamp")
+        nodes_to_crawl_id = node_info[0]
 
         session.query(CrawledNode).filter(
             CrawledNode.id == nodes_to_crawl_id).update(
             {CrawledNode.last_crawled: now}, synchronize_session="fetch")
 
-        # Populate needs check field if null
         session.query(CrawledNode).filter(CrawledNode.id == nodes_to_crawl_id,
                                           CrawledNode.needs_check.is_(None)). \
-            update({CrawledNode.needs_check: False,
-                    CrawledNode.active_port: True},
+            update({CrawledNode.needs_check: False},
                    synchronize_session="fetch")
 
-        # Update the port name if it's empty
-        if selected_port and node_to_crawl and selected_port and \
-                last_crawled_port_name is None:
-            if verbose:
-                print(f"Adding port name {port_name} to existing row")
+        if not last_crawled_port_name:  # Update port name if doesn't exist
             session.query(CrawledNode).filter(
                 CrawledNode.id == nodes_to_crawl_id).update(
-                {CrawledNode.port_name: port_name,
-                 CrawledNode.last_crawled: now}, synchronize_session="fetch")
-
-        """
-        If no results from query above, that means this is either a new node, 
-        new port, or that the port name has changed. In this case, we write a 
-        new row to the table with the new port information.
-        """
-    elif not crawled_nodes and selected_port and node_to_crawl:
-        if verbose:
-            print(f"Adding {node_to_crawl} to crawled nodes table")
-        new_crawled_node = CrawledNode(
-            node_id=node_to_crawl,
-            port=selected_port,
-            last_crawled=now,
-            port_name=port_name,
-            needs_check=False,
-            uid=f"{node_to_crawl}-{port_name}",
-            active_port=True
-        )
-        session.add(new_crawled_node)
-
-    else:
-        print(f"Something bad happened. Crawled node results: {crawled_nodes}")
+                {CrawledNode.port_name: port_name}, synchronize_session="fetch")
 
-# Do the MH List Processing
-digipeater_list = {}
-current_op_list = []
-mh_counter = 0
-new_ops_counter = 0
-bad_geocodes_counter = 0
-updated_ops_counter = 0
+    elif not node_info:  # Write new node
+        # Get port crawled by node name, port number and port name
+        crawled_nodes = session.query(CrawledNode).filter(
+            CrawledNode.node_id == node_to_crawl,
+            CrawledNode.port == selected_port,
+            CrawledNode.port_name == port_name).one_or_none()
 
-for item in mh_list:
-    time_diff = None
-    info = None
+        if crawled_nodes:
+            nodes_to_crawl_id = crawled_nodes.id
 
-    call, op_call, ssid = strip_call(item[0])
+            session.query(CrawledNode).filter(
+                CrawledNode.id == nodes_to_crawl_id).update(
+                {CrawledNode.last_crawled: now}, synchronize_session="fetch")
 
-    timestamp = item[1]
+            # Populate needs check field if null
+            session.query(CrawledNode).filter(
+                CrawledNode.id == nodes_to_crawl_id,
+                CrawledNode.needs_check.is_(None)). \
+                update({CrawledNode.needs_check: False,
+                        CrawledNode.active_port: True},
+                       synchronize_session="fetch")
+
+            # Update the port name if it's empty
+            if selected_port and node_to_crawl and selected_port and \
+                    last_crawled_port_name is None:
+                if verbose:
+                    print(f"Adding port name {port_name} to existing row")
+                session.query(CrawledNode).filter(
+                    CrawledNode.id == nodes_to_crawl_id).update(
+                    {CrawledNode.port_name: port_name,
+                     CrawledNode.last_crawled: now},
+                    synchronize_session="fetch")
+
+            """
+            If no results from query above, that means this is either a new 
+            node, new port, or that the port name has changed. In this case, 
+            we write a new row to the table with the new port information.
+            """
+        elif not crawled_nodes and selected_port and node_to_crawl:
+            if verbose:
+                print(f"Adding {node_to_crawl} to crawled nodes table")
+            new_crawled_node = CrawledNode(
+                node_id=node_to_crawl,
+                port=selected_port,
+                last_crawled=now,
+                port_name=port_name,
+                needs_check=False,
+                uid=f"{node_to_crawl}-{port_name}",
+                active_port=True
+            )
+            session.add(new_crawled_node)
 
-    # Get last time station was heard
-    try:
-        last_heard = session.query(RemoteOperator.lastheard). \
-            distinct(RemoteOperator.remote_call, RemoteOperator.lastheard). \
-            filter(RemoteOperator.remote_call == f'{op_call}'). \
-            order_by(RemoteOperator.lastheard.desc()).first()
+        else:
+            print(f"Something bad happened. Crawled node results: "
+                  f"{crawled_nodes}")
 
-        last_check = session.query(RemoteOperator.lastcheck).\
-            distinct(RemoteOperator.remote_call, RemoteOperator.lastcheck).\
-            filter(RemoteOperator.remote_call == f'{op_call}').\
-            order_by(RemoteOperator.lastcheck.desc()).first()
 
-        if last_heard:
-            last_heard = last_heard[0]
+def store_mh_list(node_to_crawl, port_name, mh_list, now):
+    """
+    Write the MH list of a crawled port, and add or update its operators
+    and digipeaters
+    :param node_to_crawl: Node name
+    :param port_name: Port name
+    :param mh_list: List of [call, heard time, digipeaters]
+    :param now: Time of the crawl
+    :return: Number of MH rows added
+    """
+    band = classify_band(port_name)
+    added = 0
 
-        if last_check is not None:
-            last_check = last_check[0]
+    # Collect operators & digipeaters and their last heard/check times, so
+    # every callsign that needs a lookup can be resolved in one batch
+    digipeater_list = {}
+    op_calls = {}
+    for item in mh_list:
+        call, op_call, ssid = strip_call(item[0])
+        op_calls.setdefault(op_call, call.split('-')[0])
 
-            if last_check is not None:
-                time_diff = (now - last_check)
-            else:
-                time_diff = None
+        try:
+            for digipeater in item[2]:
+                digipeater_list[digipeater.strip()] = item[1]
+        except TypeError:
+            pass
+
+    digipeater_calls = {get_callsign(digipeater_call).base
+                        for digipeater_call in digipeater_list}
+
+    phase_start = time.perf_counter()
+    last_seen_ops = get_last_seen(session, RemoteOperator.remote_call,
+                                  RemoteOperator.lastheard,
+                                  RemoteOperator.lastcheck, op_calls)
+    last_seen_digipeaters = get_last_seen(session, RemoteDigipeater.call,
+                                          RemoteDigipeater.lastheard,
+                                          RemoteDigipeater.lastcheck,
+                                          digipeater_calls)
+
+    # Operators & digipeaters in this list that are already in the DB, and
+    # the ports each digipeater has been heard on
+    existing_ops = set(last_seen_ops)
+    digipeater_ports = {}
+    if digipeater_calls:
+        digipeater_ports = dict(session.query(
+            RemoteDigipeater.call, RemoteDigipeater.ports).filter(
+            RemoteDigipeater.call.in_(digipeater_calls)).all())
+    metrics.add_time('db_prefetch', time.perf_counter() - phase_start)
+
+    lookup_calls = set()
+    op_last_seen = {}
+    for op_call, lookup_call in op_calls.items():
+        last_heard, last_check = last_seen_ops.get(op_call, (None, None))
+        time_diff = (now - last_check) if last_check is not None else None
+        op_last_seen[op_call] = (last_heard, time_diff)
+
+        if op_call not in existing_ops or time_diff is None or \
+                time_diff.days >= refresh_days:
+            lookup_calls.add(lookup_call)
+
+    digipeater_last_seen = {}
+    for digipeater_call in digipeater_calls:
+        last_seen, last_check = last_seen_digipeaters.get(digipeater_call,
+                                                          (None, None))
+        time_diff = (now - last_check) if last_check is not None else None
+        digipeater_last_seen[digipeater_call] = (last_seen, time_diff)
+
+        if digipeater_call not in digipeater_ports or \
+                time_diff is None or time_diff.days >= refresh_days:
+            lookup_calls.add(digipeater_call)
 
+    if verbose:
+        print(f"Looking up {len(lookup_calls)} callsigns")
+    with metrics.timer('lookups'):
+        if defer_geocode:
+            lookups = get_cached_info_many(lookup_calls, info_method)
         else:
-            time_diff = None
+            lookups = get_info_many(lookup_calls, info_method)
 
-    except IndexError:
-        time_diff = None
-        last_heard = None
+    # Calls that aren't cached are left to geocode_worker.py. Calls that
+    # are already bad geocodes aren't queued again.
+    deferred = set()
+    if defer_geocode:
+        deferred = {call for call in lookup_calls if call not in lookups and
+                    call not in bad_geocodes}
+    queued = {}
 
-    times = [(timestamp + datetime.timedelta(seconds=x)).strftime("%H:%M:%S")
-             for x in range(-5, 5)]
+    # Get MH rows already stored for this port around the times in the list
+    with metrics.timer('db_prefetch'):
+        heard_index = load_heard_index(
+            session, RemotelyHeardStation.remote_call,
+            RemotelyHeardStation.heard_time, [item[1] for item in mh_list],
+            criteria=(RemotelyHeardStation.parent_call == node_to_crawl,
+                      RemotelyHeardStation.port == port_name))
 
-    check_list = []
-    to_add = True
-    for time in times:
-        if f"{call} {time}" in existing_mh_data:
-            to_add = False
+    # Do the MH List Processing. Inserts are queued on the writer, so this
+    # is mostly updates.
+    phase_start = time.perf_counter()
+    current_op_list = []
 
-    lat = None
-    lon = None
-    grid = None
+    for item in mh_list:
+        info = None
 
-    digipeaters = ""
-    try:
-        for digipeater in item[2]:
-            digipeater = digipeater.strip()
-            digipeaters += f"{digipeater},"
-            digipeater_list[digipeater] = timestamp
-    except TypeError:
-        digipeaters = None
-
-    # Write MH table
-    if to_add is True:
-        if verbose:
-            print(f"{now} Adding {call} at {timestamp} through {digipeaters}.")
-
-        remotely_heard = RemotelyHeardStation(
-            parent_call=node_to_crawl,
-            remote_call=call,
-            heard_time=timestamp,
-            ssid=ssid,
-            update_time=now,
-            port=port_name,
-            uid=f"{node_to_crawl}-{port_name}",
-            digis=digipeaters
-        )
-
-        session.add(remotely_heard)
-        mh_counter += 1
-
-    # Update ops last heard
-    if last_heard and timestamp > last_heard:
-        session.query(RemoteOperator). \
-            filter(RemoteOperator.remote_call == f"{op_call}"). \
-            update({RemoteOperator.lastheard: timestamp},
-                   synchronize_session="fetch")
+        call, op_call, ssid = strip_call(item[0])
 
-    # Write Ops table if new operator
-    if op_call not in existing_ops_data and op_call not in current_op_list:
-        # add coordinates & grid
-        if '-' in call:
-            try:
-                info = get_info(call.split('-')[0], info_method)
-            except Exception as e:
-                print(f"Error {e} on {call}")
+        timestamp = item[1]
+        last_heard, time_diff = op_last_seen[op_call]
 
-        else:
-            try:
-                info = get_info(call, info_method)
-            except Exception as e:
-                print(f"Error {e} on {call}")
+        to_add = not heard_index.seen(call, timestamp)
 
-        if info:
-            try:
-                lat = float(info[0])
-                lon = float(info[1])
-                grid = info[2]
-            except ValueError:
-                if verbose:
-                    print(f"Couldn't get coordinates for {op_call}")
-                grid = None
+        lat = None
+        lon = None
+        grid = None
 
-        if grid:  # No grid means no geocode generally
+        digipeaters = ""
+        try:
+            for digipeater in item[2]:
+                digipeaters += f"{digipeater.strip()},"
+        except TypeError:
+            digipeaters = None
+
+        # Write MH table
+        if to_add is True:
             if verbose:
-                print(f"{now} Adding {op_call} to operator table.")
+                print(f"{now} Adding {call} at {timestamp} through "
+                      f"{digipeaters}.")
 
-            remote_operator = RemoteOperator(
+            remotely_heard = RemotelyHeardStation(
                 parent_call=node_to_crawl,
-                remote_call=op_call,
-                lastheard=timestamp,
-                grid=grid,
-                geom=f'SRID=4326;POINT({lon} {lat})',
+                remote_call=call,
+                heard_time=timestamp,
+                ssid=ssid,
+                update_time=now,
                 port=port_name,
+                band=band,
                 uid=f"{node_to_crawl}-{port_name}",
-                lastcheck=now
+                digis=digipeaters,
+                heard_bucket=heard_bucket(timestamp)
             )
 
-            session.add(remote_operator)
-            new_ops_counter += 1
+            writer.add(remotely_heard)
+            heard_index.add(call, timestamp)
+            counters['mh'] += 1
+            added += 1
 
-        else:  # Add to bad_geocodes table
-            if op_call not in bad_geocodes:
-                if verbose:
-                    print(
-                        f"{op_call} not geocoded. Adding to bad geocode table")
-                new_bad_geocode = BadGeocode(
-                    last_checked=now,
-                    reason="Operator not geocoded",
-                    node_name=op_call,
-                    parent_node=node_to_crawl
-                )
+        # Update ops last heard
+        if last_heard and timestamp > last_heard:
+            session.query(RemoteOperator). \
+                filter(RemoteOperator.remote_call == f"{op_call}"). \
+                update({RemoteOperator.lastheard: timestamp},
+                       synchronize_session="fetch")
 
-                session.add(new_bad_geocode)
-                bad_geocodes_counter += 1
-
-    elif op_call not in current_op_list:  # Update existing op
-        if time_diff is None or time_diff.days >= refresh_days:
+        # Write Ops table if new operator
+        if op_call not in existing_ops and op_call not in current_op_list:
             # add coordinates & grid
-            info = get_info(call.split('-')[0], info_method)
+            info = lookups.get(call.split('-')[0])
 
             if info:
                 try:
                     lat = float(info[0])
                     lon = float(info[1])
                     grid = info[2]
+                except ValueError:
+                    if verbose:
+                        print(f"Couldn't get coordinates for {op_call}")
+                    grid = None
+
+            if grid:  # No grid means no geocode generally
+                if verbose:
+                    print(f"{now} Adding {op_call} to operator table.")
+
+                remote_operator = RemoteOperator(
+                    parent_call=node_to_crawl,
+                    remote_call=op_call,
+                    lastheard=timestamp,
+                    grid=grid,
+                    geom=f'SRID=4326;POINT({lon} {lat})',
+                    port=port_name,
+                    uid=f"{node_to_crawl}-{port_name}",
+                    lastcheck=now
+                )
+
+                writer.add(remote_operator)
+                existing_ops.add(op_call)
+                counters['new_ops'] += 1
+
+            elif call.split('-')[0] in deferred:
+                queued[('remote_operator', op_call)] = queue_payload(
+                    parent_call=node_to_crawl, port=port_name,
+                    uid=f"{node_to_crawl}-{port_name}", lastheard=timestamp)
+
+            else:  # Add to bad_geocodes table
+                if op_call not in bad_geocodes:
+                    if verbose:
+                        print(f"{op_call} not geocoded. Adding to bad "
+                              f"geocode table")
+                    new_bad_geocode = BadGeocode(
+                        last_checked=now,
+                        reason="Operator not geocoded",
+                        node_name=op_call,
+                        parent_node=node_to_crawl
+                    )
+
+                    writer.add(new_bad_geocode)
+                    bad_geocodes.add(op_call, now)
+                    counters['bad_geocodes'] += 1
+
+        elif op_call not in current_op_list:  # Update existing op
+            if time_diff is None or time_diff.days >= refresh_days:
+                # add coordinates & grid
+                info = lookups.get(call.split('-')[0])
+
+                if info:
+                    try:
+                        lat = float(info[0])
+                        lon = float(info[1])
+                        grid = info[2]
+                    except IndexError:
+                        lat = None
+                        lon = None
+                        grid = None
+
+                    if verbose:
+                        print(f"Updating coordinates for {op_call}")
+                    if lat is not None and lon is not None:
+                        session.query(RemoteOperator).filter(
+                            RemoteOperator.remote_call == f'{op_call}').update(
+                            {RemoteOperator.parent_call: node_to_crawl,
+                             RemoteOperator.geom:
+                                 f"SRID=4326;POINT({lon} {lat})",
+                             RemoteOperator.grid: grid,
+                             RemoteOperator.port: port_name,
+                             RemoteOperator.uid: f"{node_to_crawl}-{port_name}",
+                             RemoteOperator.lastcheck: now},
+                            synchronize_session="fetch")
+                        counters['updated_ops'] += 1
+
+                elif call.split('-')[0] in deferred:
+                    queued[('remote_operator', op_call)] = queue_payload(
+                        parent_call=node_to_crawl, port=port_name,
+                        uid=f"{node_to_crawl}-{port_name}",
+                        lastheard=timestamp)
+
+            else:  # Update port & uid
+                if verbose:
+                    print(f"Updating parent node & port data for {op_call}")
+                session.query(RemoteOperator).filter(
+                    RemoteOperator.remote_call == f'{op_call}').update(
+                    {RemoteOperator.parent_call: node_to_crawl,
+                     RemoteOperator.port: port_name,
+                     RemoteOperator.uid: f"{node_to_crawl}-{port_name}"},
+                    synchronize_session="fetch")
+                counters['updated_ops'] += 1
+
+        current_op_list.append(op_call)
+
+    # Write digipeaters table
+    added_digipeaters = []
+    for digipeater in digipeater_list.items():
+        lat = None
+        lon = None
+        grid = None
+        digipeater_call = digipeater[0]
+        timestamp = digipeater[1]
+
+        callsign = get_callsign(digipeater_call)
+        heard = callsign.heard
+        ssid = callsign.ssid
+        digipeater_call = callsign.base
+        last_seen, time_diff = digipeater_last_seen[digipeater_call]
+
+        # Add new digipeater
+        if digipeater_call not in digipeater_ports and \
+                digipeater_call not in added_digipeaters:
+
+            digipeater_info = lookups.get(digipeater_call)
+
+            if digipeater_info:
+                if verbose:
+                    print(f"Adding digipeater {digipeater_call}")
+
+                try:
+                    lat = float(digipeater_info[0])
+                    lon = float(digipeater_info[1])
+                    grid = digipeater_info[2]
                 except IndexError:
                     lat = None
                     lon = None
                     grid = None
 
-                if verbose:
-                    print(f"Updating coordinates for {op_call}")
                 if lat is not None and lon is not None:
-                    session.query(RemoteOperator).filter(
-                        RemoteOperator.remote_call == f'{op_call}').update(
-                        {RemoteOperator.parent_call: node_to_crawl,
-                         RemoteOperator.geom: f"SRID=4326;POINT({lon} {lat})",
-                         RemoteOperator.grid: grid,
-                         RemoteOperator.port: port_name,
-                         RemoteOperator.uid: f"{node_to_crawl}-{port_name}",
-                         RemoteOperator.lastcheck: now},
-                        synchronize_session="fetch")
-                    updated_ops_counter += 1
-
-        else:  # Update port & uid
+                    remote_digi = RemoteDigipeater(
+                        parent_call=node_to_crawl,
+                        call=digipeater_call,
+                        lastheard=timestamp,
+                        grid=grid,
+                        heard=heard,
+                        ssid=ssid,
+                        geom=f'SRID=4326;POINT({lon} {lat})',
+                        last_port=port_name,
+                        uid=f"{node_to_crawl}-{port_name}",
+                        ports=port_name,
+                        lastcheck=now)
+
+                    writer.add(remote_digi)
+                    digipeater_ports[digipeater_call] = port_name
+                    counters['new_digipeaters'] += 1
+                added_digipeaters.append(digipeater_call)
+            elif digipeater_call in deferred:
+                queued[('remote_digipeater', digipeater_call)] = \
+                    queue_payload(parent_call=node_to_crawl,
+                                  lastheard=timestamp, heard=heard, ssid=ssid,
+                                  last_port=port_name,
+                                  uid=f"{node_to_crawl}-{port_name}",
+                                  ports=port_name)
+            elif verbose:
+                print(f"Could not get info for digipeater: {digipeater_call}")
+
+        else:
+            if digipeater_call in digipeater_ports:
+                # Update last port and ssid and parent call
+                if verbose:
+                    print(f"Updating parent node, ssid, and port name for "
+                          f"{digipeater_call}")
+                session.query(RemoteDigipeater). \
+                    filter(RemoteDigipeater.call == f"{digipeater_call}"). \
+                    update({RemoteDigipeater.parent_call: node_to_crawl,
+                            RemoteDigipeater.last_port: port_name,
+                            RemoteDigipeater.ssid: ssid})
+            if time_diff is None or time_diff.days >= refresh_days:
+                digipeater_info = lookups.get(digipeater_call)
+
+                if digipeater_info:
+                    if verbose:
+                        print(f"Adding digipeater {digipeater_call}")
+                    lat = float(digipeater_info[0])
+                    lon = float(digipeater_info[1])
+                    grid = digipeater_info[2]
+
+                    if lat is not None and lon is not None:
+                        if verbose:
+                            print(f"Updating digipeater coordinates for "
+                                  f"{digipeater}")
+                        session.query(RemoteDigipeater).\
+                            filter(RemoteDigipeater.call ==
+                                   f"{digipeater_call}").\
+                            update({
+                            RemoteDigipeater.geom:
+                                f"SRID=4326;POINT({lon} {lat})",
+                            RemoteDigipeater.lastcheck: now},
+                            synchronize_session="fetch")
+                        counters['updated_digipeaters'] += 1
+
+                elif digipeater_call in deferred:
+                    queued[('remote_digipeater', digipeater_call)] = \
+                        queue_payload(parent_call=node_to_crawl,
+                                      lastheard=timestamp, heard=heard,
+                                      ssid=ssid, last_port=port_name,
+                                      uid=f"{node_to_crawl}-{port_name}",
+                                      ports=port_name)
+
+                # Add new digipeater port
+        if digipeater_call in digipeater_ports and \
+                digipeater_call not in added_digipeaters:
+            existing_digi_ports = digipeater_ports[digipeater_call]
+
+            port_list = None
+            if not existing_digi_ports:
+                port_list = port_name
+            else:
+                port_list = existing_digi_ports
+                if port_name not in port_list:
+                    port_list += ',' + port_name
+
+            if not existing_digi_ports or \
+                    port_name not in existing_digi_ports:
+                session.query(RemoteDigipeater). \
+                    filter(RemoteDigipeater.call == digipeater_call). \
+                    update({RemoteDigipeater.ports: port_list})
+                digipeater_ports[digipeater_call] = port_list
+
+        # Update timestamp
+        if last_seen and last_seen < timestamp:
             if verbose:
-                print(f"Updating parent node & port data for {op_call}")
-            session.query(RemoteOperator).filter(
-                RemoteOperator.remote_call == f'{op_call}').update(
-                {RemoteOperator.parent_call: node_to_crawl,
-                 RemoteOperator.port: port_name,
-                 RemoteOperator.uid: f"{node_to_crawl}-{port_name}"},
+                print(f"Updating timestamp for digipeater {digipeater_call} "
+                      f"with TS {timestamp}")
+            session.query(RemoteDigipeater).filter(
+                RemoteDigipeater.call == f"{digipeater_call}").update(
+                {RemoteDigipeater.lastheard: timestamp},
                 synchronize_session="fetch")
-            updated_ops_counter += 1
-
-    current_op_list.append(op_call)
-
-# Write digipeaters table
-added_digipeaters = []
-new_digipeater_counter = 0
-updated_digipeater_counter = 0
-for digipeater in digipeater_list.items():
-    lat = None
-    lon = None
-    grid = None
-    digipeater_call = digipeater[0]
-    timestamp = digipeater[1]
-    heard = False
-    ssid = None
-    time_diff = None
-
-    if '*' in digipeater_call:
-        heard = True
 
-    try:
-        ssid = int(re.sub(r'[^\w]', ' ', digipeater_call.split('-')[1]))
-    except IndexError:
-        # No ssid
-        ssid = None
+    metrics.add_time('db_updates', time.perf_counter() - phase_start)
 
-    digipeater_call = re.sub(r'[^\w]', ' ',
-                             digipeater_call.split('-')[0]).strip().upper()
+    if queued:
+        if verbose:
+            print(f"Queueing {len(queued)} callsigns for geocoding")
+        with metrics.timer('db_enqueue'):
+            counters['deferred_geocodes'] += enqueue_geocodes(
+                session, GeocodeQueue, queued, now)
 
-    try:
-        last_seen = session.query(RemoteDigipeater.lastheard). \
-            distinct(RemoteDigipeater.call, RemoteDigipeater.lastheard). \
-            filter(RemoteDigipeater.call == f'{digipeater_call}'). \
-            order_by(RemoteDigipeater.lastheard).first()
+    with metrics.timer('db_inserts'):
+        writer.flush()
 
-        last_check = session.query(RemoteDigipeater.lastcheck).\
-            distinct(RemoteDigipeater.call, RemoteDigipeater.lastcheck).\
-            filter(RemoteDigipeater.call == f'{digipeater_call}').\
-            order_by(RemoteDigipeater.lastcheck).first()
+    return added
 
-        if last_seen:
-            last_seen = last_seen[0]
 
-        if last_check is not None:
-            last_check = last_check[0]
+def save_crawl_stats(node_info, new_rows, seconds, now):
+    """
+    Update the new station rate and crawl time of an auto crawled port,
+    which auto_node_selector uses to rank ports
+    :param node_info: Tuple from auto_node_selector, or None for a manual
+    crawl
+    :param new_rows: MH rows the crawl added
+    :param seconds: Seconds the crawl took
+    :param now: Time of the crawl
+    """
+    if not node_info or debug:
+        return
 
-            if last_check is not None:
-                time_diff = (now - last_check)
-            else:
-                time_diff = None
+    crawled_node_id, _, last_crawled, _, new_station_rate, crawl_seconds = \
+        node_info
+    stale_days = (now - last_crawled).total_seconds() / 86400
+    new_station_rate, crawl_seconds = update_crawl_stats(
+        new_station_rate, crawl_seconds, new_rows, stale_days, seconds)
 
-        else:
-            time_diff = None
+    if verbose:
+        print(f"Port now averages {new_station_rate:.1f} new MH rows per day "
+              f"and {crawl_seconds:.1f}s per crawl")
+    session.query(CrawledNode).filter(CrawledNode.id == crawled_node_id). \
+        update({CrawledNode.new_station_rate: new_station_rate,
+                CrawledNode.crawl_seconds: crawl_seconds},
+               synchronize_session=False)
 
-    except IndexError:
-        last_seen = None  # New digi
-        time_diff = None
 
-    # Add new digipeater
-    if digipeater_call not in existing_digipeaters_data and \
-            digipeater_call not in added_digipeaters:
+def finish():
+    """
+    Update operator bands, commit and print the run summary
+    """
+    # Populate bands column for remote_operators table
+    if verbose:
+        print("Updating operator bands")
+    with metrics.timer('db_band_update'):
+        update_operator_bands(session, RemoteOperator, RemotelyHeardStation)
 
-        digipeater_info = get_info(digipeater_call, info_method)
+    if not debug:
+        with metrics.timer('db_commit'):
+            session.commit()
 
-        if digipeater_info:
-            if verbose:
-                print(f"Adding digipeater {digipeater_call}")
+    for name, value in counters.items():
+        metrics.count(name, value)
+    save_metrics('mh_crawler', None if debug else session, RunMetric)
+    session.close()
+
+    print(f"{datetime.datetime.utcnow().replace(microsecond=0)} - Added "
+          f"{counters['mh']} MH rows, with {counters['new_ops']} "
+          f"new operators, {counters['updated_ops']} updated ops, and "
+          f"{counters['bad_geocodes']} bad geocodes. Added "
+          f"{counters['new_digipeaters']} new digipeaters and updated "
+          f"{counters['updated_digipeaters']} digipeaters.")
+
+
+def crawl_nodes(node_to_crawl_info, parallel=1, all_ports=False):
+    """
+    Crawl several nodes, up to parallel at once. Each worker only talks to
+    the network; this thread writes everything to the DB, committing after
+    each node.
+    :param node_to_crawl_info: Dict from auto_node_selector
+    :param parallel: Most nodes to crawl at once
+    :param all_ports: Get the MH list of every active port of each node in
+    the same connection, instead of only the selected port
+    :return: Number of nodes that failed
+    """
+    node_ports = {}
+    for node, node_info in node_to_crawl_info.items():
+        node_ports[node] = [node_info]
+        if all_ports:
+            node_ports[node] = active_node_ports(CrawledNode, session,
+                                                 node) or [node_info]
+
+    errors = 0
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        crawls = {executor.submit(fetch_node, node,
+                                  {port_info[1]: port_info[3]
+                                   for port_info in port_infos}): node
+                  for node, port_infos in node_ports.items()}
+
+        for crawl in as_completed(crawls):
+            node_to_crawl = crawls[crawl]
+            port_infos = node_ports[node_to_crawl]
 
             try:
-                lat = float(digipeater_info[0])
-                lon = float(digipeater_info[1])
-                grid = digipeater_info[2]
-            except IndexError:
-                lat = None
-                lon = None
-                grid = None
-
-            if lat is not None and lon is not None:
-                remote_digi = RemoteDigipeater(parent_call=node_to_crawl,
-                                               call=digipeater_call,
-                                               lastheard=timestamp,
-                                               grid=grid,
-                                               heard=heard,
-                                               ssid=ssid,
-                                               geom=f'SRID=4326;POINT({lon} {lat})',
-                                               last_port=port_name,
-                                               uid=f"{node_to_crawl}-{port_name}",
-                                               ports=port_name,
-                                               lastcheck=now)
-
-                session.add(remote_digi)
-                new_digipeater_counter += 1
-            added_digipeaters.append(digipeater_call)
-        elif verbose:
-            print(f"Could not get info for digipeater: {digipeater_call}")
+                node_name_map, mh_lists, now, seconds = crawl.result()
+                for node_info in port_infos:
+                    selected_port = node_info[1]
+                    port_name = node_name_map.get(selected_port)
+                    if port_name is None:
+                        # Don't lose the node's other ports
+                        print(f"Port {selected_port} not found on "
+                              f"{node_to_crawl}")
+                        continue
+                    port_name = port_name.strip()
+
+                    port_ok, last_crawled_port_name = check_crawled_port(
+                        node_to_crawl, selected_port, port_name)
+                    mh_list = mh_lists.get(selected_port)
+                    if port_ok and mh_list is not None:
+                        update_crawled_node(node_to_crawl, node_info,
+                                            selected_port, port_name,
+                                            last_crawled_port_name, now)
+                        added = store_mh_list(node_to_crawl, port_name,
+                                              mh_list, now)
+                        # The connection is shared by the ports
+                        save_crawl_stats(node_info, added,
+                                         seconds / len(mh_lists), now)
+            except Exception as e:
+                # One bad node or listing doesn't end the run
+                print(f"Error crawling {node_to_crawl}: {e!r}")
+                session.rollback()
+                # Drop the node's queued rows, so they aren't written with
+                # the next node
+                writer.clear()
+                # The bad geocode index may hold rows that were rolled back
+                with metrics.timer('db_load_caches'):
+                    load_caches()
+                errors += 1
+                continue
+
+            if not debug:
+                with metrics.timer('db_commit'):
+                    session.commit()
+
+    metrics.count('crawl_errors', errors)
+    return errors
+
+
+def close_gateways():
+    """
+    Log out of the local node
+    """
+    with gateway_lock:
+        if verbose:
+            print(f"Logged in to the local node "
+                  f"{sum(g.logins for g in gateway_sessions)} times")
+
+        for gateway in gateway_sessions:
+            gateway.close()
+        gateway_sessions.clear()
+        idle_gateways.clear()
+
+
+if __name__ == '__main__':
+    print(f"\n==============================================\n"
+          f"Run at {datetime.datetime.utcnow().replace(microsecond=0)}")
+
+    port_name = None
+
+    parser = argparse.ArgumentParser(description="Crawl BPQ nodes")
+    parser.add_argument('--node', metavar='N', type=str,
+                        help="Node name to crawl")
+    parser.add_argument('-auto', action='store_true',
+                        help="Pick a node to crawl automatically")
+    parser.add_argument('-v', action='store_true', help='Verbose log')
+    parser.add_argument('--bulk', action='store_true',
+                        help="Write new rows with COPY instead of one at a "
+                             "time")
+    parser.add_argument('--parallel', metavar='N', type=int, default=1,
+                        help="With -auto, crawl up to N nodes at once over "
+                             "separate telnet sessions")
+    parser.add_argument('--count', metavar='N', type=int,
+                        help="With -auto, number of due node ports to crawl "
+                             "this run. Defaults to --parallel.")
+    parser.add_argument('--all-ports', action='store_true',
+                        help="With -auto, get the MH list of every active "
+                             "port of each node in one connection")
+    parser.add_argument('--defer-geocode', action='store_true',
+                        help="Queue callsigns that aren't in the geocode "
+                             "cache for geocode_worker.py")
+    args = parser.parse_args()
+    node_to_crawl = args.node
+    auto = args.auto
+    parallel = args.parallel
+    crawl_count = args.count or parallel
+    all_ports = args.all_ports
+
+    if node_to_crawl:
+        node_to_crawl = node_to_crawl.strip().upper()
+
+    last_crawled_port_name = None
+    node_to_crawl_info = {}
+
+    if (crawl_count > 1 or all_ports) and not auto:
+        print("--parallel, --count and --all-ports only work with auto mode")
+        exit()
 
-    else:
-        if digipeater_call in existing_digipeaters_data:
-            # Update last port and ssid and parent call
-            if verbose:
-                print(
-                    f"Updating parent node, ssid, and port name for {digipeater_call}")
-            session.query(RemoteDigipeater). \
-                filter(RemoteDigipeater.call == f"{digipeater_call}"). \
-                update({RemoteDigipeater.parent_call: node_to_crawl,
-                        RemoteDigipeater.last_port: port_name,
-                        RemoteDigipeater.ssid: ssid})
-        if time_diff is None or time_diff.days >= refresh_days:
-            digipeater_info = get_info(digipeater_call, info_method)
+    if auto and node_to_crawl:
+        print("You can't enter node to crawl & auto mode")
+        exit()
 
-            if digipeater_info:
-                if verbose:
-                    print(f"Adding digipeater {digipeater_call}")
-                lat = float(digipeater_info[0])
-                lon = float(digipeater_info[1])
-                grid = digipeater_info[2]
+    start_run(args.v, args.bulk, args.defer_geocode)
 
-                if lat is not None and lon is not None:
-                    if verbose:
-                        print(
-                            f"Updating digipeater coordinates for {digipeater}")
-                    session.query(RemoteDigipeater).\
-                        filter(RemoteDigipeater.call == f"{digipeater_call}").\
-                        update({
-                        RemoteDigipeater.geom: f"SRID=4326;POINT({lon} {lat})",
-                        RemoteDigipeater.lastcheck: now},
-                        synchronize_session="fetch")
-                    updated_digipeater_counter += 1
-
-            # Add new digipeater port
-    if digipeater_call in existing_digipeaters_data and \
-            digipeater_call not in added_digipeaters:
-        existing_digi_ports = \
-            existing_digipeaters_data.get(digipeater_call)[3]
-
-        port_list = None
-        if not existing_digi_ports:
-            port_list = port_name
-        else:
-            port_list = existing_digi_ports
-            if port_name not in port_list:
-                port_list += ',' + port_name
+    if auto and not debug:
+        node_to_crawl_info = auto_node_selector(CrawledNode, session,
+                                                refresh_days,
+                                                limit=crawl_count)
+        if not node_to_crawl_info:
+            session.close()
+            exit()
+    elif not node_to_crawl and not debug:
+        print("You must enter a node to crawl.")
+        exit()
+    elif not node_to_crawl and not auto:
+        node_to_crawl = "KD5LPB"
+
+    if auto:
+        # Each worker stays logged in to the local node between crawls, and
+        # sends the mh commands with the ports command so the ports listing
+        # ends at the next prompt
+        print(f"Auto crawling {len(node_to_crawl_info)} nodes, {parallel} "
+              f"at a time")
+        try:
+            crawl_nodes(node_to_crawl_info, parallel, all_ports)
+            finish()
+        finally:
+            close_gateways()
+        exit()
 
-        if not existing_digi_ports or port_name not in existing_digi_ports:
-            session.query(RemoteDigipeater). \
-                filter(RemoteDigipeater.call == digipeater_call). \
-                update({RemoteDigipeater.ports: port_list})
+    # Connect to local telnet server
+    tn = telnet_connect()
 
-    # Update timestamp
-    if last_seen and last_seen < timestamp:
-        if verbose:
-            print(
-                f"Updating timestamp for digipeater {digipeater_call} with TS {timestamp}")
-        session.query(RemoteDigipeater).filter(
-            RemoteDigipeater.call == f"{digipeater_call}").update(
-            {RemoteDigipeater.lastheard: timestamp},
-            synchronize_session="fetch")
-
-    # Add to port list
-
-# Get bands for each operator
-
-if verbose:
-    print("Updating bands columns")
-case_statement = "UPDATE public.remote_mh SET band = CASE " \
-                 "WHEN (port LIKE '%4__.%' OR port LIKE '44_.%') AND port NOT LIKE '% 14.%' AND port NOT LIKE '% 7.%' THEN '70CM' " \
-                 "WHEN (port LIKE '%14_.%' OR port LIKE '14_.%') AND port NOT LIKE '% 14.%' AND port NOT LIKE '% 7.%' THEN '2M' " \
-                 "WHEN (port LIKE '%22_.%' OR port LIKE '22_.%') THEN '1.25M' " \
-                 "WHEN (port LIKE '% 14.%' OR port LIKE '14.%') AND port NOT LIKE '%14_.%' AND port NOT LIKE '% 7.%' THEN '20M' " \
-                 "WHEN (port LIKE '% 7.%' OR port LIKE '7.%') AND port NOT LIKE '%14_.%' AND port NOT LIKE '%14.%%%' THEN '40M' " \
-                 "WHEN (port LIKE '% 3.%' OR port LIKE '3.%') AND port NOT LIKE '%14_.%' AND port NOT LIKE '%14.%%%' THEN '80M' " \
-                 "END;"
-# engine.execute(text(case_statement)).execution_options(autocommit=True)
-session.execute(case_statement)
-
-# Populate bands column for remote_operators table
-all_operators = session.query(RemoteOperator).filter(
-    RemoteOperator.bands.is_(None))
-
-for operator in all_operators:
-    operating_bands = ""
-    call = operator.remote_call
-    call = call.split('-')[0].strip()
-    bands = operator.bands
-
-    all_mh = session.query(RemotelyHeardStation).filter(
-        RemotelyHeardStation.remote_call.like(f'{call}%'))
-
-    if bands:
-        operating_bands += bands
-
-    for mh_item in all_mh:
-        remote_call = mh_item.remote_call
-        band = mh_item.band
-
-        if re.sub('[\W_]+', '', remote_call.split('-')[0]) == call and band:
-            if band not in operating_bands:
-                operating_bands += f"{band},"
-
-    if len(operating_bands) > 0:
-        session.query(RemoteOperator).filter(
-            RemoteOperator.remote_call == f'{call}').update(
-            {RemoteOperator.bands: operating_bands},
-            synchronize_session="fetch")
-
-if not debug:
-    session.commit()
-session.close()
-
-print(f"{now} - Added {mh_counter} MH rows, with {new_ops_counter} "
-      f"new operators, {updated_ops_counter} updated ops, and "
-      f"{bad_geocodes_counter} bad geocodes. Added {new_digipeater_counter} "
-      f"new digipeaters and updated {updated_digipeater_counter} digipeaters.")
+    start = time.monotonic()
+    if not debug:  # Stay local if debugging
+        try:
+            tn = node_connect(node_to_crawl, tn)
+        except KeyboardInterrupt:
+            print("Closing connection")
+            tn.write(b'bye\r')
+            exit()
+
+        if tn is None:
+            exit()
+
+    try:
+        node_name_map = get_ports(tn)
+    except CrawlError as e:
+        print(e)
+        exit()
+
+    # Give menu options on screen
+    selected_port = None
+    menu_item = 1
+    print("Select VHF/UHF port to scan MHeard on")
+    for menu_item, port_name in node_name_map.items():
+        print(f"{menu_item}: {port_name}")
+
+    try:
+        selected_port = int(input().strip())
+    except ValueError:
+        print("You didn't enter a valid selection. Closing")
+        tn.write(b'bye\r')
+        exit()
+
+    if selected_port:
+
+        port_name = node_name_map.get(selected_port).strip()
+
+        try:
+            port_ok, last_crawled_port_name = check_crawled_port(
+                node_to_crawl, selected_port, port_name)
+        except CrawlError as e:
+            print(e)
+            exit()
+
+        # Exit if port has changed
+        if not port_ok:
+            session.commit()
+            session.close()
+            tn.write(b"bye\r")
+            exit()
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        try:
+            mh_list = get_mh_list(tn, selected_port, now)
+        except CrawlError as e:
+            print(e)
+            print("Try again")
+            exit()
+        seconds = time.monotonic() - start
+    else:
+        print("No port selected")
+        exit()
+
+    update_crawled_node(node_to_crawl, node_to_crawl_info.get(node_to_crawl),
+                        selected_port, port_name, last_crawled_port_name, now)
+    added = store_mh_list(node_to_crawl, port_name, mh_list, now)
+    save_crawl_stats(node_to_crawl_info.get(node_to_crawl), added, seconds,
+                     now)
+    finish()
@@ -0,0 +1,101 @@
+#!/bin/python3
+# Run the crawlers from one long-running process, so the DB engine, caches
+# and gateway sessions stay warm between crawls
+
+import argparse
+import datetime
+
+import crawler
+import geocode_worker
+import mh_crawler
+import mh_to_pg
+from common import auto_node_selector, get_daemon_conf
+from common.gateway import GatewaySession
+from common.scheduler import Scheduler
+from models.db import CrawledNode
+
+parser = argparse.ArgumentParser(description="Crawl BPQ nodes on a schedule")
+parser.add_argument('-v', action='store_true', help='Verbose log')
+parser.add_argument('--bulk', action='store_true',
+                    help="Write new rows with COPY instead of one at a time")
+parser.add_argument('--all-ports', action='store_true',
+                    help="Get the MH list of every active port of each node "
+                         "in one connection")
+parser.add_argument('--defer-geocode', action='store_true',
+                    help="Queue callsigns that aren't in the geocode cache "
+                         "and look them up in a separate job")
+args = parser.parse_args()
+verbose = args.v
+bulk = args.bulk
+all_ports = args.all_ports
+defer_geocode = args.defer_geocode
+daemon_conf = get_daemon_conf()
+
+# The local MH and nodes list jobs run one at a time, so they share a
+# session on the local node. The remote MH crawls keep their own pool.
+local_gateway = GatewaySession()
+
+
+def local_mh():
+    """
+    Save the local node's MH list
+    """
+    mh_to_pg.main(verbose, bulk, defer_geocode, gateway=local_gateway)
+
+
+def remote_mh():
+    """
+    Crawl the MH lists of due remote node ports
+    """
+    print(f"\n==============================================\n"
+          f"Run at {datetime.datetime.utcnow().replace(microsecond=0)}")
+
+    mh_crawler.start_run(verbose, bulk, defer_geocode)
+    try:
+        node_to_crawl_info = auto_node_selector(CrawledNode,
+                                                mh_crawler.session,
+                                                mh_crawler.refresh_days,
+                                                limit=daemon_conf['count'])
+        if not node_to_crawl_info:
+            return
+
+        print(f"Auto crawling {len(node_to_crawl_info)} nodes, "
+              f"{daemon_conf['parallel']} at a time")
+        mh_crawler.crawl_nodes(node_to_crawl_info, daemon_conf['parallel'],
+                               all_ports)
+        mh_crawler.finish()
+    finally:
+        mh_crawler.session.close()
+
+
+def geocode_queue():
+    """
+    Look up the callsigns the crawls queued
+    """
+    geocode_worker.main(verbose=verbose)
+
+
+def node_list():
+    """
+    Crawl the nodes list of a due node
+    """
+    crawler.main(auto=True, verbose=verbose, gateway=local_gateway)
+
+
+scheduler = Scheduler()
+scheduler.add("local MH", daemon_conf['local_mh_interval'], local_mh)
+scheduler.add("remote MH", daemon_conf['remote_mh_interval'], remote_mh,
+              delay=30)
+scheduler.add("nodes list", daemon_conf['nodes_interval'], node_list,
+              delay=60)
+if defer_geocode:
+    scheduler.add("geocode queue", daemon_conf['geocode_interval'],
+                  geocode_queue, delay=90)
+
+try:
+    scheduler.run_forever()
+except KeyboardInterrupt:
+    print("Stopping")
+finally:
+    local_gateway.close()
+    mh_crawler.close_gateways()
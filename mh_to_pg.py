@@ -3,352 +3,382 @@
 
 import argparse
 import datetime
-import re
-import time
 
-from sqlalchemy import func, desc
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
 
-from common import get_info, get_conf, telnet_connect
-from models.db import local_engine, LocallyHeardStation, Operator, \
-    Digipeater
-
-parser = argparse.ArgumentParser(description="Scrape BPQ node")
-parser.add_argument('-v', action='store_true', help="Verbose logs")
-args = parser.parse_args()
-verbose = args.v
+from common import get_info_many, get_conf, get_last_seen, telnet_connect, \
+    save_metrics, get_cached_info_many
+from common.bpq_parser import BPQParser, port_header
+from common.bulk import BulkWriter
+from common.dedupe import load_heard_index
+from common.expect import read_records
+from common.geocode_queue import enqueue_geocodes, queue_payload
+from common.metrics import metrics
+from common.string_cleaner import strip_call, get_callsign
+from models.db import get_engine, LocallyHeardStation, Operator, \
+    Digipeater, RunMetric, GeocodeQueue
 
 refresh_days = 7
 
-conf = get_conf()
-info_method = conf['info_method']
-
-# Connect to PG
-Session = sessionmaker(bind=local_engine)
-session = Session()
-
 # Connect to PG
-
-now = datetime.datetime.utcnow().replace(microsecond=0)
-year = datetime.date.today().year
-
-print(f"\n==============================================\n"
-      f"Run started at {now}")
-
-tn = telnet_connect()
-tn.write("mhu 1".encode('ascii') + b"\r")
-time.sleep(1)
-tn.write(b"\r")
-time.sleep(1)
-tn.write(b"bye\r")
-
-print(f"Connected to {conf['telnet_ip']}")
-
-output = tn.read_all()
-output = output.split(b"Port 1")[1].strip()
-output = output.split(b'***')[0]
-output = re.sub(b' +', b' ', output)
-output = output.split(b'\r\n')
-
-lines = output[0].split(b'\r')
-output = []
-
-for item in lines:
-    substring = item.strip().split(b'\n')[0]
-    sublist = substring.split()
-    output.append(sublist)
-
-# Clean up list
-for index, item in enumerate(output):
-    if b'via' in item:
-        item.remove(b'via')
-
-    if len(item) == 1:
-        del output[index]
-
-radio_mh_list = []
-for item in output:
-    res = []
-
-    call = item[0].decode('utf-8')
-    res.append(call)
-    month = item[1].decode('utf-8')
-    day = item[2].decode('utf-8')
-    time = item[3].decode('utf-8')
-
-    ymd = datetime.datetime.strptime(f"{month} {day} {year} {time}",
-                                     "%b %d %Y %H:%M:%S")
-    if ymd > datetime.datetime.utcnow():
-        ymd = datetime.datetime.strptime(f"{month} {day} {year - 1} {time}",
-                                         "%b %d %Y %H:%M:%S")
-    res.append(ymd)
-    try:
-        digipeaters = item[4].decode('utf-8').split(',')
-        res.append(digipeaters)
-    except IndexError:
-        res.append(None)
-
-    radio_mh_list.append(res)
-
-# Write to PG, first get existing data to check for duplicates
-existing_mh = session.query(LocallyHeardStation.call,
-                            LocallyHeardStation.timestamp).all()
-
-existing_mh_data = []
-for row in existing_mh:
-    call = row.call
-    timestamp = row.timestamp
-    hms = timestamp.strftime("%H:%M:%S")
-    existing_mh_data.append(f"{call} {hms}")
-
-radio_mh_list = sorted(radio_mh_list, key=lambda x: x[1], reverse=False)
-
-existing_ops = session.query(Operator.id, Operator.call,
-                             func.st_x(Operator.geom),
-                             func.st_y(Operator.geom),
-                             Operator.grid).all()
-
-existing_ops_data = {}
-for op in existing_ops:
-    call = op[1]
-    lon = op[2]
-    lat = op[3]
-    grid = op[4]
-    existing_ops_data[call] = (lat, lon, grid)
-
-existing_digipeaters = session.query(Digipeater.call,
-                                     func.st_x(Digipeater.geom),
-                                     func.st_y(Digipeater.geom),
-                                     Digipeater.heard).all()
-
-existing_digipeaters_data = {}
-for digipeater in existing_digipeaters:
-    call = digipeater[0]
-    lon = digipeater[1]
-    lat = digipeater[2]
-    heard = digipeater[3]
-    existing_digipeaters_data[call] = (lat, lon, heard)
-
-# Write to PG
-digipeater_list = {}
-current_op_list = []
-mh_counter = 0
-new_op_counter = 0
-for item in radio_mh_list:
-    call = item[0].strip().upper()
-    op_call = re.sub(r'[^\w]', ' ', call.split('-')[0].strip())
-
+Session = sessionmaker()
+
+
+def main(verbose=False, bulk=False, defer_geocode=False, gateway=None):
+    """
+    Get the MH list of the local node and save it to the DB
+    :param verbose: Verbose logs
+    :param bulk: Write new rows with COPY instead of one at a time
+    :param defer_geocode: Queue callsigns that aren't in the geocode cache
+    for geocode_worker.py instead of looking them up now
+    :param gateway: GatewaySession to send the command on. A new telnet
+    session is logged in and out if this is None.
+    """
+    metrics.clear()
+    session = Session(bind=get_engine())
     try:
-        ssid = re.sub(r'[^\w]', ' ', call.split('-')[1].strip())
-        ssid = int(ssid)
-    except IndexError or TypeError:
-        ssid = None
-
-    timestamp = item[1]
-
-    # Get last check time for determining if we should get a new geocode
-    try:
-        last_heard = session.query(Operator.lastheard). \
-            filter(Operator.call == op_call). \
-            order_by(desc(Operator.lastheard)).first()
-
-        last_check = session.query(Operator.lastcheck).\
-            filter(Operator.call == op_call).\
-            order_by(desc(Operator.lastcheck)).first()
-
-        if last_heard is not None:
-            last_heard = last_heard[0]
-
-        if last_check is not None:
-            last_check = last_check[0]
-
-        if last_check is not None:
-            timedelta = (now - last_check)
+        save_local_mh(session, verbose, bulk, defer_geocode, gateway)
+    finally:
+        session.close()
+
+
+def save_local_mh(session, verbose=False, bulk=False, defer_geocode=False,
+                  gateway=None):
+    """
+    Get the MH list of the local node and save it to the DB
+    :param session: A session object
+    :param verbose: Verbose logs
+    :param bulk: Write new rows with COPY instead of one at a time
+    :param defer_geocode: Queue callsigns that aren't in the geocode cache
+    for geocode_worker.py instead of looking them up now
+    :param gateway: GatewaySession to send the command on. A new telnet
+    session is logged in and out if this is None.
+    """
+    conf = get_conf()
+    info_method = conf['info_method']
+
+    # New MH, operator & digipeater rows go through the writer. Rows
+    # another run already wrote are skipped by the unique keys.
+    writer = BulkWriter(session, method="copy" if bulk else "insert",
+                        ignore_conflicts=True)
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+
+    print(f"\n==============================================\n"
+          f"Run started at {now}")
+
+    if gateway is None:
+        with telnet_connect() as tn:
+            tn.write("mhu 1".encode('ascii') + b"\r")
+            tn.write(b"\r")
+            tn.write(b"bye\r")
+
+            print(f"Connected to {conf['telnet_ip']}")
+
+            # Parse the listing as it's read, until the node closes the
+            # connection
+            parser = BPQParser('mhu', port_header(1), now)
+            radio_mh_list = list(read_records(tn, parser, timeout=30))
+    else:
+        # The session stays logged in, so the listing ends when the link
+        # goes quiet
+        parser, radio_mh_list = gateway.local_command(
+            b"mhu 1", lambda: BPQParser('mhu', port_header(1), now))
+
+    for error in parser.errors:
+        print(f"Couldn't parse MH line {error.line}: {error.reason}")
+
+    # Write to PG, first get existing data to check for duplicates
+    heard_index = load_heard_index(session, LocallyHeardStation.call,
+                                   LocallyHeardStation.timestamp,
+                                   [item[1] for item in radio_mh_list],
+                                   window=0)
+
+    radio_mh_list = sorted(radio_mh_list, key=lambda x: x[1], reverse=False)
+
+    # Collect operators & digipeaters and their last heard/check times, so
+    # every callsign that needs a lookup can be resolved in one batch
+    digipeater_list = {}
+    op_calls = {}
+    for item in radio_mh_list:
+        call, op_call, ssid = strip_call(item[0])
+        op_calls.setdefault(op_call, call.split('-')[0])
+
+        try:
+            for digipeater in item[2]:
+                digipeater_list[digipeater.strip()] = item[1]
+        except TypeError:
+            pass
+
+    digipeater_calls = {get_callsign(digipeater_call).base
+                        for digipeater_call in digipeater_list}
+
+    # Operators & digipeaters in this list that are already in the DB
+    existing_ops_data = {}
+    if op_calls:
+        existing_ops = session.query(Operator.call,
+                                     func.st_x(Operator.geom),
+                                     func.st_y(Operator.geom),
+                                     Operator.grid). \
+            filter(Operator.call.in_(op_calls)).all()
+        for call, lon, lat, grid in existing_ops:
+            existing_ops_data[call] = (lat, lon, grid)
+
+    existing_digipeaters_data = {}
+    if digipeater_calls:
+        existing_digipeaters = session.query(Digipeater.call,
+                                             func.st_x(Digipeater.geom),
+                                             func.st_y(Digipeater.geom),
+                                             Digipeater.heard). \
+            filter(Digipeater.call.in_(digipeater_calls)).all()
+        for call, lon, lat, heard in existing_digipeaters:
+            existing_digipeaters_data[call] = (lat, lon, heard)
+
+    last_seen_ops = get_last_seen(session, Operator.call, Operator.lastheard,
+                                  Operator.lastcheck, op_calls)
+    last_seen_digipeaters = get_last_seen(session, Digipeater.call,
+                                          Digipeater.lastheard,
+                                          Digipeater.lastcheck,
+                                          digipeater_calls)
+
+    lookup_calls = set()
+    op_last_seen = {}
+    for op_call, lookup_call in op_calls.items():
+        last_heard, last_check = last_seen_ops.get(op_call, (None, None))
+        timedelta = (now - last_check) if last_check is not None else None
+        op_last_seen[op_call] = (last_heard, timedelta)
+
+        if op_call not in existing_ops_data or timedelta is None or \
+                timedelta.days >= refresh_days:
+            lookup_calls.add(lookup_call)
+
+    digipeater_last_seen = {}
+    for digipeater_call in digipeater_calls:
+        last_seen, last_check = last_seen_digipeaters.get(digipeater_call,
+                                                          (None, None))
+        timedelta = (now - last_check) if last_check is not None else None
+        digipeater_last_seen[digipeater_call] = (last_seen, timedelta)
+
+        if digipeater_call not in existing_digipeaters_data or \
+                timedelta is None or timedelta.days >= refresh_days:
+            lookup_calls.add(digipeater_call)
+
+    if verbose:
+        print(f"Looking up {len(lookup_calls)} callsigns")
+    with metrics.timer('lookups'):
+        if defer_geocode:
+            lookups = get_cached_info_many(lookup_calls, info_method)
         else:
-            timedelta = None
-    except IndexError:
-        timedelta = None
-        last_heard = None
-
-    hms = timestamp.strftime("%H:%M:%S")
-    lat = None
-    lon = None
-    grid = None
-
-    digipeaters = ""
-    try:
-        for digipeater in item[2]:
-            digipeater = digipeater.strip()
-            digipeaters += f"{digipeater},"
-            digipeater_list[digipeater] = timestamp
-    except TypeError:
-        digipeaters = None
-
-    # Write MH table
-    if f"{call} {hms}" not in existing_mh_data:
-        if verbose:
-            print(f"{now} Adding {call} at {timestamp} through {digipeaters}.")
-
-        new_mh_entry = LocallyHeardStation(
-            timestamp=timestamp,
-            call=call,
-            digipeaters=digipeaters,
-            op_call=op_call,
-            ssid=ssid
-        )
-        session.add(new_mh_entry)
-        mh_counter += 1
-
-    # Update ops last heard
-    if last_heard and timestamp > last_heard:
-        session.query(Operator).filter(Operator.call == op_call).update(
-            {Operator.lastheard: timestamp}, synchronize_session="fetch")
-
-    # Write Ops table if
-    if op_call not in existing_ops_data and op_call not in current_op_list:
-        # add coordinates & grid
-        info = get_info(call.split('-')[0], info_method)
-
-        if info:
-            lat = float(info[0])
-            lon = float(info[1])
-            grid = info[2]
-
+            lookups = get_info_many(lookup_calls, info_method)
+
+    # Calls that aren't cached are left to geocode_worker.py
+    deferred = set()
+    if defer_geocode:
+        deferred = {call for call in lookup_calls if call not in lookups}
+    queued = {}
+
+    # Write to PG
+    current_op_list = []
+    mh_counter = 0
+    new_op_counter = 0
+    for item in radio_mh_list:
+        call, op_call, ssid = strip_call(item[0])
+
+        timestamp = item[1]
+        last_heard, timedelta = op_last_seen[op_call]
+
+        lat = None
+        lon = None
+        grid = None
+
+        digipeaters = ""
+        try:
+            for digipeater in item[2]:
+                digipeaters += f"{digipeater.strip()},"
+        except TypeError:
+            digipeaters = None
+
+        # Write MH table
+        if not heard_index.seen(call, timestamp):
             if verbose:
-                print(f"{now} Adding {op_call} to operator table.")
-            new_operator = Operator(
-                call=op_call,
-                lastheard=timestamp,
-                geom=f'SRID=4326;POINT({lon} {lat})',
-                grid=grid,
-                lastcheck=now
+                print(f"{now} Adding {call} at {timestamp} through "
+                      f"{digipeaters}.")
+
+            new_mh_entry = LocallyHeardStation(
+                timestamp=timestamp,
+                call=call,
+                digipeaters=digipeaters,
+                op_call=op_call,
+                ssid=ssid
             )
-            session.add(new_operator)
-            current_op_list.append(op_call)
-            new_op_counter += 1
-
-    elif timedelta is None or timedelta.days >= refresh_days and op_call not in \
-            current_op_list:
-        # add coordinates & grid
+            writer.add(new_mh_entry)
+            heard_index.add(call, timestamp)
+            mh_counter += 1
+
+        # Update ops last heard
+        if last_heard and timestamp > last_heard:
+            session.query(Operator).filter(Operator.call == op_call). \
+                update({Operator.lastheard: timestamp},
+                       synchronize_session="fetch")
 
-        info = get_info(call.split('-')[0], info_method)
+        # Write Ops table if
+        if op_call not in existing_ops_data and op_call not in current_op_list:
+            # add coordinates & grid
+            info = lookups.get(call.split('-')[0])
+
+            if info:
+                lat = float(info[0])
+                lon = float(info[1])
+                grid = info[2]
+
+                if verbose:
+                    print(f"{now} Adding {op_call} to operator table.")
+                new_operator = Operator(
+                    call=op_call,
+                    lastheard=timestamp,
+                    geom=f'SRID=4326;POINT({lon} {lat})',
+                    grid=grid,
+                    lastcheck=now
+                )
+                writer.add(new_operator)
+                current_op_list.append(op_call)
+                new_op_counter += 1
+
+            elif call.split('-')[0] in deferred:
+                queued[('operator', op_call)] = queue_payload(
+                    lastheard=timestamp)
+
+        elif timedelta is None or timedelta.days >= refresh_days and \
+                op_call not in current_op_list:
+            # add coordinates & grid
+
+            info = lookups.get(call.split('-')[0])
+
+            if info:
+                lat = float(info[0])
+                lon = float(info[1])
+                grid = info[2]
+
+            elif call.split('-')[0] in deferred:
+                queued[('operator', op_call)] = queue_payload(
+                    lastheard=timestamp)
+
+            if lat is not None and (lat, lon, grid) != \
+                    existing_ops_data.get(call):
+                if verbose:
+                    print(f"Updating coordinates for {op_call}")
+                session.query(Operator). \
+                    filter(Operator.call == op_call). \
+                    update({Operator.geom: f'SRID=4326;POINT({lon} {lat})',
+                            Operator.lastheard: timestamp,
+                            Operator.grid: grid,
+                            Operator.lastcheck: now},
+                           synchronize_session="fetch")
 
-        if info:
-            lat = float(info[0])
-            lon = float(info[1])
-            grid = info[2]
+            current_op_list.append(op_call)
 
-        if (lat, lon, grid) != existing_ops_data.get(call):
-            if verbose:
-                print(f"Updating coordinates for {op_call}")
-            session.query(Operator).filter(Operator.call == op_call).update(
-                {Operator.geom: f'SRID=4326;POINT({lon} {lat})',
-                 Operator.lastheard: timestamp,
-                 Operator.grid: grid,
-                 Operator.lastcheck: now},
+    # Write digipeaters table
+    added_digipeaters = []
+    digipeater_counter = 0
+    for digipeater in digipeater_list.items():
+        lat = None
+        lon = None
+        grid = None
+        digipeater_call = digipeater[0]
+        timestamp = digipeater[1]
+
+        callsign = get_callsign(digipeater_call)
+        heard = callsign.heard
+        ssid = callsign.ssid
+        digipeater_call = callsign.base
+        last_seen, timedelta = digipeater_last_seen[digipeater_call]
+
+        if digipeater_call not in existing_digipeaters_data and \
+                digipeater_call not in added_digipeaters:
+            digipeater_info = lookups.get(digipeater_call)
+
+            if digipeater_info:
+                if verbose:
+                    print(f"Adding digipeater {digipeater_call}")
+                lat = float(digipeater_info[0])
+                lon = float(digipeater_info[1])
+                grid = digipeater_info[2]
+
+                new_digipeater = Digipeater(
+                    call=digipeater_call,
+                    lastheard=timestamp,
+                    grid=grid,
+                    geom=f'SRID=4326;POINT({lon} {lat})',
+                    heard=heard,
+                    ssid=ssid,
+                    lastcheck=now
+                )
+
+                writer.add(new_digipeater)
+                digipeater_counter += 1
+                added_digipeaters.append(digipeater_call)
+
+            elif digipeater_call in deferred:
+                queued[('digipeater', digipeater_call)] = queue_payload(
+                    lastheard=timestamp, heard=heard, ssid=ssid)
+
+        elif timedelta is None or timedelta.days >= refresh_days:
+            digipeater_info = lookups.get(digipeater_call)
+
+            if digipeater_info:
+                if verbose:
+                    print(f"Updating digipeater {digipeater_call}")
+                lat = float(digipeater_info[0])
+                lon = float(digipeater_info[1])
+                grid = digipeater_info[2]
+
+                session.query(Digipeater). \
+                    filter(Digipeater.call == digipeater_call). \
+                    update({Digipeater.geom: f'SRID=4326;POINT({lon} {lat})',
+                            Digipeater.lastcheck: now},
+                           synchronize_session="fetch")
+
+            elif digipeater_call in deferred:
+                queued[('digipeater', digipeater_call)] = queue_payload(
+                    lastheard=timestamp, heard=heard, ssid=ssid)
+
+        # Update timestamp
+        if last_seen and last_seen < timestamp:
+            session.query(Digipeater).filter(
+                Digipeater.call == digipeater_call).update(
+                {Digipeater.lastheard: timestamp, Digipeater.heard: heard},
                 synchronize_session="fetch")
 
-        current_op_list.append(op_call)
-
-# Write digipeaters table
-added_digipeaters = []
-digipeater_counter = 0
-for digipeater in digipeater_list.items():
-    lat = None
-    lon = None
-    grid = None
-    digipeater_call = digipeater[0]
-    timestamp = digipeater[1]
-    heard = False
-    ssid = None
-
-    if '*' in digipeater_call:
-        heard = True
-
-    try:
-        ssid = re.sub(r'[^\w]', ' ', digipeater_call.split('-')[1])
-        ssid = int(ssid)
-    except IndexError or TypeError:
-        # No ssid
-        ssid = None
-
-    digipeater_call = re.sub(r'[^\w]', ' ', digipeater_call.split('-')[0]). \
-        strip()
-
-    try:
-        last_seen = session.query(Digipeater.lastheard).filter(
-            Digipeater.call == digipeater_call).order_by(
-            desc(Digipeater.lastheard)).first()
-
-        last_check = session.query(Digipeater.lastcheck).\
-            filter(Digipeater.call == digipeater_call).\
-            order_by(desc(Digipeater.lastcheck)).first()
-
-        if last_seen is not None:
-            last_seen = last_seen[0]
-
-        if last_check is not None:
-            last_check = last_check[0]
-
-        if last_check is not None:
-            timedelta = (now - last_check)
-        else:
-            timedelta = None
-
-    except IndexError:
-        last_seen = None  # New digi
-        timedelta = None
-
-    if digipeater_call not in existing_digipeaters_data and \
-            digipeater_call not in added_digipeaters:
-        digipeater_info = get_info(digipeater_call, info_method)
-
-        if digipeater_info:
-            if verbose:
-                print(f"Adding digipeater {digipeater_call}")
-            lat = float(digipeater_info[0])
-            lon = float(digipeater_info[1])
-            grid = digipeater_info[2]
-
-            new_digipeater = Digipeater(
-                call=digipeater_call,
-                lastheard=timestamp,
-                grid=grid,
-                geom=f'SRID=4326;POINT({lon} {lat})',
-                heard=heard,
-                ssid=ssid,
-                lastcheck=now
-            )
-
-            session.add(new_digipeater)
-            digipeater_counter += 1
-            added_digipeaters.append(digipeater_call)
-
-    elif timedelta is None or timedelta.days >= refresh_days:
-        digipeater_info = get_info(digipeater_call, info_method)
-
-        if digipeater_info:
-            if verbose:
-                print(f"Updating digipeater {digipeater_call}")
-            lat = float(digipeater_info[0])
-            lon = float(digipeater_info[1])
-            grid = digipeater_info[2]
-
-            session.query(Digipeater). \
-                filter(Digipeater.call == digipeater_call). \
-                update({Digipeater.geom: f'SRID=4326;POINT({lon} {lat})',
-                        Digipeater.lastcheck: now},
-                       synchronize_session="fetch")
-
-    # Update timestamp
-    if last_seen and last_seen < timestamp:
-        session.query(Digipeater).filter(
-            Digipeater.call == digipeater_call).update(
-            {Digipeater.lastheard: timestamp, Digipeater.heard: heard},
-            synchronize_session="fetch")
-
-session.commit()
-session.close()
-
-print(f"Added {mh_counter} MH items, {new_op_counter} new ops,"
-      f" and {digipeater_counter} digipeaters")
+    if queued:
+        if verbose:
+            print(f"Queueing {len(queued)} callsigns for geocoding")
+        with metrics.timer('db_enqueue'):
+            metrics.count('deferred_geocodes', enqueue_geocodes(
+                session, GeocodeQueue, queued, now))
+
+    with metrics.timer('db_inserts'):
+        writer.flush()
+    with metrics.timer('db_commit'):
+        session.commit()
+
+    metrics.count('mh', mh_counter)
+    metrics.count('new_ops', new_op_counter)
+    metrics.count('new_digipeaters', digipeater_counter)
+    save_metrics('mh_to_pg', session, RunMetric)
+
+    print(f"Added {mh_counter} MH items, {new_op_counter} new ops,"
+          f" and {digipeater_counter} digipeaters")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape BPQ node")
+    parser.add_argument('-v', action='store_true', help="Verbose logs")
+    parser.add_argument('--bulk', action='store_true',
+                        help="Write new rows with COPY instead of one at a "
+                             "time")
+    parser.add_argument('--defer-geocode', action='store_true',
+                        help="Queue callsigns that aren't in the geocode "
+                             "cache for geocode_worker.py")
+    args = parser.parse_args()
+    main(args.v, args.bulk, args.defer_geocode)
@@ -2,31 +2,65 @@ from datetime import datetime
 
 from geoalchemy2 import *
 from sqlalchemy import Column, BigInteger, String, DateTime, \
-    Integer, Boolean, create_engine, ForeignKey
+    Integer, Boolean, Float, create_engine, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import expression
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 from common import get_conf
+from common.bands import base_call_clause
 
 debug = False
 
-conf = get_conf()
+_engine = None
+Base = declarative_base()
 
-if debug:
-    con_string = f"postgresql://{conf['pg_user']}:{conf['pg_pw']}@" \
-                 f"{conf['pg_host']}/packetmaptest"
+__all__ = ["local_engine", "get_engine", "init_db", "BadGeocode",
+           "CrawledNode", "Digipeater", "GeocodeQueue",
+           "LocallyHeardStation", "Node",
+           "Operator", "RemoteDigipeater", "RemotelyHeardStation",
+           "RemoteOperator", "RunMetric"]
 
-else:
-    con_string = f"postgresql://{conf['pg_user']}:{conf['pg_pw']}@" \
-                 f"{conf['pg_host']}/{conf['pg_db']}"
 
-local_engine = create_engine(con_string)
-Base = declarative_base()
+def get_engine():
+    """
+    Get the engine, creating it on first use so importing the models
+    doesn't read settings.cfg or touch the database
+    :return: Engine object
+    """
+    global _engine
+
+    if _engine is None:
+        conf = get_conf()
+
+        if debug:
+            con_string = f"postgresql://{conf['pg_user']}:{conf['pg_pw']}@" \
+                         f"{conf['pg_host']}/packetmaptest"
+
+        else:
+            con_string = f"postgresql://{conf['pg_user']}:{conf['pg_pw']}@" \
+                         f"{conf['pg_host']}/{conf['pg_db']}"
 
-__all__ = ["local_engine", "BadGeocode", "CrawledNode", "Digipeater",
-           "LocallyHeardStation", "Node", "Operator", "RemoteDigipeater",
-           "RemotelyHeardStation", "RemoteOperator"]
+        _engine = create_engine(con_string)
+
+    return _engine
+
+
+def __getattr__(name):
+    # local_engine is created on first access
+    if name == "local_engine":
+        return get_engine()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def init_db(engine=None):
+    """
+    Create any tables that don't exist
+    :param engine: An engine object. Defaults to the configured engine.
+    """
+    Base.metadata.create_all(engine or get_engine(), checkfirst=True)
 
 
 class BadGeocode(Base):
@@ -37,7 +71,7 @@ class BadGeocode(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     last_checked = Column(DateTime, default=datetime.now())
     reason = Column(String, nullable=False)
-    node_name = Column(String, nullable=False)
+    node_name = Column(String, nullable=False, index=True)
     parent_node = Column(String, nullable=True)
 
 
@@ -46,6 +80,10 @@ class CrawledNode(Base):
     Nodes that have been crawled
     """
     __tablename__ = 'crawled_nodes'
+    __table_args__ = (
+        Index('ix_crawled_nodes_node_id_port_active_port', 'node_id', 'port',
+              'active_port'),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     node_id = Column(String, nullable=False)
     port = Column(Integer, nullable=False)
@@ -54,6 +92,10 @@ class CrawledNode(Base):
     needs_check = Column(Boolean, nullable=False)
     uid = Column(String, nullable=False)
     active_port = Column(Boolean, nullable=False)
+    # Averages over past crawls, used to rank ports to crawl next. NULL
+    # until the port has been auto crawled.
+    new_station_rate = Column(Float)  # New MH rows per day
+    crawl_seconds = Column(Float)  # Seconds to connect and fetch the MH list
 
     received_tx = relationship("RemotelyHeardStation",
                                back_populates="crawled_node",
@@ -83,6 +125,9 @@ class Digipeater(Base):
     Local digipeater data
     """
     __tablename__ = 'digipeaters'
+    __table_args__ = (
+        Index('uq_digipeaters_call', 'call', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     call = Column(String, nullable=False)
     lastheard = Column(DateTime, default=datetime.now())
@@ -93,13 +138,35 @@ class Digipeater(Base):
     lastcheck = Column(DateTime, default=datetime.now())
 
 
+class GeocodeQueue(Base):
+    """
+    Callsigns waiting on a lookup, for geocode_worker.py. kind is the table
+    the result goes to: operator, digipeater, remote_operator or
+    remote_digipeater. payload holds the values for a new row.
+    """
+    __tablename__ = 'geocode_queue'
+    __table_args__ = (
+        Index('uq_geocode_queue_kind_call', 'kind', 'call', unique=True),
+    )
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)
+    call = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    enqueued = Column(DateTime, nullable=False)
+    next_attempt = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+
+
 class LocallyHeardStation(Base):
     """
     Local MHeard List
     """
     __tablename__ = 'mh_list'
+    __table_args__ = (
+        Index('uq_mh_list_call_timestamp', 'call', 'timestamp', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
-    timestamp = Column(DateTime, default=datetime.now())
+    timestamp = Column(DateTime, default=datetime.now(), index=True)
     call = Column(String, nullable=False)
     digipeaters = Column(String, nullable=True)
     op_call = Column(String, nullable=False)
@@ -111,6 +178,10 @@ class Node(Base):
     Nodes I am connected to
     """
     __tablename__ = 'nodes'
+    __table_args__ = (
+        Index('ix_nodes_call_level', 'call', 'level'),
+        Index('uq_nodes_call', 'call', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     call = Column(String, nullable=False)
     parent_call = Column(String, nullable=False)
@@ -129,6 +200,9 @@ class Operator(Base):
     Locally heard operators
     """
     __tablename__ = 'operators'
+    __table_args__ = (
+        Index('uq_operators_call', 'call', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     call = Column(String, nullable=False)
     lastheard = Column(DateTime, default=datetime.now())
@@ -142,6 +216,9 @@ class RemoteDigipeater(Base):
     Remotely-heard digipeater
     """
     __tablename__ = 'remote_digipeaters'
+    __table_args__ = (
+        Index('uq_remote_digipeaters_call', 'call', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     parent_call = Column(String, ForeignKey("crawled_nodes.node_id"),
                          nullable=False)
@@ -164,6 +241,13 @@ class RemotelyHeardStation(Base):
     Remotely-heard station
     """
     __tablename__ = 'remote_mh'
+    __table_args__ = (
+        Index('ix_remote_mh_parent_call_port_heard_time', 'parent_call',
+              'port', 'heard_time'),
+        Index('uq_remote_mh_parent_call_port_remote_call_heard_bucket',
+              'parent_call', 'port', 'remote_call', 'heard_bucket',
+              unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     parent_call = Column(String, ForeignKey("crawled_nodes.node_id"),
                          nullable=False)
@@ -176,6 +260,13 @@ class RemotelyHeardStation(Base):
     band = Column(String, nullable=True)
     uid = Column(String, nullable=False)
     digis = Column(String, nullable=True)
+    # heard_time in HEARD_BUCKET_SECONDS buckets, for the unique key
+    heard_bucket = Column(BigInteger, nullable=True)
+
+
+# Finds an operator's MH rows when filling in their bands
+Index('ix_remote_mh_base_call',
+      base_call_clause(RemotelyHeardStation.remote_call))
 
 
 class RemoteOperator(Base):
@@ -183,6 +274,9 @@ class RemoteOperator(Base):
     Store remotely-heard operator data
     """
     __tablename__ = 'remote_operators'
+    __table_args__ = (
+        Index('uq_remote_operators_remote_call', 'remote_call', unique=True),
+    )
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     parent_call = Column(String, ForeignKey("crawled_nodes.node_id"),
                          nullable=False)
@@ -197,14 +291,14 @@ class RemoteOperator(Base):
     uid = Column(String, nullable=False)
     lastcheck = Column(DateTime, default=datetime.now())
 
-BadGeocode.__table__.create(local_engine, checkfirst=True)
-CrawledNode.__table__.create(local_engine, checkfirst=True)
-Digipeater.__table__.create(local_engine, checkfirst=True)
-LocallyHeardStation.__table__.create(local_engine, checkfirst=True)
-Node.__table__.create(local_engine, checkfirst=True)
-Operator.__table__.create(local_engine, checkfirst=True)
-RemoteDigipeater.__table__.create(local_engine, checkfirst=True)
-RemotelyHeardStation.__table__.create(local_engine, checkfirst=True)
-RemoteOperator.__table__.create(local_engine, checkfirst=True)
-
-Base.metadata.create_all(local_engine, checkfirst=True)
+
+class RunMetric(Base):
+    """
+    Counters & phase timings of each script run
+    """
+    __tablename__ = 'run_metrics'
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    run = Column(String, nullable=False, index=True)
+    started = Column(DateTime, nullable=False)
+    seconds = Column(Float, nullable=False)
+    data = Column(JSONB, nullable=False)
@@ -2,9 +2,11 @@
 # coding:utf-8
 
 import os
+import threading
 import requests
 import xmltodict
 from configparser import ConfigParser
+from requests.adapters import HTTPAdapter
 
 
 class QRZerror(Exception):
@@ -20,14 +22,42 @@ class QRZMissingCredentials(Exception):
     pass
 
 class QRZ(object):
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, session_file=None, pool_size=10):
         if cfg:
             self._cfg = ConfigParser()
             self._cfg.read(cfg)
         else:
             self._cfg = None
-        self._session = None
-        self._session_key = None
+        # One pooled keep-alive session for the life of the client
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session_file = session_file
+        self._session_key = self._load_session_key()
+        self._lock = threading.Lock()
+
+    def _load_session_key(self):
+        if not self._session_file:
+            return None
+        try:
+            with open(self._session_file) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _save_session_key(self):
+        if not self._session_file:
+            return
+        try:
+            if self._session_key:
+                with open(self._session_file, 'w') as f:
+                    f.write(self._session_key)
+                os.chmod(self._session_file, 0o600)
+            elif os.path.exists(self._session_file):
+                os.remove(self._session_file)
+        except OSError:
+            pass
 
     def _get_session(self):
         if self._cfg and self._cfg.has_section('qrz'):
@@ -40,20 +70,29 @@ class QRZ(object):
             raise QRZMissingCredentials("No Username/Password found")
 
         url = '''https://xmldata.qrz.com/xml/current/?username={0}&password={1}'''.format(username, password)
-        self._session = requests.Session()
         #self._session.verify = bool(os.getenv('SSL_VERIFY', False))
         r = self._session.get(url)
         if r.status_code == 200:
             raw_session = xmltodict.parse(r.content)
             self._session_key = raw_session.get('QRZDatabase').get('Session').get('Key')
             if self._session_key:
+                self._save_session_key()
                 return True
         raise QRZsessionNotFound("Could not get QRZ session")
 
+    def _expire_session(self, session_key):
+        with self._lock:
+            # Another thread may already have logged in again
+            if self._session_key == session_key:
+                self._session_key = None
+                self._save_session_key()
+
     def callsign(self, callsign, retry=True):
-        if self._session_key is None:
-            self._get_session()
-        url = """http://xmldata.qrz.com/xml/current/?s={0}&callsign={1}""".format(self._session_key, callsign)
+        with self._lock:
+            if self._session_key is None:
+                self._get_session()
+            session_key = self._session_key
+        url = """http://xmldata.qrz.com/xml/current/?s={0}&callsign={1}""".format(session_key, callsign)
         r = self._session.get(url)
         if r.status_code != 200:
             raise Exception("Error Querying: Response code {}".format(r.status_code))
@@ -64,8 +103,7 @@ class QRZ(object):
             errormsg = raw['Session'].get('Error')
             if 'Session Timeout' in errormsg or 'Invalid session key' in errormsg:
                 if retry:
-                    self._session_key = None
-                    self._session = None
+                    self._expire_session(session_key)
                     return self.callsign(callsign, retry=False)
             elif "not found" in errormsg.lower():
                 raise CallsignNotFound(errormsg)
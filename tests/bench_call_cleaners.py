@@ -0,0 +1,54 @@
+"""
+Call cleaner benchmarks. These aren't collected with the unit tests; run
+them with:
+
+python -m pytest tests/bench_call_cleaners.py -s
+
+Set BENCH_MIN_RATE to fail any benchmark slower than that many calls per
+second.
+"""
+import os
+import random
+import time
+
+from common.string_cleaner import clean_calls
+import pytest
+
+
+def random_call(rng):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return f"{rng.choice('KNW')}{rng.randint(0, 9)}" \
+           f"{''.join(rng.choice(letters) for _ in range(3))}-" \
+           f"{rng.randint(1, 15)}"
+
+
+def nodes_list(entries, rng):
+    # Every fourth entry repeats an earlier node with its parts swapped,
+    # like a node heard by its call and its alias
+    calls = []
+    for i in range(entries):
+        if i % 4 == 3:
+            alias, call = calls[rng.randrange(len(calls))].split(b':')
+            calls.append(call + b':' + alias)
+        else:
+            calls.append(f"N{i:06}:{random_call(rng)}".encode('ascii'))
+
+    return calls
+
+
+@pytest.mark.parametrize('entries', [10000, 100000])
+def test_clean_rate(entries):
+    calls = nodes_list(entries, random.Random(1))
+
+    start = time.perf_counter()
+    cleaned = clean_calls(calls)
+    elapsed = time.perf_counter() - start
+
+    rate = entries / elapsed
+    print(f"\n{entries} nodes: {len(cleaned)} after cleaning in "
+          f"{elapsed:.3f}s, {rate:,.0f} calls/s")
+
+    assert len(cleaned) <= entries * 3 // 4 + 1
+
+    min_rate = float(os.environ.get('BENCH_MIN_RATE', 0))
+    assert rate >= min_rate
@@ -0,0 +1,96 @@
+"""
+Parser benchmarks. These aren't collected with the unit tests; run them
+with:
+
+python -m pytest tests/bench_parsers.py -s
+
+Set BENCH_MIN_RATE to fail any benchmark slower than that many records
+per second.
+"""
+import datetime
+import os
+import random
+import time
+
+from common.bpq_parser import BPQParser, port_header
+import pytest
+
+now = datetime.datetime(2024, 1, 30, 12, 0, 0)
+months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec']
+
+
+def random_call(rng):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return f"{rng.choice('KNW')}{rng.randint(0, 9)}" \
+           f"{''.join(rng.choice(letters) for _ in range(3))}-" \
+           f"{rng.randint(1, 15)}"
+
+
+def mh_listing(rows, rng):
+    lines = [b"GMNOD:KD5LPB-7} Heard List for Port 1"]
+    for i in range(rows):
+        line = f"{random_call(rng):<10}{rng.randint(0, 9):02}:" \
+               f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:" \
+               f"{rng.randint(0, 59):02}"
+        if i % 3 == 0:
+            line += f" via {random_call(rng)}*,{random_call(rng)}"
+        lines.append(line.encode('ascii'))
+    lines.append(b"*** Disconnected from Stream 1")
+
+    return b"\r".join(lines) + b"\r"
+
+
+def mhu_listing(rows, rng):
+    lines = [b"KD5LPB:KD5LPB-7} Heard List for Port 1"]
+    for i in range(rows):
+        line = f"{random_call(rng):<10}{rng.choice(months)} " \
+               f"{rng.randint(1, 28):2} {rng.randint(0, 23):02}:" \
+               f"{rng.randint(0, 59):02}:{rng.randint(0, 59):02}"
+        if i % 3 == 0:
+            line += f" via {random_call(rng)}"
+        lines.append(line.encode('ascii'))
+
+    return b"\r".join(lines) + b"\r"
+
+
+def nodes_listing(rows, rng):
+    lines = [b"GMNOD:KD5LPB-7} Nodes"]
+    for i in range(0, rows, 4):
+        lines.append("  ".join(f"N{n:05}:{random_call(rng)}"
+                               for n in range(i, i + 4)).encode('ascii'))
+
+    return b"\r".join(lines) + b"\r"
+
+
+listings = {
+    'mh': (mh_listing, port_header(1)),
+    'mhu': (mhu_listing, port_header(1)),
+    'nodes': (nodes_listing, b"Nodes")
+}
+
+
+@pytest.mark.parametrize('command', sorted(listings))
+@pytest.mark.parametrize('chunk_size', [256, 65536])
+def test_parse_rate(command, chunk_size):
+    make_listing, header = listings[command]
+    rows = 50000
+    data = make_listing(rows, random.Random(1))
+
+    start = time.perf_counter()
+    parser = BPQParser(command, header, now)
+    records = 0
+    for i in range(0, len(data), chunk_size):
+        records += len(parser.feed(data[i:i + chunk_size]))
+    records += len(parser.close())
+    elapsed = time.perf_counter() - start
+
+    rate = records / elapsed
+    print(f"\n{command} in {chunk_size} byte chunks: {records} records in "
+          f"{elapsed:.3f}s, {rate:,.0f} records/s")
+
+    assert records == rows
+    assert parser.errors == []
+
+    min_rate = float(os.environ.get('BENCH_MIN_RATE', 0))
+    assert rate >= min_rate
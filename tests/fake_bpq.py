@@ -0,0 +1,290 @@
+#!/bin/python3
+# A fake BPQ telnet server for load and latency testing without a real
+# node or RF links. Point the [telnet] section of settings.cfg at it.
+
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec']
+
+
+class FakeNode(object):
+    """
+    A node with synthetic ports, MH lists and nodes list
+    """
+
+    def __init__(self, alias, call, rng, mh_rows, node_rows):
+        self.alias = alias
+        self.call = call
+        self.ports = ['2M 145.050 1200 Baud', '70CM 441.000 9600 Baud',
+                      'Telnet Server']
+
+        # Heard lists per port, as (call, seconds ago, digipeaters)
+        self.heard = {}
+        for port in range(1, len(self.ports) + 1):
+            heard = []
+            for i in range(mh_rows):
+                digipeaters = None
+                if i % 3 == 0:
+                    digipeaters = f"{random_call(rng)}*,{random_call(rng)}"
+                heard.append((random_call(rng), rng.randint(0, 7 * 86400),
+                              digipeaters))
+            self.heard[port] = sorted(heard, key=lambda h: h[1])
+
+        self.nodes = [(f"N{i:05}", random_call(rng)) for i in
+                      range(node_rows)]
+
+    @property
+    def prompt(self):
+        return f"{self.alias}:{self.call}}}"
+
+
+def random_call(rng):
+    return f"{rng.choice('KNW')}{rng.randint(0, 9)}" \
+           f"{''.join(rng.choice(LETTERS) for _ in range(3))}-" \
+           f"{rng.randint(1, 15)}"
+
+
+class FakeBPQServer(socketserver.ThreadingTCPServer):
+    """
+    Implements the login prompt and the c, p, mh, mhu, nodes and bye
+    commands, with configurable latency, throughput and dropped
+    connections
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, user="test", password="test",
+                 node_count=10, mh_rows=20, node_rows=40, latency=0,
+                 jitter=0, throughput=0, drop_rate=0, seed=1):
+        """
+        :param address: (host, port) tuple. Port 0 picks a free port.
+        :param user: Telnet username
+        :param password: Telnet password
+        :param node_count: Number of remote nodes. They're named NODE0,
+        NODE1, ...
+        :param mh_rows: Rows in each port's MH list
+        :param node_rows: Rows in each nodes list
+        :param latency: Seconds before answering each command. Connecting
+        to and commands on remote nodes take twice as long.
+        :param jitter: Random seconds added to the latency
+        :param throughput: Bytes per second to send, 0 for no limit
+        :param drop_rate: Chance of dropping the connection on a command
+        :param seed: Random seed for the synthetic tables
+        """
+        super().__init__(address, FakeBPQHandler)
+        rng = random.Random(seed)
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.throughput = throughput
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.local = FakeNode("LOCAL", "KD5LPB-7", rng, mh_rows, node_rows)
+        self.nodes = {f"NODE{i}": FakeNode(f"NODE{i}", random_call(rng), rng,
+                                           mh_rows, node_rows)
+                      for i in range(node_count)}
+        self.commands = 0
+        self.logins = 0
+
+    def random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+
+class FakeBPQHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.buffer = b''
+        self.node = None
+
+        self.send(b"user: ")
+        user = self.read_line()
+        self.send(b"password:")
+        password = self.read_line()
+        if user != server.user or password != server.password:
+            self.send(b"Invalid Password\r\n")
+            return
+
+        server.logins += 1
+        self.send(b"Welcome to KD5LPB Telnet Server\r\n")
+
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            if not line:
+                continue
+
+            server.commands += 1
+            self.wait()
+            if server.drop_rate and server.random() < server.drop_rate:
+                return
+
+            if not self.command(line):
+                return
+
+    def command(self, line):
+        """
+        Answer a command
+        :return: False if the connection should be closed
+        """
+        node = self.node or self.server.local
+        words = line.split()
+        command = words[0].lower()
+
+        if command == 'c' and len(words) > 1:
+            remote = self.server.nodes.get(words[1].upper())
+            if self.node or remote is None:
+                self.send(f"{node.prompt} Downlink connect needs port "
+                          f"number\r".encode('ascii'))
+            else:
+                self.wait()
+                self.node = remote
+                self.send(f"{node.prompt} Connected to {remote.alias}\r"
+                          f"Welcome to {remote.alias}\r".encode('ascii'))
+
+        elif command == 'p':
+            lines = [f"{node.prompt} Ports"]
+            lines += [f"  {i} {name}" for i, name in
+                      enumerate(node.ports, start=1)]
+            self.send_lines(lines)
+
+        elif command in ('mh', 'mhu'):
+            try:
+                port = int(words[1])
+                heard = node.heard[port]
+            except (IndexError, ValueError, KeyError):
+                self.send(f"{node.prompt} Invalid Port\r".encode('ascii'))
+                return True
+
+            now = time.time()
+            lines = [f"{node.prompt} Heard List for Port {port}"]
+            for call, ago, digipeaters in heard:
+                if command == 'mh':
+                    days, rest = divmod(ago, 86400)
+                    hours, rest = divmod(rest, 3600)
+                    minutes, seconds = divmod(rest, 60)
+                    line = f"{call:<10}{days:02}:{hours:02}:{minutes:02}:" \
+                           f"{seconds:02}"
+                else:
+                    heard_time = time.gmtime(now - ago)
+                    line = f"{call:<10}{MONTHS[heard_time.tm_mon - 1]} " \
+                           f"{heard_time.tm_mday:02} " \
+                           f"{time.strftime('%H:%M:%S', heard_time)}"
+                if digipeaters:
+                    line += f" via {digipeaters}"
+                lines.append(line)
+            self.send_lines(lines)
+
+        elif command in ('n', 'nodes'):
+            lines = [f"{node.prompt} Nodes"]
+            for i in range(0, len(node.nodes), 4):
+                lines.append("  ".join(f"{alias}:{call}" for alias, call in
+                                       node.nodes[i:i + 4]))
+            self.send_lines(lines)
+
+        elif command in ('b', 'bye'):
+            if self.node:
+                self.send(f"*** Disconnected from {self.node.alias}\r"
+                          f"Returned to Node {self.server.local.prompt[:-1]}"
+                          f"\r".encode('ascii'))
+                self.node = None
+            else:
+                self.send(b"*** Disconnected\r")
+                return False
+
+        else:
+            self.send(f"{node.prompt} Invalid command\r".encode('ascii'))
+
+        return True
+
+    def wait(self):
+        """
+        Sleep for the command latency
+        """
+        server = self.server
+        delay = server.latency + server.jitter * server.random()
+        if self.node:
+            delay *= 2
+        if delay:
+            time.sleep(delay)
+
+    def read_line(self):
+        """
+        Read a line ending in a carriage return
+        :return: Line string, or None if the connection closed
+        """
+        while b'\r' not in self.buffer:
+            try:
+                data = self.request.recv(1024)
+            except OSError:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split(b'\r', 1)
+        return line.strip().decode('ascii', errors='replace')
+
+    def send_lines(self, lines):
+        self.send(("\r".join(lines) + "\r").encode('ascii'))
+
+    def send(self, data):
+        """
+        Send data, limited to the server throughput
+        """
+        throughput = self.server.throughput
+        if not throughput:
+            self.request.sendall(data)
+            return
+
+        # Send in small chunks, like frames over a slow link
+        chunk_size = max(int(throughput / 10), 1)
+        for i in range(0, len(data), chunk_size):
+            self.request.sendall(data[i:i + chunk_size])
+            time.sleep(chunk_size / throughput)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake BPQ telnet server")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--user', default="test")
+    parser.add_argument('--password', default="test")
+    parser.add_argument('--nodes', type=int, default=10,
+                        help="Number of remote nodes, named NODE0, NODE1...")
+    parser.add_argument('--mh-rows', type=int, default=20,
+                        help="Rows in each port's MH list")
+    parser.add_argument('--node-rows', type=int, default=40,
+                        help="Rows in each nodes list")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds before answering each command")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Random seconds added to the latency")
+    parser.add_argument('--throughput', type=float, default=0,
+                        help="Bytes per second, 0 for no limit")
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help="Chance of dropping the connection on a "
+                             "command")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    server = FakeBPQServer((args.host, args.port), args.user, args.password,
+                           args.nodes, args.mh_rows, args.node_rows,
+                           args.latency, args.jitter, args.throughput,
+                           args.drop_rate, args.seed)
+    print(f"Fake BPQ server on {args.host}:{server.server_address[1]} with "
+          f"nodes NODE0 to NODE{args.nodes - 1}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,52 @@
+import datetime
+
+from common.bad_geocodes import BadGeocodeIndex, tokens
+import pytest
+
+checked = datetime.datetime(2024, 1, 30, 12, 0, 0)
+
+
+def test_tokens():
+    assert tokens('LPBNOD:KD5LPB-7') == {'LPBNOD', 'KD5LPB-7', 'KD5LPB'}
+    assert tokens(':KE0GB-7') == {'KE0GB-7', 'KE0GB'}
+    assert tokens('ROSE') == {'ROSE'}
+
+
+def test_lookup_by_part():
+    index = BadGeocodeIndex([('LPBNOD:KD5LPB-7', checked), ('ROSE', None)])
+
+    assert len(index) == 2
+    assert 'LPBNOD:KD5LPB-7' in index
+    assert 'LPBNOD' in index
+    assert 'KD5LPB' in index
+    assert 'ROSE' in index
+    assert 'KD5' not in index
+    assert None not in index
+
+    assert index.get('KD5LPB-7') == checked
+    assert index.get('ROSE') is None
+    assert index.get('KE0GB') is None
+
+
+def test_shared_part_gets_latest_time():
+    later = checked + datetime.timedelta(days=1)
+    index = BadGeocodeIndex([('LPBNOD:KD5LPB-7', checked),
+                             ('LPBBBS:KD5LPB-1', later)])
+
+    assert index.get('KD5LPB') == later
+    assert index.get('LPBNOD') == checked
+
+    index.add('KE0GB', later)
+    assert 'KE0GB' in index
+
+
+def test_has_name_is_exact():
+    index = BadGeocodeIndex([('LPBNOD:KD5LPB-7', checked)])
+
+    # A new node name sharing the callsign matches by part, but not by
+    # name, so it still gets its own bad geocode row
+    assert 'KD5LPB-7' in index
+    assert not index.has_name('LPBBBS:KD5LPB-7')
+    assert index.has_name('LPBNOD:KD5LPB-7')
+    assert not index.has_name('KD5LPB')
+    assert not index.has_name(None)
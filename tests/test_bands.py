@@ -0,0 +1,45 @@
+from sqlalchemy.dialects import postgresql
+
+from common.bands import classify_band, update_operator_bands, \
+    base_call_clause
+from models.db import RemoteOperator, RemotelyHeardStation
+import pytest
+
+
+def test_band_from_frequency():
+    assert classify_band('2M 144.990 1200 Baud') == '2M'
+    assert classify_band('UHF 441.300') == '70CM'
+    assert classify_band('223.780') == '1.25M'
+    assert classify_band('HF 14.105 Robust') == '20M'
+    assert classify_band('7.101 300 Baud') == '40M'
+    assert classify_band('3.590') == '80M'
+
+
+def test_band_from_label():
+    assert classify_band('2m Packet') == '2M'
+    assert classify_band('70cm 9600') == '70CM'
+
+
+def test_no_band():
+    assert classify_band('Telnet') is None
+    assert classify_band('1200 Baud') is None
+    assert classify_band(None) is None
+
+
+def test_operator_bands_use_base_call_index():
+    class Session(object):
+        def execute(self, statement):
+            self.statement = statement
+            return self
+
+        rowcount = 0
+
+    session = Session()
+    update_operator_bands(session, RemoteOperator, RemotelyHeardStation)
+    sql = str(session.statement)
+
+    # The join has to match the indexed expression exactly
+    index = str(base_call_clause(RemotelyHeardStation.remote_call).compile(
+        dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+    assert index.replace('remote_mh.', 'mh.') in sql
+    assert "WHERE op.bands IS NULL" in sql
@@ -0,0 +1,188 @@
+import datetime
+import os
+
+from common.bpq_parser import BPQParser, MHRecord, NodeRecord, PortRecord, \
+    parse_listing, port_header
+import pytest
+
+now = datetime.datetime(2024, 1, 30, 12, 0, 0)
+
+# Sample transcripts in the format BPQ sends over telnet
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures', 'bpq')
+
+
+def read_fixture(name):
+    with open(os.path.join(fixtures, name), 'rb') as f:
+        return f.read()
+
+
+def feed_chunks(parser, data, size):
+    """
+    Feed data in pieces, like reads from a slow link
+    """
+    records = []
+    for start in range(0, len(data), size):
+        records += parser.feed(data[start:start + size])
+
+    return records + parser.close()
+
+
+def test_split_across_feeds():
+    parser = BPQParser('mh', b"Port 1", now)
+    records = parser.feed(b"GMNOD:KD5LPB-7} Heard List for Port 1\rKE0G")
+    assert records == []
+
+    records = parser.feed(b"B-7   00:01:00:00 via KD5LPB-7*,N0CALL\r")
+    assert records == [MHRecord('KE0GB-7', now - datetime.timedelta(hours=1),
+                                ['KD5LPB-7*', 'N0CALL'])]
+
+
+def test_malformed_line():
+    parser = BPQParser('mh', b"Port 1", now)
+    records = parser.feed(b"Port 1\r\nKE0GB-7 00:xx:01:00\r\n"
+                          b"W0ARP-7 00:00:00:10\r\n*** Disconnected\r\n")
+
+    assert [record.call for record in records] == ['W0ARP-7']
+    assert parser.errors[0].line == 'KE0GB-7 00:xx:01:00'
+    assert parser.done
+
+
+def test_text_before_header_ignored():
+    parser = BPQParser('nodes', b"Nodes")
+    records = parser.feed(b"Welcome to GMNOD 12:00:00\r")
+    records += parser.feed(b"GMNOD:KD5LPB-7} Nodes\r")
+    records += parser.feed(b"LPBNOD:KD5LPB-7  KE0GB-7")
+    records += parser.close()
+
+    assert records == [NodeRecord('LPBNOD', 'KD5LPB-7'),
+                       NodeRecord(None, 'KE0GB-7')]
+
+
+def test_end_at_next_listing():
+    data = b"GMNOD:KD5LPB-7} Heard List for Port 1\rKE0GB-7 00:00:00:10\r" \
+           b"GMNOD:KD5LPB-7} Heard List for Port 2\rW0ARP-7 00:00:00:20\r"
+    parser = BPQParser('mh', port_header(1), now, end=port_header(2))
+    records = parser.feed(data)
+
+    assert [record.call for record in records] == ['KE0GB-7']
+    assert parser.done
+    assert parser.leftover.startswith(b"GMNOD:KD5LPB-7} Heard List for Port 2")
+
+    records, errors = parse_listing('mh', port_header(2), parser.leftover,
+                                    now)
+    assert [record.call for record in records] == ['W0ARP-7']
+
+
+def test_ports_fixture():
+    ports, errors = parse_listing('ports', b"Ports", read_fixture('ports.txt'))
+
+    assert ports == [PortRecord(1, '2M 145.050 1200 Baud'),
+                     PortRecord(2, '70CM 441.000 9600 Baud'),
+                     PortRecord(3, 'Telnet Server'),
+                     PortRecord(4, 'HF 7.101 VARA')]
+    assert errors == []
+
+
+def test_mh_fixture():
+    records, errors = parse_listing('mh', port_header(1),
+                                    read_fixture('mh.txt'), now)
+
+    assert len(records) == 5
+    assert records[0] == MHRecord('KE0GB-7',
+                                  datetime.datetime(2024, 1, 30, 11, 57, 46),
+                                  ['KD5LPB-7*'])
+    assert records[1].digipeaters is None
+    assert records[2].digipeaters == ['KE0GB-7', 'KD5LPB-7*']
+    assert records[4].heard_time == datetime.datetime(2024, 1, 28, 8, 55, 55)
+    assert [error.line for error in errors] == ['K0BAD-1   corrupted']
+
+
+def test_mhu_fixture():
+    records, errors = parse_listing('mhu', port_header(1),
+                                    read_fixture('mhu.txt'), now)
+
+    assert [record.call for record in records] == \
+           ['KE0GB-7', 'W0ARP', 'N0HI-7', 'KD0XYZ']
+    assert records[0].heard_time == datetime.datetime(2024, 1, 30, 11, 58, 14)
+    assert records[2].digipeaters == ['KE0GB-7', 'KD5LPB-7']
+    # Later than now, so heard last year
+    assert records[3].heard_time == datetime.datetime(2023, 12, 31, 23, 59, 59)
+    assert len(errors) == 1
+
+
+def test_nodes_fixture():
+    records, errors = parse_listing('nodes', b"Nodes",
+                                    read_fixture('nodes.txt'))
+
+    assert records[:2] == [NodeRecord('LPBNOD', 'KD5LPB-7'),
+                           NodeRecord('COSCO', 'KE0GB-7')]
+    assert NodeRecord(None, 'KE0GB-10') in records
+    assert NodeRecord('#TEMP', 'W0ARP-3') in records
+    assert len(records) == 7
+    assert [error.line for error in errors] == ['----']
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 39, 40])
+def test_fixture_split_across_reads(size):
+    # Lines end in a bare \r, and reads can end anywhere, including right
+    # after one
+    data = read_fixture('mh.txt')
+    whole, errors = parse_listing('mh', port_header(1), data, now)
+
+    parser = BPQParser('mh', port_header(1), now)
+    assert feed_chunks(parser, data, size) == whole
+    assert parser.errors == errors
+
+    # A \r\n split between reads doesn't make an extra line
+    parser = BPQParser('mh', port_header(1), now)
+    assert feed_chunks(parser, data.replace(b'\r', b'\r\n'), size) == whole
+    assert parser.errors == errors
+
+
+def test_disconnect_mid_listing_fixture():
+    parser = BPQParser('mh', port_header(1), now)
+    records = feed_chunks(parser, read_fixture('mh_disconnect.txt'), 16)
+
+    assert [record.call for record in records] == ['KE0GB-7', 'W0ARP']
+    # The line cut off by the disconnect is an error, and nothing after
+    # the disconnect is parsed
+    assert [error.line for error in parser.errors] == ['N0HI-7    00:01:']
+    assert parser.done
+    assert parser.feed(b"KD5LPB-2  00:00:00:42\r") == []
+
+
+def test_mixed_mh_mhu_fixture():
+    data = read_fixture('mh_mixed.txt')
+    parser = BPQParser('mh', port_header(1), now, end=port_header(2))
+    records = parser.feed(data)
+
+    assert [record.call for record in records] == ['KE0GB-7', 'N0HI-7']
+    assert [error.line for error in parser.errors] == \
+           ['W0ARP     Jan 30 11:44:30']
+
+    records, errors = parse_listing('mhu', port_header(2), parser.leftover,
+                                    now)
+    assert [record.call for record in records] == ['KD0XYZ', 'KE0GB-10']
+    assert records[1].heard_time == datetime.datetime(2024, 1, 29, 23, 10)
+    assert [error.line for error in errors] == ['W0ARP-7   00:00:10:00']
+
+
+def test_long_via_chain_fixture():
+    records, errors = parse_listing('mhu', port_header(1),
+                                    read_fixture('mhu_via.txt'), now)
+
+    assert errors == []
+    assert len(records) == 3
+    assert records[0].digipeaters == ['KD5LPB-7*', 'W0ARP-7*', 'N0HI-7*',
+                                      'KD0XYZ-1*', 'KE0GB-10*', 'W0ARP-3',
+                                      'N0HI-1', 'KD5LPB-2']
+    assert len(records[1].digipeaters) == 7
+    assert records[2].digipeaters is None
+
+
+def test_port_header():
+    records, errors = parse_listing('mh', port_header(1),
+                                    b"Heard List for Port 10\r"
+                                    b"KE0GB-7 00:00:00:01\r", now)
+
+    assert records == []
@@ -0,0 +1,56 @@
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from common.bulk import BulkWriter
+import pytest
+
+Base = declarative_base()
+
+
+class HeardStation(Base):
+    __tablename__ = 'heard'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    call = Column(String, nullable=False)
+    digis = Column(String, nullable=True)
+    port = Column(String, default="1")
+
+
+def test_bulk_insert():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    writer = BulkWriter(session, method="insert")
+    writer.add(HeardStation(call='KD5LPB-7', digis=''))
+    writer.add(HeardStation(call='KE0GB-7', port="2"))
+
+    assert len(writer) == 2
+    assert writer.flush() == 2
+    assert len(writer) == 0
+
+    rows = session.query(HeardStation.call, HeardStation.digis,
+                         HeardStation.port).order_by(HeardStation.id).all()
+    assert rows == [('KD5LPB-7', '', '1'), ('KE0GB-7', None, '2')]
+
+
+class Operator(Base):
+    __tablename__ = 'operators'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    call = Column(String, nullable=False, unique=True)
+
+
+def test_ignore_conflicts():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Operator(call='KD5LPB'))
+    session.commit()
+
+    writer = BulkWriter(session, method="insert", ignore_conflicts=True)
+    writer.add(Operator(call='KD5LPB'))
+    writer.add(Operator(call='KE0GB'))
+
+    assert writer.flush() == 1
+    assert sorted(call for call, in session.query(Operator.call)) == \
+        ['KD5LPB', 'KE0GB']
@@ -9,6 +9,22 @@ def test_strip_call():
     assert ssid == 7
 
 
+def test_callsign():
+    callsign = string_cleaner.get_callsign('n0call-7*')
+    assert callsign.call == 'N0CALL-7'
+    assert callsign.base == 'N0CALL'
+    assert callsign.ssid == 7
+    assert callsign.heard
+    assert callsign.valid
+    assert string_cleaner.get_callsign('n0call-7*') is callsign
+    assert callsign == string_cleaner.Callsign(b'N0CALL-7')
+
+    callsign = string_cleaner.get_callsign('ROSE')
+    assert callsign.ssid is None
+    assert not callsign.heard
+    assert not callsign.valid
+
+
 def test_remove_dupes():
     dupe_list = [['LPBNOD', 'KD5LPB-7'], ['KD5LPB-7', 'LPBNOD'],
                  ['COSCO', 'KE0GB-7'],['KE0GB-7', 'COSCO']]
@@ -22,3 +38,11 @@ def test_clean_calls():
     output_node_names = string_cleaner.clean_calls(input_node_names)
     assert output_node_names == [[b'LPBNOD', b'KD5LPB-7'], [b'COSCO', b'KE0GB-7'],
                                  [b'PHYLNS', b'W0ARP-7'], [b'SOLBPQ', b'N0HI-7']]
+
+
+def test_clean_calls_str():
+    input_node_names = ['LPBNOD:KD5LPB-7', 'KD5LPB-7:LPBNOD', 'KE0GB-7',
+                        ':W0ARP-7', '']
+    output_node_names = string_cleaner.clean_calls(input_node_names)
+    assert output_node_names == [['LPBNOD', 'KD5LPB-7'], ['KE0GB-7'],
+                                 ['W0ARP-7']]
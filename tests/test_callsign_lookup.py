@@ -1,5 +1,18 @@
 import pytest
-from common import get_info
+import common
+from common import get_info, get_info_many
+from common.geocode_cache import GeocodeCache
+
+
+@pytest.fixture(autouse=True)
+def geocode_cache(tmp_path, monkeypatch):
+    # Start every test with an empty cache instead of the one in the repo
+    # root, so results don't depend on earlier runs
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=60)
+    monkeypatch.setattr(common, '_geocode_cache', cache)
+
+    return cache
 
 
 def test_bad_callsign_lookup():
@@ -14,6 +27,12 @@ def test_bad_callsign_lookup():
     assert bad_results_4 is None
 
 
+def test_bad_callsign_lookup_many():
+    bad_results = get_info_many(['SYDNEY', 'ROSE', None], 'hamdb')
+
+    assert bad_results == {'SYDNEY': None, 'ROSE': None}
+
+
 def test_good_callsign_lookup():
     good_results_1 = get_info('KD5LPB', 'QRZ')
     good_results_2 = get_info('PD2SKZ', 'QRZ')
@@ -0,0 +1,58 @@
+import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from common.crawl_priority import crawl_score, crawl_score_clause, \
+    update_crawl_stats
+from models.db import CrawledNode
+
+now = datetime.datetime(2024, 1, 30, 12, 0, 0)
+
+
+def test_busy_port_first():
+    last_crawled = now - datetime.timedelta(days=2)
+
+    busy = crawl_score(last_crawled, 200, 20, now)
+    quiet = crawl_score(last_crawled, 0, 20, now)
+    slow = crawl_score(last_crawled, 200, 120, now)
+
+    assert busy > slow > quiet
+
+
+def test_quiet_port_gets_stale():
+    # A port that never hears anything still comes up eventually
+    quiet = crawl_score(now - datetime.timedelta(days=30), 0, 20, now)
+    busy = crawl_score(now - datetime.timedelta(days=1), 10, 20, now)
+
+    assert quiet > busy
+
+
+def test_new_port_explored():
+    last_crawled = now - datetime.timedelta(days=1)
+
+    assert crawl_score(last_crawled, None, None, now) > \
+        crawl_score(last_crawled, 20, 30, now)
+
+
+def test_update_crawl_stats():
+    # First crawl sets the averages
+    rate, seconds = update_crawl_stats(None, None, 20, 2, 10)
+    assert rate == 10
+    assert seconds == 10
+
+    rate, seconds = update_crawl_stats(rate, seconds, 40, 1, 20)
+    assert round(rate, 6) == 19
+    assert round(seconds, 6) == 13
+
+    # A recrawl after a few minutes counts as an hour
+    rate, seconds = update_crawl_stats(None, None, 1, 0.001, 10)
+    assert rate == 24
+
+
+def test_score_clause():
+    sql = str(crawl_score_clause(CrawledNode, now).compile(
+        dialect=postgresql.dialect()))
+
+    assert 'EXTRACT(epoch FROM' in sql
+    assert 'coalesce(crawled_nodes.new_station_rate' in sql
+    assert 'greatest(coalesce(crawled_nodes.crawl_seconds' in sql
@@ -0,0 +1,81 @@
+import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from common.dedupe import HeardIndex, heard_bucket, \
+    duplicates_statement, delete_duplicates_statement
+from models.db import Operator, RemotelyHeardStation
+import pytest
+
+heard_time = datetime.datetime(2024, 1, 30, 12, 0, 0)
+
+
+def test_seen_in_window():
+    index = HeardIndex([('KD5LPB-7', heard_time)], window=5)
+
+    assert index.seen('KD5LPB-7', heard_time)
+    assert index.seen('KD5LPB-7', heard_time + datetime.timedelta(seconds=5))
+    assert index.seen('KD5LPB-7', heard_time - datetime.timedelta(seconds=5))
+    assert not index.seen('KD5LPB-7',
+                          heard_time + datetime.timedelta(seconds=6))
+    assert not index.seen('KE0GB-7', heard_time)
+
+
+def test_seen_checks_date():
+    index = HeardIndex([('KD5LPB-7', heard_time)], window=5)
+
+    assert not index.seen('KD5LPB-7', heard_time + datetime.timedelta(days=1))
+
+
+def test_add():
+    index = HeardIndex(window=0)
+    index.add('KD5LPB-7', heard_time)
+    index.add('KD5LPB-7', heard_time - datetime.timedelta(hours=1))
+
+    assert len(index) == 2
+    assert index.seen('KD5LPB-7', heard_time)
+    assert not index.seen('KD5LPB-7',
+                          heard_time - datetime.timedelta(seconds=1))
+
+
+def test_heard_bucket():
+    assert heard_bucket(heard_time) == 1706616000 // 10
+    assert heard_bucket(heard_time + datetime.timedelta(seconds=9)) == \
+        heard_bucket(heard_time)
+    assert heard_bucket(heard_time + datetime.timedelta(seconds=10)) == \
+        heard_bucket(heard_time) + 1
+
+
+def test_duplicates_statement():
+    sql = str(duplicates_statement(Operator.__table__).compile(
+        dialect=postgresql.dialect()))
+    assert sql == "SELECT operators.call \nFROM operators " \
+                  "GROUP BY operators.call \n" \
+                  "HAVING count(*) > %(count_1)s \n LIMIT %(param_1)s"
+
+    sql = str(duplicates_statement(
+        RemotelyHeardStation.__table__).compile(dialect=postgresql.dialect()))
+    assert "JOIN" not in sql
+    assert "EXTRACT(epoch FROM remote_mh.heard_time)" in sql
+
+
+def test_delete_duplicates_statement():
+    sql = str(delete_duplicates_statement(Operator.__table__).compile(
+        dialect=postgresql.dialect()))
+    assert sql == "DELETE FROM operators AS a USING operators AS b " \
+                  "WHERE a.call = b.call AND a.id > b.id"
+
+    # Remote MH rows are matched on heard_time buckets, so rows without a
+    # heard_bucket yet are deduped too
+    sql = str(delete_duplicates_statement(
+        RemotelyHeardStation.__table__).compile(dialect=postgresql.dialect()))
+    assert "a.remote_call = b.remote_call" in sql
+    assert "EXTRACT(epoch FROM a.heard_time)" in sql
+    assert "heard_bucket" not in sql
+
+
+def test_delete_duplicates_batch():
+    sql = str(delete_duplicates_statement(Operator.__table__, 1, 5001).compile(
+        dialect=postgresql.dialect()))
+    assert sql.endswith("AND a.id > b.id AND a.id >= %(id_1)s "
+                        "AND a.id < %(id_2)s")
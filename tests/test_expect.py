@@ -0,0 +1,140 @@
+import re
+import socket
+import threading
+import time
+from telnetlib import Telnet
+
+from common.bpq_parser import BPQParser
+from common.expect import expect, read_records
+import pytest
+
+
+@pytest.fixture
+def link():
+    """
+    A Telnet object connected to a local socket standing in for the node
+    """
+    node, client = socket.socketpair()
+    tn = Telnet()
+    tn.sock = client
+    yield tn, node
+    node.close()
+    tn.close()
+
+
+def send_later(sock, chunks, delay=0.1):
+    def run():
+        for chunk in chunks:
+            time.sleep(delay)
+            sock.sendall(chunk)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_expect_pattern(link):
+    tn, node = link
+    send_later(node, [b"Connected to GMNOD\r", b"GMNOD:KD5LPB-7} "]).join()
+
+    index, data = expect(tn, [b"nothing", re.compile(rb'\w+:[\w-]+\} ')],
+                         timeout=5)
+
+    assert index == 1
+    assert data.startswith(b"Connected to GMNOD")
+
+
+def test_expect_split_across_reads(link):
+    tn, node = link
+    send_later(node, [b"Welcome\r" * 50 + b"Conn", b"ected to GMNOD\r",
+                      b"GMNOD:KD5LP", b"B-7} "], delay=0.05)
+
+    index, data = expect(tn, [b"Connected to"], timeout=5)
+    assert index == 0
+
+    index, data = expect(tn, [re.compile(rb'\w+:[\w-]+\} ')], timeout=5)
+    assert index == 0
+    assert data.endswith(b"GMNOD:KD5LPB-7} ")
+
+
+def test_expect_leftover(link):
+    tn, node = link
+    start = time.monotonic()
+
+    # Nothing more is sent, so the match has to come from the data passed in
+    index, data = expect(tn, [b"Returned to Node"], timeout=5,
+                         data=b"*** Disconnected\rReturned to Node GMNOD\r")
+
+    assert index == 0
+    assert time.monotonic() - start < 1
+
+
+def test_expect_deadline(link):
+    tn, node = link
+    start = time.monotonic()
+
+    index, data = expect(tn, [b"Ports"], timeout=0.3)
+
+    assert index == -1
+    assert data == b''
+    assert time.monotonic() - start < 1
+
+
+def test_expect_closed(link):
+    tn, node = link
+    node.sendall(b"KD5LPB-7 Jan 30 12:00:00\r")
+    node.close()
+
+    index, data = expect(tn, [], timeout=5)
+
+    assert index == -1
+    assert data == b"KD5LPB-7 Jan 30 12:00:00\r"
+
+
+def test_read_records_idle(link):
+    tn, node = link
+    thread = send_later(node, [b"GMNOD:KD5LPB-7} Ports\r",
+                               b"  1 2M 145.050\r",
+                               b"  2 70CM 441.000\r"])
+    start = time.monotonic()
+
+    parser = BPQParser('ports', b"Ports")
+    ports = list(read_records(tn, parser, timeout=10, idle=0.5))
+    thread.join()
+
+    assert [port.number for port in ports] == [1, 2]
+    assert ports[1].name == "70CM 441.000"
+    assert time.monotonic() - start < 3
+
+
+def test_read_records_disconnect(link):
+    tn, node = link
+    send_later(node, [b"GMNOD:KD5LPB-7} Heard List for Port 1\r"
+                      b"KE0GB-7   00:00:00:05\r",
+                      b"*** Disconnected\r"]).join()
+
+    parser = BPQParser('mh', b"Port 1")
+    records = list(read_records(tn, parser, timeout=10))
+
+    assert [record.call for record in records] == ['KE0GB-7']
+    assert parser.done
+
+
+def test_read_records_leftover(link):
+    tn, node = link
+    send_later(node, [b"GMNOD:KD5LPB-7} Heard List for Port 1\r"
+                      b"KE0GB-7   00:00:00:05\r"
+                      b"GMNOD:KD5LPB-7} Heard List for Port 2\r"
+                      b"W0ARP-7   00:00:00:10\r"
+                      b"*** Disconnected\r"]).join()
+
+    first = BPQParser('mh', b"Port 1", end=re.compile(rb'\w+:[\w-]+\} '))
+    records = list(read_records(tn, first, timeout=10))
+    assert [record.call for record in records] == ['KE0GB-7']
+
+    # The next list is handed on by the caller, not pushed back into the
+    # telnet object
+    second = BPQParser('mh', b"Port 2")
+    records = list(read_records(tn, second, timeout=10, data=first.leftover))
+    assert [record.call for record in records] == ['W0ARP-7']
+    assert second.done
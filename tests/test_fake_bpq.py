@@ -0,0 +1,165 @@
+import threading
+
+import common
+import mh_crawler
+from common import telnet_connect
+from common.bpq_parser import MHRecord
+from common.metrics import metrics
+from fake_bpq import FakeBPQServer
+import pytest
+
+
+def start_server(**options):
+    server = FakeBPQServer(("127.0.0.1", 0), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def fake_bpq(monkeypatch):
+    servers = []
+
+    def start(**options):
+        server = start_server(**options)
+        servers.append(server)
+        conf = {'telnet_ip': "127.0.0.1",
+                'telnet_port': server.server_address[1],
+                'telnet_user': "test", 'telnet_pw': "test"}
+        monkeypatch.setattr(common, 'get_conf', lambda: conf)
+        # Listings without an end marker finish when the link goes quiet
+        monkeypatch.setattr(mh_crawler, 'IDLE_TIMEOUT', 0.2)
+        return server
+
+    yield start
+
+    mh_crawler.close_gateways()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_local_node(fake_bpq):
+    server = fake_bpq(mh_rows=5)
+    tn = telnet_connect()
+
+    node_name_map = mh_crawler.get_ports(tn)
+    assert node_name_map[1] == '2M 145.050 1200 Baud'
+    assert server.logins == 1
+    tn.close()
+
+
+def test_crawl_through_gateway(fake_bpq):
+    server = fake_bpq(node_count=3, mh_rows=30)
+    metrics.clear()
+
+    for node in ['NODE0', 'NODE1', 'NODE2']:
+        node_name_map, mh_lists, now, seconds = mh_crawler.fetch_node(
+            node, {1: '2M 145.050 1200 Baud'})
+        mh_list = mh_lists[1]
+
+        assert len(node_name_map) == 3
+        assert len(mh_list) == 30
+        assert isinstance(mh_list[0], MHRecord)
+        assert mh_list == sorted(mh_list, key=lambda x: x.heard_time)
+
+    # One login, reused for each node
+    assert server.logins == 1
+
+    timings = metrics.snapshot('mh_crawler')['timings']
+    assert timings['gateway_login']['count'] == 1
+    assert timings['node_connect']['count'] == 3
+    assert timings['command_mh']['count'] == 3
+
+
+def test_all_ports_one_connection(fake_bpq):
+    server = fake_bpq(node_count=2, mh_rows=25)
+
+    for node in ['NODE0', 'NODE1']:
+        node_name_map, mh_lists, now, seconds = mh_crawler.fetch_node(
+            node, {1: None, 2: '70CM 441.000 9600 Baud', 3: 'Changed'})
+
+        # Port 3's name has changed, so it isn't fetched
+        assert sorted(mh_lists) == [1, 2]
+        assert len(mh_lists[1]) == 25
+        assert len(mh_lists[2]) == 25
+        assert mh_lists[1] != mh_lists[2]
+
+    assert server.logins == 1
+
+
+def test_ports_end_at_next_prompt(fake_bpq, monkeypatch):
+    fake_bpq(node_count=1, mh_rows=5)
+    # The crawl mustn't wait for the link to go quiet
+    monkeypatch.setattr(mh_crawler, 'IDLE_TIMEOUT', 30)
+
+    node_name_map, mh_lists, now, seconds = mh_crawler.fetch_node(
+        'NODE0', {1: None, 5: None})
+
+    assert len(node_name_map) == 3
+    # Port 5 doesn't exist, so its answer is skipped
+    assert sorted(mh_lists) == [1]
+    assert len(mh_lists[1]) == 5
+    assert seconds < 10
+
+
+def test_unknown_node(fake_bpq):
+    fake_bpq()
+
+    with pytest.raises(mh_crawler.CrawlError):
+        mh_crawler.fetch_node('NOWHERE', {1: None})
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.clears = 0
+
+    def clear(self):
+        self.clears += 1
+
+
+def test_crawl_error_skips_node(fake_bpq, monkeypatch):
+    fake_bpq(node_count=2, mh_rows=5)
+    session = FakeSession()
+    writer = FakeWriter()
+    stored = []
+
+    def store_mh_list(node_to_crawl, port_name, mh_list, now):
+        # A bug in one node's rows mustn't end the run
+        if node_to_crawl == 'NODE0':
+            raise ValueError("Bad row")
+        stored.append(node_to_crawl)
+        return len(mh_list)
+
+    monkeypatch.setattr(mh_crawler, 'session', session)
+    monkeypatch.setattr(mh_crawler, 'writer', writer)
+    monkeypatch.setattr(mh_crawler, 'load_caches', lambda: None)
+    monkeypatch.setattr(mh_crawler, 'check_crawled_port',
+                        lambda node, port, name: (True, name))
+    monkeypatch.setattr(mh_crawler, 'update_crawled_node',
+                        lambda *args: None)
+    monkeypatch.setattr(mh_crawler, 'save_crawl_stats', lambda *args: None)
+    monkeypatch.setattr(mh_crawler, 'store_mh_list', store_mh_list)
+
+    node_to_crawl_info = {node: (node, 1, None, None, None) for node in
+                          ['NODE0', 'NODE1']}
+    errors = mh_crawler.crawl_nodes(node_to_crawl_info)
+
+    assert errors == 1
+    assert stored == ['NODE1']
+    assert session.rollbacks == 1
+    assert writer.clears == 1
+    assert session.commits == 1
@@ -0,0 +1,142 @@
+import socket
+import threading
+from telnetlib import Telnet
+
+import common.gateway
+from common.bpq_parser import BPQParser
+from common.gateway import GatewaySession
+import pytest
+
+
+class FakeNode(object):
+    """
+    Answers connect and bye commands like a local BPQ node
+    """
+
+    def __init__(self, returned=True):
+        self.returned = returned
+        self.logins = 0
+        self.sockets = []
+        # Sessions closed without telling the client. Commands sent on them
+        # are ignored.
+        self.dropped = set()
+
+    def telnet_connect(self):
+        node, client = socket.socketpair()
+        self.sockets.append(node)
+        self.logins += 1
+        threading.Thread(target=self.serve, args=(node,), daemon=True).start()
+
+        tn = Telnet()
+        tn.sock = client
+        return tn
+
+    def serve(self, sock):
+        buffer = b''
+        while True:
+            try:
+                data = sock.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            if sock in self.dropped:
+                continue
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                line = line.strip()
+                if line.startswith(b'c '):
+                    sock.sendall(b"Connected to " + line[2:] + b"\r")
+                elif line == b'n':
+                    sock.sendall(b"KD5LPB:KD5LPB-7} Nodes\r"
+                                 b"LPBNOD:KD5LPB-1   GMNOD:KE0GB-7\r")
+                elif line == b'bye' and self.returned:
+                    sock.sendall(b"Returned to Node KD5LPB:KD5LPB-7\r")
+
+
+@pytest.fixture
+def fake_node(monkeypatch):
+    node = FakeNode()
+    monkeypatch.setattr(common.gateway, 'telnet_connect', node.telnet_connect)
+    monkeypatch.setattr(common.gateway, 'IDLE_TIMEOUT', 0.2)
+    yield node
+    for sock in node.sockets:
+        sock.close()
+
+
+def test_session_reused(fake_node):
+    gateway = GatewaySession()
+
+    for node_name in ['GMNOD', 'KE0GB']:
+        tn = gateway.connect(node_name)
+        assert tn is not None
+        tn.write(b"bye\r")
+        assert gateway.release(timeout=5)
+
+    assert gateway.logins == 1
+    assert fake_node.logins == 1
+    gateway.close()
+
+
+def test_session_dropped(fake_node):
+    fake_node.returned = False
+    gateway = GatewaySession()
+
+    tn = gateway.connect('GMNOD')
+    tn.write(b"bye\r")
+    assert not gateway.release(timeout=0.5)
+    assert gateway.tn is None
+
+    assert gateway.connect('KE0GB') is not None
+    assert gateway.logins == 2
+    gateway.close()
+
+
+def test_session_dropped_silently(fake_node):
+    gateway = GatewaySession()
+
+    tn = gateway.connect('GMNOD')
+    tn.write(b"bye\r")
+    assert gateway.release(timeout=5)
+
+    # The local node closes the idle session without telling us, so
+    # writes still work but nothing comes back
+    fake_node.dropped.add(fake_node.sockets[0])
+    fake_node.sockets[0].shutdown(socket.SHUT_WR)
+
+    assert gateway.connect('KE0GB') is not None
+    assert gateway.logins == 2
+    gateway.close()
+
+
+def test_local_command(fake_node):
+    gateway = GatewaySession()
+
+    for i in range(2):
+        parser, nodes = gateway.local_command(
+            b"n", lambda: BPQParser('nodes', b"Nodes"), timeout=5)
+        assert parser.started
+        assert [node.call for node in nodes] == ['KD5LPB-1', 'KE0GB-7']
+
+    tn = gateway.connect('GMNOD')
+    tn.write(b"bye\r")
+    assert gateway.release(timeout=5)
+
+    assert gateway.logins == 1
+    gateway.close()
+
+
+def test_local_command_dropped_silently(fake_node):
+    gateway = GatewaySession()
+    gateway.local_command(b"n", lambda: BPQParser('nodes', b"Nodes"),
+                          timeout=5)
+
+    fake_node.dropped.add(fake_node.sockets[0])
+    fake_node.sockets[0].shutdown(socket.SHUT_WR)
+
+    parser, nodes = gateway.local_command(
+        b"n", lambda: BPQParser('nodes', b"Nodes"), timeout=5)
+    assert len(nodes) == 2
+    assert gateway.logins == 2
+    gateway.close()
@@ -0,0 +1,31 @@
+from common.geocode_cache import GeocodeCache
+import pytest
+
+
+def test_cache_hit(tmp_path):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=60)
+    cache.put('kd5lpb', 'qrz', ('39.603100', '-104.699620', 'DM79po'))
+
+    assert cache.get('KD5LPB', 'qrz') == \
+        (True, ('39.603100', '-104.699620', 'DM79po'))
+    assert cache.get('KD5LPB', 'hamdb') == (False, None)
+
+
+def test_cache_not_found(tmp_path):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=60)
+    cache.put('ROSE', 'hamdb', None)
+
+    assert cache.get('ROSE', 'hamdb') == (True, None)
+
+
+def test_cache_expiry(tmp_path):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=-1)
+    cache.put('ROSE', 'hamdb', None)
+    cache.put('KD5LPB', 'hamdb', ('39.603100', '-104.699620', 'DM79po'))
+
+    assert cache.get('ROSE', 'hamdb') == (False, None)
+    assert cache.evict() == 1
+    assert cache.get('KD5LPB', 'hamdb')[0] is True
@@ -0,0 +1,118 @@
+import datetime
+from collections import namedtuple
+
+from sqlalchemy.dialects import postgresql
+
+import common
+import geocode_worker
+from common import get_cached_info_many
+from common.geocode_cache import GeocodeCache
+from common.geocode_queue import queue_payload, read_payload, retry_delay, \
+    enqueue_statement, claim_statement, release_geocodes
+from models.db import GeocodeQueue
+
+now = datetime.datetime(2024, 1, 30, 12, 0, 0)
+
+
+def compile_statement(statement):
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_payload_round_trip():
+    payload = queue_payload(parent_call="GMNOD", lastheard=now, heard=True,
+                            ssid=None)
+
+    assert payload['lastheard'] == "2024-01-30T12:00:00"
+    assert read_payload(payload) == {'parent_call': "GMNOD",
+                                     'lastheard': now, 'heard': True,
+                                     'ssid': None}
+
+
+def test_retry_backoff():
+    assert retry_delay(1) == datetime.timedelta(minutes=5)
+    assert retry_delay(2) == datetime.timedelta(minutes=10)
+    assert retry_delay(3) == datetime.timedelta(minutes=20)
+
+
+def test_enqueue_skips_queued_calls():
+    sql = compile_statement(enqueue_statement(
+        GeocodeQueue, {('operator', 'KE0GB'): {}, ('digipeater', 'W0ARP'): {}},
+        now))
+
+    assert sql.startswith("INSERT INTO geocode_queue")
+    assert "ON CONFLICT (kind, call) DO NOTHING" in sql
+
+
+def test_claim_skips_locked_rows():
+    sql = compile_statement(claim_statement(GeocodeQueue, 50, now))
+
+    assert sql.startswith("UPDATE geocode_queue SET")
+    assert "FOR UPDATE SKIP LOCKED" in sql
+    assert "RETURNING geocode_queue.id" in sql
+
+
+def test_cached_info_many_skips_invalid_calls(tmp_path, monkeypatch):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=60)
+    cache.put('KD5LPB', 'hamdb', ('39.603100', '-104.699620', 'DM79po'))
+    monkeypatch.setattr(common, '_geocode_cache', cache)
+
+    # Invalid calls are never cached, so they'd be queued on every crawl
+    assert get_cached_info_many(['KD5LPB', 'BEACON', 'KE0GB'], 'hamdb') == \
+        {'KD5LPB': ('39.603100', '-104.699620', 'DM79po'), 'BEACON': None}
+
+
+def test_release_geocodes():
+    class Session(object):
+        def execute(self, statement):
+            self.statement = statement
+
+    session = Session()
+    release_geocodes(session, GeocodeQueue, [1, 2], now)
+    sql = compile_statement(session.statement)
+
+    assert "attempts=(geocode_queue.attempts - %(attempts_1)s)" in sql
+    assert "WHERE geocode_queue.id IN" in sql
+
+
+def test_cached_not_found_is_not_retried(tmp_path, monkeypatch):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=60,
+                         negative_ttl=60)
+    cache.put('KE0GB', 'hamdb', None)
+    monkeypatch.setattr(common, '_geocode_cache', cache)
+
+    Row = namedtuple('Row', ['id', 'kind', 'call', 'payload', 'attempts'])
+    claimed = [Row(1, 'remote_operator', 'KE0GB', {}, 1),
+               Row(2, 'remote_operator', 'W0ARP', {}, 1)]
+    looked_up = []
+    retried = []
+    finished = []
+
+    def get_info_many(calls, method):
+        looked_up.extend(calls)
+        # The provider is down
+        return {call: None for call in calls}
+
+    monkeypatch.setattr(geocode_worker, 'claim_geocodes',
+                        lambda *args: claimed)
+    monkeypatch.setattr(geocode_worker, 'get_info_many', get_info_many)
+    monkeypatch.setattr(geocode_worker, 'apply_geocode',
+                        lambda *args: 'bad_geocode')
+    monkeypatch.setattr(geocode_worker, 'retry_geocode',
+                        lambda session, queue, queue_id, *args:
+                        retried.append(queue_id))
+    monkeypatch.setattr(geocode_worker, 'finish_geocode',
+                        lambda session, queue, queue_id:
+                        finished.append(queue_id))
+
+    class Session(object):
+        def commit(self):
+            pass
+
+    assert geocode_worker.process_batch(Session(), 50, 'hamdb') == 2
+
+    # The cached miss is finished on its first attempt, without asking the
+    # provider again. The failed lookup is retried.
+    assert looked_up == ['W0ARP']
+    assert finished == [1]
+    assert retried == [2]
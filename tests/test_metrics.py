@@ -0,0 +1,68 @@
+import json
+import os
+
+from common.metrics import Metrics, export, prometheus_text
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_timings_and_counters():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    for seconds in [2, 5]:
+        with metrics.timer('node_connect'):
+            clock.now += seconds
+    metrics.count('mh', 3)
+    metrics.count('mh')
+
+    snapshot = metrics.snapshot('mh_crawler')
+    assert snapshot['seconds'] == 7
+    assert snapshot['counters'] == {'mh': 4}
+    assert snapshot['timings']['node_connect'] == {'count': 2, 'total': 7,
+                                                   'max': 5}
+
+    metrics.clear()
+    assert metrics.snapshot('mh_crawler')['timings'] == {}
+
+
+def test_timer_records_errors():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    with pytest.raises(OSError):
+        with metrics.timer('gateway_login'):
+            clock.now += 1
+            raise OSError("Connection refused")
+
+    assert metrics.snapshot('mh_crawler')['timings']['gateway_login'][
+        'total'] == 1
+
+
+def test_export(tmp_path):
+    metrics = Metrics()
+    metrics.count('mh', 12)
+    metrics.add_time('db_commit', 0.25)
+    snapshot = metrics.snapshot('mh_to_pg')
+
+    json_file = tmp_path / "metrics.jsonl"
+    export(snapshot, str(json_file), str(tmp_path))
+    export(snapshot, str(json_file), str(tmp_path))
+
+    lines = json_file.read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])['counters'] == {'mh': 12}
+
+    prom = (tmp_path / "mh_stats_mh_to_pg.prom").read_text()
+    assert prom == prometheus_text(snapshot)
+    assert 'mh_stats_run_count{run="mh_to_pg",name="mh"} 12' in prom
+    assert 'mh_stats_phase_seconds{run="mh_to_pg",phase="db_commit"} 0.25' \
+        in prom
+    assert not os.path.exists(tmp_path / "mh_stats_mh_to_pg.prom.tmp")
@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+
+def test_import_does_not_touch_db(tmp_path):
+    # Run from a directory without settings.cfg, so reading it would fail
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=repo)
+    code = "import models.db as db; assert db._engine is None; " \
+           "assert db.Base.metadata.tables"
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path,
+                            env=env, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
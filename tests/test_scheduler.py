@@ -0,0 +1,67 @@
+from common.scheduler import Scheduler
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_cadences(clock):
+    scheduler = Scheduler(clock=clock, sleep=clock.sleep)
+    runs = []
+    scheduler.add("fast", 10, lambda: runs.append(("fast", clock.now)))
+    scheduler.add("slow", 25, lambda: runs.append(("slow", clock.now)),
+                  delay=5)
+    assert scheduler.add("off", 0, lambda: None) is None
+
+    while clock.now <= 50:
+        clock.sleep(scheduler.run_pending())
+
+    assert [t for name, t in runs if name == "fast"] == [0, 10, 20, 30, 40, 50]
+    assert [t for name, t in runs if name == "slow"] == [5, 30]
+
+
+def test_failing_job(clock):
+    scheduler = Scheduler(clock=clock, sleep=clock.sleep)
+
+    def fail():
+        raise ValueError("no route")
+
+    job = scheduler.add("failing", 10, fail)
+
+    assert scheduler.run_pending() == 10
+    clock.sleep(10)
+    scheduler.run_pending()
+
+    assert job.runs == 2
+    assert job.failures == 2
+
+
+def test_exit_is_not_swallowed(clock):
+    scheduler = Scheduler(clock=clock, sleep=clock.sleep)
+    scheduler.add("exits", 10, exit)
+
+    with pytest.raises(SystemExit):
+        scheduler.run_pending()
+
+
+def test_slow_job_does_not_catch_up(clock):
+    scheduler = Scheduler(clock=clock, sleep=clock.sleep)
+    job = scheduler.add("slow", 10, lambda: clock.sleep(35))
+
+    scheduler.run_pending()
+
+    assert clock.now == 35
+    assert job.next_run == 35